@@ -74,6 +74,8 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
   String _serverIp = '192.168.137.1';  // 默认 IP，会被 UDP 发现覆盖
   int _serverPort = 9527;
   String _lastSentText = '';  // 保存上次发送的文本
+  bool _lastSentManually = false;  // 上次是否为手动发送（可在 PC 端撤销）
+  List<String> _serverFeatures = [];  // PC 端支持的协议功能
   bool _showMenu = false;  // 是否显示下拉菜单
   bool _shadowModeEnabled = false;  // 自动发送开关
   int _lastSentLength = 0;  // 自动发送：已发送的字符数
@@ -197,6 +199,7 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
           _status = ConnectionStatus.connected;
           _syncEnabled = data['sync_enabled'] ?? true;
           _deviceName = data['computer_name'] ?? '';
+          _serverFeatures = List<String>.from(data['features'] ?? []);
         });
       } else if (type == 'ack') {
         _textController.clear();
@@ -217,6 +220,9 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
       _deviceName = '';
     });
 
+    // 查询 PC 当前地址（热点重启后 IP 可能变化）
+    _sendDiscoveryQuery();
+
     // Reconnect after 3 seconds
     _reconnectTimer?.cancel();
     _reconnectTimer = Timer(const Duration(seconds: 3), () {
@@ -245,12 +251,29 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
           }
         }
       });
+
+      // 主动查询，PC 端立即回复，无需等待下一次广播
+      _sendDiscoveryQuery();
     } catch (e) {
       print('UDP 发现启动失败: $e');
       // 如果 UDP 启动失败，仍然可以使用默认 IP 连接
     }
   }
 
+  /// 发送 UDP 发现查询
+  /// PC 端收到后直接回复服务器信息到本端口
+  void _sendDiscoveryQuery() {
+    try {
+      _udpSocket?.send(
+        utf8.encode(json.encode({'type': 'voice_coding_discover'})),
+        InternetAddress('255.255.255.255'),
+        _udpBroadcastPort,
+      );
+    } catch (e) {
+      print('UDP 发现查询失败: $e');
+    }
+  }
+
   /// 处理 UDP 发现消息
   void _handleUdpDiscovery(String message, String sourceIp) {
     try {
@@ -294,6 +317,7 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
       }));
       // 保存文本用于撤回
       _lastSentText = text;
+      _lastSentManually = true;
       // 重置自动发送已发送长度（因为文本框会被清空）
       _lastSentLength = 0;
     } catch (e) {
@@ -346,6 +370,7 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
       _lastSentLength = currentText.length;
       // 保存当前文本用于撤回（自动发送模式下也能撤回）
       _lastSentText = currentText;
+      _lastSentManually = false;
     } catch (e) {
       print('自动发送失败: $e');
     }
@@ -439,6 +464,18 @@ class _MainPageState extends State<MainPage> with WidgetsBindingObserver, Ticker
   }
 
   void _recallLastText() {
+    // 手动发送的文本是 PC 上的一次输入，可由 PC 端删除
+    if (_lastSentManually &&
+        _status == ConnectionStatus.connected &&
+        _serverFeatures.contains('undo')) {
+      try {
+        _channel!.sink.add(json.encode({'type': 'undo'}));
+      } catch (e) {
+        print('撤销失败: $e');
+      }
+      _lastSentManually = false;
+    }
+
     // 从本地恢复上次发送的文本
     if (_lastSentText.isNotEmpty) {
       _textController.text = _lastSentText;
@@ -0,0 +1,426 @@
+"""
+Voicing - WebSocket Load Benchmark
+语音编程 - WebSocket 压测工具
+
+Starts the real server (`start_server` / `handle_client`) in-process with a
+null injection backend and drives it with simulated phone clients sending
+realistic dictation traffic: short auto-send increments, long manual sends
+and heartbeat pings.
+
+Reports throughput, ack latency percentiles and server event-loop lag.
+
+`--clipboard-stress N` instead pastes N messages back to back through
+`ClipboardTransactions` against a fake clipboard and checks that every
+message was pasted and the user's clipboard was restored.
+
+Usage / 用法:
+    cd pc
+    python benchmark.py --clients 4 --duration 10
+    python benchmark.py --clipboard-stress 100 --clipboard-delay 20
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import deque
+
+import websockets
+
+import voice_coding
+from voice_coding import state
+
+
+# Dictation fragments an IME typically commits in auto-send mode
+# 自动发送模式下输入法一次提交的典型片段
+SHADOW_PHRASES = [
+    "好的", "我们", "现在", "把这个函数", "改成异步的", "然后", "加一个参数",
+    "，", "。", "返回值", "是列表", "self", "return", "await", "为什么",
+    "这里会报错", "检查一下", "日志", "谢谢",
+]
+
+LOOP_LAG_INTERVAL = 0.01  # 事件循环延迟采样间隔（秒）
+
+
+def percentile(samples: list, pct: float) -> float:
+    """Nearest-rank percentile of pre-sorted samples / 已排序样本的百分位数"""
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, math.ceil(pct / 100 * len(samples)) - 1))
+    return samples[rank]
+
+
+def find_free_port() -> int:
+    """Ask the OS for an unused TCP port / 获取一个空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerHarness:
+    """
+    Run the Voicing server on its own thread and event loop.
+    在独立线程和事件循环中运行 Voicing 服务器。
+    """
+
+    def __init__(self, port: int, backend: str, batch_window: float, compress_min_size: int):
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.loop_lag = []
+        self._thread = threading.Thread(target=self._run, name="BenchServer", daemon=True)
+
+        state.ws_port = port
+        state.running = True
+        state.batch_window = batch_window
+        state.compression_min_size = compress_min_size
+        state.injection_backend = voice_coding.create_injection_backend(backend)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.create_task(self._monitor_loop_lag())
+        self.loop.run_until_complete(voice_coding.start_server())
+        self.loop.close()
+
+    async def _monitor_loop_lag(self):
+        """Measure how late the loop wakes a sleeping task / 测量事件循环唤醒延迟"""
+        while state.running:
+            started = time.perf_counter()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag.append(time.perf_counter() - started - LOOP_LAG_INTERVAL)
+
+    def start(self):
+        self._thread.start()
+        # Wait until the listener accepts connections / 等待服务器开始监听
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            try:
+                with socket.create_connection(("127.0.0.1", self.port), timeout=0.2):
+                    return
+            except OSError:
+                time.sleep(0.05)
+        raise RuntimeError("server did not start")
+
+    def stop(self):
+        state.running = False
+        self._thread.join(timeout=5)
+
+
+class SimulatedPhone:
+    """
+    One phone client generating dictation traffic.
+    模拟一台手机发送听写流量。
+    """
+
+    def __init__(self, index: int, port: int, args):
+        self.index = index
+        self.url = f"ws://127.0.0.1:{port}"
+        self.args = args
+        self.rng = random.Random(args.seed + index)
+        self.ack_latency = []
+        self.pong_latency = []
+        self.queue_latency = []
+        self.inject_latency = []
+        self.sent_texts = 0
+        self.sent_bytes = 0
+        self._text_sent_at = {}  # id (v1) or seq (v2) -> send time
+        self._ping_sent_at = deque()
+        self._seq = 0
+
+    async def run(self, deadline: float):
+        async with websockets.connect(self.url, max_size=None) as ws:
+            await ws.recv()  # connected
+            if self.args.protocol >= 2:
+                await ws.send(json.dumps({
+                    "type": "hello",
+                    "client_id": f"bench-{self.index}",
+                    "reset": True,
+                    "protocol": self.args.protocol,
+                    "binary": self.args.binary,
+                }))
+                await ws.recv()  # session
+            reader = asyncio.create_task(self._read(ws))
+            pinger = asyncio.create_task(self._ping(ws, deadline))
+            try:
+                await self._dictate(ws, deadline)
+                await pinger
+                # Drain outstanding acks / 等待剩余的确认
+                drain_deadline = time.monotonic() + 5
+                while self._text_sent_at and time.monotonic() < drain_deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                pinger.cancel()
+                reader.cancel()
+
+    async def _send_text(self, ws, text: str):
+        if self.args.protocol >= 2:
+            # Pipelined, sequence-numbered frames / 带序号的流水线发送
+            self._seq += 1
+            if self.args.binary:
+                frame = struct.pack(">BI", 0x01, self._seq) + text.encode("utf-8")
+            else:
+                frame = json.dumps({"type": "text", "content": text, "seq": self._seq})
+            key = self._seq
+        else:
+            key = f"{self.index}-{self.sent_texts}"
+            frame = json.dumps({"type": "text", "content": text, "id": key})
+        self._text_sent_at[key] = time.perf_counter()
+        self.sent_texts += 1
+        self.sent_bytes += len(frame) if isinstance(frame, bytes) else len(frame.encode("utf-8"))
+        await ws.send(frame)
+
+    def _ack_upto(self, seq: int, now: float):
+        """Cumulative ack: everything up to seq is done / 累计确认"""
+        while self._text_sent_at:
+            first = next(iter(self._text_sent_at))
+            if first > seq:
+                break
+            self.ack_latency.append(now - self._text_sent_at.pop(first))
+
+    async def _dictate(self, ws, deadline: float):
+        rng = self.rng
+        while time.monotonic() < deadline:
+            if rng.random() < self.args.manual_ratio:
+                # Long manual send / 手动发送长文本
+                length = rng.randint(200, 2000)
+                text = "".join(rng.choice(SHADOW_PHRASES) for _ in range(length // 3))
+                await self._send_text(ws, text)
+                await asyncio.sleep(rng.uniform(0.5, 2.0) * self.args.pace)
+            else:
+                # Burst of auto-send increments while speaking / 说话时连续的影随增量
+                for _ in range(rng.randint(3, 12)):
+                    await self._send_text(ws, rng.choice(SHADOW_PHRASES))
+                    await asyncio.sleep(rng.uniform(0.005, 0.12) * self.args.pace)
+                await asyncio.sleep(rng.uniform(0.2, 1.0) * self.args.pace)
+
+    async def _ping(self, ws, deadline: float):
+        while time.monotonic() < deadline:
+            self._ping_sent_at.append(time.perf_counter())
+            await ws.send(json.dumps({"type": "ping"}))
+            await asyncio.sleep(self.args.ping_interval)
+
+    async def _read(self, ws):
+        async for message in ws:
+            now = time.perf_counter()
+            if isinstance(message, bytes):
+                # Binary cumulative ack / 二进制累计确认
+                _, seq = struct.unpack_from(">BI", message)
+                self._ack_upto(seq, now)
+                continue
+            data = json.loads(message)
+            msg_type = data.get("type")
+            if msg_type == "ack":
+                if "seq" in data:
+                    self._ack_upto(data["seq"], now)
+                else:
+                    sent_at = self._text_sent_at.pop(data.get("id"), None)
+                    if sent_at is not None:
+                        self.ack_latency.append(now - sent_at)
+                timing = data.get("timing")
+                if timing:
+                    # Server-side breakdown (ms) / 服务器端各阶段耗时（毫秒）
+                    self.queue_latency.append((timing["inject_start"] - timing["recv"]) / 1000)
+                    self.inject_latency.append((timing["inject_end"] - timing["inject_start"]) / 1000)
+            # Pongs arrive in send order / pong 按发送顺序返回
+            elif msg_type == "pong" and self._ping_sent_at:
+                self.pong_latency.append(now - self._ping_sent_at.popleft())
+
+
+def format_ms(samples: list) -> str:
+    if not samples:
+        return "n/a"
+    samples = sorted(samples)
+    return (f"p50 {percentile(samples, 50) * 1000:7.2f}  "
+            f"p95 {percentile(samples, 95) * 1000:7.2f}  "
+            f"p99 {percentile(samples, 99) * 1000:7.2f}  "
+            f"max {samples[-1] * 1000:7.2f} ms")
+
+
+class FakeClipboard:
+    """
+    Clipboard plus a target app that reads it some time after Ctrl+V.
+    模拟剪贴板，以及在 Ctrl+V 之后延迟读取剪贴板的目标程序。
+
+    Each Ctrl+V gets a random read lag, but the read itself happens when the
+    clipboard is next written (or on `settle()`), so the result does not
+    depend on thread scheduling. A write before the lag has passed means the
+    transactions did not wait long enough; it is counted in `early_writes`.
+    """
+
+    def __init__(self, content: str, max_read_lag: float, rng: random.Random):
+        self.content = content
+        self.max_read_lag = max_read_lag
+        self.rng = rng
+        self.pasted = []
+        self.early_writes = 0
+        self.lock = threading.Lock()
+        self._pending_read = None  # 目标程序读取剪贴板的时刻
+
+    def read(self) -> str:
+        with self.lock:
+            return self.content
+
+    def write(self, text: str):
+        with self.lock:
+            self._app_reads()
+            self.content = text
+
+    def press_paste(self):
+        with self.lock:
+            self._app_reads()
+            self._pending_read = time.perf_counter() + self.rng.uniform(0, self.max_read_lag)
+
+    def settle(self):
+        """Let the app finish its last read / 让目标程序完成最后一次读取"""
+        with self.lock:
+            self._app_reads()
+
+    def _app_reads(self):
+        if self._pending_read is None:
+            return
+        if time.perf_counter() < self._pending_read:
+            self.early_writes += 1
+        self.pasted.append(self.content)
+        self._pending_read = None
+
+
+def run_clipboard_stress(args) -> bool:
+    """Paste a burst through a fake clipboard and verify it / 用模拟剪贴板验证连续粘贴"""
+    rng = random.Random(args.seed)
+    settle = max(0.0, args.clipboard_delay / 1000)
+    messages = [f"{i}:{rng.choice(SHADOW_PHRASES)}" for i in range(args.clipboard_stress)]
+    ok = True
+
+    # user_copy_at: index after which the user copies something mid-burst
+    # user_copy_at：在第几条之后用户于连续粘贴期间复制了新内容
+    for label, user_copy_at in (("burst", None), ("user copy mid-burst", len(messages) // 2)):
+        original = "用户原剪贴板"
+        clipboard = FakeClipboard(original, settle * 0.8, rng)
+        transactions = voice_coding.ClipboardTransactions(
+            clipboard.read, clipboard.write, clipboard.press_paste, settle=settle)
+        expected = original
+        started = time.perf_counter()
+        paste_time = []
+        for index, text in enumerate(messages):
+            t0 = time.perf_counter()
+            transactions.paste(text)
+            paste_time.append(time.perf_counter() - t0)
+            if index == user_copy_at:
+                time.sleep(settle)
+                expected = "用户新复制的内容"
+                clipboard.write(expected)
+        elapsed = time.perf_counter() - started
+        time.sleep(transactions.idle + 0.1)
+        clipboard.settle()
+
+        passed = (clipboard.pasted == messages and clipboard.content == expected
+                  and clipboard.early_writes == 0)
+        ok = ok and passed
+        print(f"{label:20} {'OK  ' if passed else 'FAIL'} {len(clipboard.pasted)}/{len(messages)} pasted "
+              f"in order: {clipboard.pasted == messages}, clipboard restored: "
+              f"{clipboard.content == expected}, early writes {clipboard.early_writes}, "
+              f"restores {transactions.restores}, {elapsed:.2f} s")
+        print(f"  paste call         {format_ms(paste_time)}")
+    return ok
+
+
+async def run_clients(port: int, args) -> list:
+    phones = [SimulatedPhone(i, port, args) for i in range(args.clients)]
+    deadline = time.monotonic() + args.duration
+    await asyncio.gather(*(phone.run(deadline) for phone in phones))
+    return phones
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Voicing WebSocket load benchmark")
+    parser.add_argument("--clients", type=int, default=4, help="simulated phones")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of traffic")
+    parser.add_argument("--backend", default="null", choices=["null", "memory"],
+                        help="injection backend used by the server")
+    parser.add_argument("--batch-window", type=float, default=voice_coding.TEXT_BATCH_WINDOW * 1000,
+                        metavar="MS", help="server text batching window")
+    parser.add_argument("--protocol", type=int, default=1, choices=[1, 2],
+                        help="1: JSON with per-message acks, 2: sequenced with cumulative acks")
+    parser.add_argument("--binary", action="store_true",
+                        help="use protocol v2 binary text frames")
+    parser.add_argument("--compress-min-size", type=int, default=voice_coding.COMPRESSION_MIN_SIZE,
+                        metavar="BYTES", help="server deflate threshold (-1 disables)")
+    parser.add_argument("--manual-ratio", type=float, default=0.05,
+                        help="fraction of long manual sends")
+    parser.add_argument("--pace", type=float, default=1.0,
+                        help="scale think times (smaller is more aggressive)")
+    parser.add_argument("--ping-interval", type=float, default=0.5, help="seconds between pings")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--clipboard-stress", type=int, metavar="N",
+                        help="paste N messages through a fake clipboard instead of the WebSocket benchmark")
+    parser.add_argument("--clipboard-delay", type=float, metavar="MS",
+                        default=voice_coding.CLIPBOARD_SETTLE_DELAY * 1000,
+                        help="clipboard settle delay for --clipboard-stress")
+    args = parser.parse_args()
+
+    if args.clipboard_stress:
+        sys.exit(0 if run_clipboard_stress(args) else 1)
+
+    port = find_free_port()
+    server = ServerHarness(port, args.backend, max(0.0, args.batch_window / 1000),
+                           args.compress_min_size)
+    server.start()
+    started = time.perf_counter()
+    try:
+        phones = asyncio.run(run_clients(port, args))
+    finally:
+        elapsed = time.perf_counter() - started
+        server.stop()
+
+    acks = sorted(s for phone in phones for s in phone.ack_latency)
+    queued = sorted(s for phone in phones for s in phone.queue_latency)
+    injected = sorted(s for phone in phones for s in phone.inject_latency)
+    pongs = sorted(s for phone in phones for s in phone.pong_latency)
+    lag = sorted(server.loop_lag)
+    sent = sum(phone.sent_texts for phone in phones)
+    sent_bytes = sum(phone.sent_bytes for phone in phones)
+
+    if args.json:
+        print(json.dumps({
+            "clients": args.clients,
+            "protocol": args.protocol,
+            "binary": args.binary,
+            "elapsed_s": round(elapsed, 3),
+            "messages": sent,
+            "messages_per_s": round(sent / elapsed, 1),
+            "bytes": sent_bytes,
+            "acks": len(acks),
+            "ack_ms": {p: round(percentile(acks, p) * 1000, 3) for p in (50, 95, 99)},
+            # Binary acks carry no server timing / 二进制 ack 不含服务器端耗时
+            "server_queue_ms": ({p: round(percentile(queued, p) * 1000, 3) for p in (50, 95, 99)}
+                                if queued else None),
+            "server_inject_ms": ({p: round(percentile(injected, p) * 1000, 3) for p in (50, 95, 99)}
+                                 if injected else None),
+            "pong_ms": {p: round(percentile(pongs, p) * 1000, 3) for p in (50, 95, 99)},
+            "loop_lag_ms": {p: round(percentile(lag, p) * 1000, 3) for p in (50, 95, 99)},
+        }))
+        return
+
+    print(f"clients        {args.clients}  ({args.backend} backend, "
+          f"batch window {args.batch_window:g} ms, protocol v{args.protocol}"
+          f"{' binary' if args.binary else ''}, deflate >= {args.compress_min_size} B)")
+    print(f"elapsed        {elapsed:.2f} s")
+    print(f"messages       {sent} sent, {len(acks)} acked, {sent / elapsed:.1f} msg/s, "
+          f"{sent_bytes / elapsed / 1024:.1f} KiB/s")
+    print(f"ack latency    {format_ms(acks)}")
+    print(f"  server queue {format_ms(queued)}")
+    print(f"  server paste {format_ms(injected)}")
+    print(f"pong latency   {format_ms(pongs)}")
+    print(f"loop lag       {format_ms(lag)}")
+    if len(acks) != sent:
+        print(f"WARNING: {sent - len(acks)} messages were never acked", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,401 @@
+"""
+Voicing - Session Replay
+语音编程 - 会话回放工具
+
+Replays a recording made with `voice_coding.py --record FILE` against the
+real server (`start_server` / `handle_client`) running in-process with the
+memory injection backend, at the recorded pace (`--speed 1`), N times
+faster (`--speed N`) or as fast as the server answers (`--speed 0`).
+
+Reports reply latency next to the latency in the recording, and whether
+the typed text and the replies diverge from the recording. Text rules are
+applied before recording, so pass the same `--rules` file the recorded
+server used.
+
+Usage / 用法:
+    cd pc
+    python voice_coding.py --headless --record session.vcrec
+    python replay.py session.vcrec --speed 4
+"""
+
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import time
+from collections import deque
+from pathlib import Path
+
+import websockets
+
+import voice_coding
+from voice_coding import state
+from benchmark import ServerHarness, find_free_port, format_ms
+
+# Reply fields that differ between runs / 每次运行都会不同的回复字段
+VOLATILE_FIELDS = ("timing", "resume_token", "expires_in", "computer_name")
+SETTLE_TIMEOUT = 5.0  # 最后一帧之后等待回复的时间（秒）
+
+
+def parse_json(frame) -> dict:
+    """JSON object in a text frame, or None / 解析文本帧中的 JSON 对象"""
+    if isinstance(frame, bytes):
+        return None
+    try:
+        data = json.loads(frame)
+    except json.JSONDecodeError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def request_key(frame):
+    """Key of the reply a phone frame waits for, or None / 手机帧等待的回复"""
+    if isinstance(frame, bytes):
+        decoded = voice_coding.decode_binary_text(frame)
+        return None if decoded is None else ("seq", decoded[0])
+    data = parse_json(frame)
+    if data is None:
+        return None
+    kind = data.get("type")
+    if kind == "ping":
+        return ("pong", None)
+    if kind in ("hello", "resume"):
+        return ("session", None)
+    if kind == "replace":
+        return ("rev", data.get("rev"))
+    seq = data.get("seq")
+    if kind == "text" and isinstance(seq, int) and not isinstance(seq, bool):
+        return ("seq", seq)
+    if data.get("id") is not None:
+        return ("id", json.dumps(data["id"]))
+    return None
+
+
+def reply_keys(frame) -> list:
+    """Requests a server frame answers / 服务器帧所回复的请求"""
+    if isinstance(frame, bytes):
+        if len(frame) >= 5 and frame[0] == voice_coding.BIN_ACK:
+            return [("seq", struct.unpack_from(">I", frame, 1)[0])]
+        return []
+    data = parse_json(frame)
+    if data is None:
+        return []
+    kind = data.get("type")
+    keys = []
+    if kind == "pong":
+        keys.append(("pong", None))
+    elif kind == "session":
+        keys.append(("session", None))
+    elif kind == "replace":
+        keys.append(("rev", data.get("rev")))
+    if kind == "ack" and isinstance(data.get("seq"), int):
+        keys.append(("seq", data["seq"]))
+    ids = list(data.get("ids") or ())
+    if data.get("id") is not None:
+        ids.append(data["id"])
+    keys.extend(("id", json.dumps(msg_id)) for msg_id in ids)
+    return keys
+
+
+class LatencyTracker:
+    """
+    Time from a phone frame to the server frame answering it.
+    从手机帧发出到服务器回复的时间。
+    """
+
+    def __init__(self):
+        self.samples = []
+        self._waiting = {}  # key -> 发送时间队列
+        self._seqs = {}     # seq -> 发送时间，累计确认
+
+    def sent(self, frame, at: float):
+        key = request_key(frame)
+        if key is None:
+            return
+        if key[0] == "seq":
+            self._seqs.setdefault(key[1], at)
+        else:
+            self._waiting.setdefault(key, deque()).append(at)
+
+    def received(self, frame, at: float):
+        for key in reply_keys(frame):
+            if key[0] == "seq":
+                # Cumulative ack / 累计确认
+                for seq in [seq for seq in self._seqs if seq <= key[1]]:
+                    self.samples.append(at - self._seqs.pop(seq))
+                continue
+            times = self._waiting.get(key)
+            if times:
+                self.samples.append(at - times.popleft())
+                if not times:
+                    del self._waiting[key]
+
+    @property
+    def pending(self) -> int:
+        return len(self._seqs) + sum(len(times) for times in self._waiting.values())
+
+
+class RecordedConnection:
+    """One connection from the recording / 录制中的一个连接"""
+
+    def __init__(self, index: int, address: str, opened_at: float):
+        self.index = index
+        self.address = address
+        self.opened_at = opened_at
+        self.closed_at = None
+        self.inbound = []   # (回放时刻, 录制时间戳, 帧)
+        self.outbound = []  # (回放时刻, 录制时间戳, 帧)
+
+    def latency(self) -> list:
+        """Reply latency as recorded / 录制时的回复延迟"""
+        tracker = LatencyTracker()
+        frames = sorted([(ts, 0, frame) for _, ts, frame in self.inbound]
+                        + [(ts, 1, frame) for _, ts, frame in self.outbound],
+                        key=lambda item: item[:2])
+        for ts, direction, frame in frames:
+            if direction == 0:
+                tracker.sent(frame, ts)
+            else:
+                tracker.received(frame, ts)
+        return tracker.samples
+
+
+def load_recording(path: Path, max_gap: float):
+    """
+    Split a recording into connections and the expected text.
+    将录制拆分为各个连接和预期输入的文本。
+
+    Pauses longer than `max_gap` seconds (idle time, or the gap between two
+    server runs appended to one file) are shortened to `max_gap`.
+    """
+    connections = []
+    live = {}
+    expected = voice_coding.VirtualTextField()
+    clock = 0.0
+    last = None
+    for direction, conn, timestamp, payload in voice_coding.read_recording(path):
+        if last is not None:
+            clock += min(max(timestamp - last, 0.0), max_gap)
+        last = timestamp
+        if direction == voice_coding.REC_OPEN:
+            live[conn] = RecordedConnection(len(connections), payload, clock)
+            connections.append(live[conn])
+        elif direction == voice_coding.REC_INJECT:
+            expected.inject(payload)
+        elif direction == voice_coding.REC_KEYS:
+            if payload:
+                expected.press_keys(tuple(payload.split("\n")))
+        elif conn in live:
+            connection = live[conn]
+            if direction == voice_coding.REC_IN:
+                connection.inbound.append((clock, timestamp, payload))
+            elif direction == voice_coding.REC_OUT:
+                connection.outbound.append((clock, timestamp, payload))
+            elif direction == voice_coding.REC_CLOSE:
+                connection.closed_at = clock
+                del live[conn]
+    return connections, expected.text
+
+
+async def wait_until(start: float, offset: float, speed: float):
+    """Sleep until `offset` recorded seconds after start / 等待到录制中的时刻"""
+    if speed <= 0:
+        return
+    delay = start + offset / speed - time.perf_counter()
+    if delay > 0:
+        await asyncio.sleep(delay)
+
+
+class ReplayedConnection:
+    """
+    Send one recorded connection's frames to the server.
+    向服务器重放一个录制连接的帧。
+
+    Resume tokens differ from run to run: tokens the server handed out in
+    the recording are mapped to the ones handed out now, and `resume`
+    frames are rewritten to use them.
+    """
+
+    def __init__(self, recorded: RecordedConnection, url: str, tokens: dict):
+        self.recorded = recorded
+        self.url = url
+        self.tokens = tokens
+        self.replies = []
+        self.tracker = LatencyTracker()
+        self.welcomed = asyncio.Event()
+        self._recorded_tokens = deque(
+            data["resume_token"] for data in map(parse_json, (f for _, _, f in recorded.outbound))
+            if data is not None and "resume_token" in data
+        )
+
+    async def run(self, start: float, speed: float, previous: "ReplayedConnection"):
+        await wait_until(start, self.recorded.opened_at, speed)
+        if previous is not None:
+            # Keep connection order, so resumes find their session / 保持连接顺序
+            await previous.welcomed.wait()
+        async with websockets.connect(self.url, max_size=None) as ws:
+            reader = asyncio.create_task(self._read(ws))
+            try:
+                await asyncio.wait_for(self.welcomed.wait(), SETTLE_TIMEOUT)
+                for offset, _, frame in self.recorded.inbound:
+                    await wait_until(start, offset, speed)
+                    frame = self._rewrite(frame)
+                    self.tracker.sent(frame, time.perf_counter())
+                    await ws.send(frame)
+                if self.recorded.closed_at is not None:
+                    await wait_until(start, self.recorded.closed_at, speed)
+                deadline = time.monotonic() + SETTLE_TIMEOUT
+                while self.tracker.pending and time.monotonic() < deadline:
+                    await asyncio.sleep(0.01)
+            finally:
+                self.welcomed.set()
+                reader.cancel()
+
+    def _rewrite(self, frame):
+        data = parse_json(frame)
+        if data is None or data.get("type") != "resume" or data.get("token") not in self.tokens:
+            return frame
+        data["token"] = self.tokens[data["token"]]
+        return json.dumps(data)
+
+    async def _read(self, ws):
+        async for message in ws:
+            self.tracker.received(message, time.perf_counter())
+            self.replies.append(message)
+            data = parse_json(message)
+            if data is not None and "resume_token" in data and self._recorded_tokens:
+                self.tokens[self._recorded_tokens.popleft()] = data["resume_token"]
+            self.welcomed.set()
+
+
+def reply_summary(frames) -> tuple:
+    """
+    Replies reduced to what should not depend on timing.
+    只保留与时间无关的回复内容。
+
+    Acks are merged differently at different speeds, so only the acked ids
+    and the highest acked seq are compared; other frames are compared
+    without their run-specific fields.
+    """
+    others = []
+    acked_ids = set()
+    acked_seq = 0
+    for frame in frames:
+        data = parse_json(frame)
+        if isinstance(frame, bytes) or (data is not None and data.get("type") == "ack"):
+            for kind, value in reply_keys(frame):
+                if kind == "seq":
+                    acked_seq = max(acked_seq, value)
+                elif kind == "id":
+                    acked_ids.add(value)
+            continue
+        if data is None:
+            others.append(frame)
+            continue
+        for field in VOLATILE_FIELDS:
+            data.pop(field, None)
+        others.append(json.dumps(data, sort_keys=True, ensure_ascii=False))
+    return others, acked_ids, acked_seq
+
+
+def first_difference(a: str, b: str) -> int:
+    """Index of the first differing character / 第一个不同字符的位置"""
+    index = voice_coding.common_prefix_length(a, b)
+    return -1 if index == len(a) == len(b) else index
+
+
+async def replay(connections: list, port: int, speed: float) -> list:
+    url = f"ws://127.0.0.1:{port}"
+    tokens = {}
+    replayed = [ReplayedConnection(connection, url, tokens) for connection in connections]
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        connection.run(start, speed, replayed[index - 1] if index else None)
+        for index, connection in enumerate(replayed)
+    ))
+    # Frames without a reply may still be queued / 没有回复的帧可能仍在排队
+    deadline = time.monotonic() + SETTLE_TIMEOUT
+    while state.injector.queue_depth() and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(state.batch_window + 0.1)
+    return replayed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a Voicing session recording")
+    parser.add_argument("recording", type=Path, help="file written by voice_coding.py --record")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="1: recorded pace, N: N times faster, 0: as fast as possible")
+    parser.add_argument("--max-gap", type=float, default=5.0, metavar="SECONDS",
+                        help="shorten pauses longer than this")
+    parser.add_argument("--rules", type=Path, metavar="FILE",
+                        help="text rules used by the recorded server")
+    parser.add_argument("--batch-window", type=float, default=voice_coding.TEXT_BATCH_WINDOW * 1000,
+                        metavar="MS", help="server text batching window")
+    args = parser.parse_args()
+
+    try:
+        connections, expected = load_recording(args.recording, args.max_gap)
+    except (OSError, ValueError) as e:
+        print(f"cannot read recording: {e}", file=sys.stderr)
+        sys.exit(2)
+    if args.rules is not None:
+        state.rules = voice_coding.TextRules(args.rules)
+
+    port = find_free_port()
+    server = ServerHarness(port, "memory", max(0.0, args.batch_window / 1000),
+                           voice_coding.COMPRESSION_MIN_SIZE)
+    server.start()
+    started = time.perf_counter()
+    try:
+        replayed = asyncio.run(replay(connections, port, args.speed))
+        typed = state.injection_backend.text
+    finally:
+        elapsed = time.perf_counter() - started
+        server.stop()
+
+    frames_in = sum(len(connection.inbound) for connection in connections)
+    frames_out = sum(len(connection.outbound) for connection in connections)
+    duration = max((frame[0] for connection in connections
+                    for frame in connection.inbound + connection.outbound), default=0.0)
+    print(f"recording      {args.recording}: {len(connections)} connections, "
+          f"{frames_in} frames in, {frames_out} out, {duration:.2f} s")
+    print(f"replay         {'max speed' if args.speed <= 0 else f'{args.speed:g}x'}, "
+          f"{elapsed:.2f} s, loop lag {format_ms(server.loop_lag)}")
+    print(f"recorded       {format_ms([s for c in connections for s in c.latency()])}")
+    print(f"replayed       {format_ms([s for c in replayed for s in c.tracker.samples])}")
+
+    diverged = False
+    index = first_difference(expected, typed)
+    if index < 0:
+        print(f"output         identical ({len(expected)} chars)")
+    else:
+        diverged = True
+        print(f"output         DIVERGED at char {index}: recorded {expected[index:index + 20]!r}, "
+              f"replayed {typed[index:index + 20]!r}")
+
+    differing = [
+        (connection, recorded, now)
+        for connection in replayed
+        for recorded, now in [(reply_summary(f for _, _, f in connection.recorded.outbound),
+                               reply_summary(connection.replies))]
+        if recorded != now
+    ]
+    if not differing:
+        print(f"replies        identical ({len(replayed)} connections)")
+    else:
+        diverged = True
+        connection, recorded, now = differing[0]
+        print(f"replies        DIVERGED in {len(differing)} of {len(replayed)} connections, "
+              f"first #{connection.recorded.index} ({connection.recorded.address})")
+        for label, (others, acked_ids, acked_seq) in (("recorded", recorded), ("replayed", now)):
+            print(f"  {label:12} {len(others)} frames, {len(acked_ids)} acked ids, acked seq {acked_seq}")
+        mismatch = next((pair for pair in zip(recorded[0], now[0]) if pair[0] != pair[1]), None)
+        if mismatch is not None:
+            print(f"  first change {mismatch[0]}\n               {mismatch[1]}")
+    sys.exit(1 if diverged else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,603 @@
+"""
+Voicing - Tray UI
+语音编程 - 托盘界面
+
+PyQt5 tray icon and menu, imported by voice_coding.run_tray() only after the
+WebSocket server and UDP discovery are up, so Qt stays off the cold start
+path. Pillow is only needed when the icon atlas has to be rebuilt.
+PyQt5 托盘图标与菜单。服务器和 UDP 发现启动后才由 voice_coding.run_tray()
+导入，Qt 不占用冷启动时间；只有重建图标图集时才需要 Pillow。
+"""
+
+import hashlib
+import io
+import logging
+import os
+import subprocess
+import sys
+from pathlib import Path
+from typing import Optional
+
+from PyQt5.QtWidgets import (
+    QApplication, QSystemTrayIcon, QWidget, QVBoxLayout, QHBoxLayout,
+    QLabel, QGraphicsDropShadowEffect
+)
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QIcon, QPixmap, QPainter, QColor, QCursor
+
+from voice_coding import (
+    state, startup, add_state_listener, server_url, set_sync_enabled, is_startup_enabled, set_startup_enabled
+)
+
+
+# ============================================================
+# Icon Atlas / 图标图集
+# ============================================================
+# All tray states pre-rendered at several sizes into one PNG sheet, cached
+# on disk and keyed by the source icon hash and the screen scale. Rows are
+# states, columns are sizes; every cell is `size * scale` pixels square.
+# 所有托盘状态按多个尺寸预渲染到一张 PNG 图集，按源图标哈希和屏幕缩放缓存
+ICON_ATLAS_VERSION = 1       # 渲染逻辑变化时递增，使旧图集失效
+ICON_STATES = ("normal", "dim", "paused")
+ICON_SIZES = (16, 20, 24, 32, 40, 48, 64, 256)  # 逻辑像素
+ICON_BG_COLOR = (26, 26, 46, 255)  # #1A1A2E
+ICON_DIM_ALPHA = 0.4         # 闪烁暗淡状态的不透明度
+BLINK_INTERVAL_MS = 500      # 等待连接时的闪烁间隔
+
+
+def get_icon_cache_dir() -> Path:
+    """图标缓存目录（与日志目录同级）"""
+    return Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / 'cache'
+
+
+def get_screen_scale() -> float:
+    """主屏幕缩放比例（96 DPI = 1.0），取 0.25 的整数倍"""
+    screen = QApplication.primaryScreen()
+    if screen is None:
+        return 1.0
+    scale = max(screen.logicalDotsPerInch() / 96.0, screen.devicePixelRatio())
+    return max(1.0, round(scale * 4) / 4)
+
+
+def icon_atlas_path(scale: float) -> Path:
+    """图集文件路径：源图标内容哈希 + 缩放比例"""
+    digest = hashlib.sha1(f"v{ICON_ATLAS_VERSION}".encode())
+    try:
+        with open(get_base_icon_path(), 'rb') as f:
+            digest.update(f.read())
+    except OSError:
+        pass  # 源图标缺失时使用备用图标，同样可以缓存
+    return get_icon_cache_dir() / f"tray_{digest.hexdigest()[:16]}_{int(scale * 100)}.png"
+
+
+def render_icon_state(size: int) -> dict:
+    """渲染单个尺寸的所有状态（PIL Image）"""
+    from PIL import Image, ImageDraw
+
+    # 生成基础圆形图标
+    base = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+    ImageDraw.Draw(base).ellipse([0, 0, size-1, size-1], fill=ICON_BG_COLOR)
+    base = Image.alpha_composite(base, load_base_icon(size))
+    mask = Image.new('L', (size, size), 0)
+    ImageDraw.Draw(mask).ellipse([0, 0, size-1, size-1], fill=255)
+    base.putalpha(mask)
+
+    # 暗淡状态（闪烁用）
+    dim = base.copy()
+    dim.putalpha(mask.point(lambda x: int(x * ICON_DIM_ALPHA)))
+
+    # 灰度状态（暂停用）
+    gray = base.convert('L')
+    paused = Image.merge('RGBA', (gray, gray, gray, mask))
+
+    return {'normal': base, 'dim': dim, 'paused': paused}
+
+
+def render_icon_atlas(pixel_sizes) -> bytes:
+    """渲染图集并返回 PNG 数据"""
+    from PIL import Image
+
+    cell = max(pixel_sizes)
+    sheet = Image.new('RGBA', (sum(pixel_sizes), cell * len(ICON_STATES)), (0, 0, 0, 0))
+    x = 0
+    for size in pixel_sizes:
+        rendered = render_icon_state(size)
+        for row, name in enumerate(ICON_STATES):
+            sheet.paste(rendered[name], (x, row * cell))
+        x += size
+    byte_data = io.BytesIO()
+    sheet.save(byte_data, format='PNG')
+    return byte_data.getvalue()
+
+
+def save_icon_atlas(path: Path, data: bytes):
+    """原子写入图集并删除旧版本图集"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    for stale in path.parent.glob('tray_*.png'):
+        if stale != path:
+            try:
+                stale.unlink()
+            except OSError:
+                pass
+
+
+def load_icon_atlas(scale: Optional[float] = None) -> dict:
+    """
+    加载图集并切分为各状态的多尺寸 QIcon
+
+    命中缓存时只解码一张 PNG，不导入 Pillow；未命中时渲染并写入缓存。
+    """
+    if scale is None:
+        scale = get_screen_scale()
+    pixel_sizes = [round(size * scale) for size in ICON_SIZES]
+    path = icon_atlas_path(scale)
+
+    sheet = QPixmap(str(path)) if path.exists() else QPixmap()
+    if sheet.isNull() or sheet.width() != sum(pixel_sizes):
+        data = render_icon_atlas(pixel_sizes)
+        try:
+            save_icon_atlas(path, data)
+            logging.info(f"图标图集已生成: {path}")
+        except OSError as e:
+            logging.warning(f"无法写入图标图集 {path}: {e}")
+        sheet = QPixmap()
+        sheet.loadFromData(data)
+
+    cell = max(pixel_sizes)
+    icons = {}
+    for row, name in enumerate(ICON_STATES):
+        icon = QIcon()
+        x = 0
+        for size in pixel_sizes:
+            icon.addPixmap(sheet.copy(x, row * cell, size, size))
+            x += size
+        icons[name] = icon
+    return icons
+
+
+# ============================================================
+# PyQt5 Modern Tray Menu / PyQt5 现代托盘菜单
+# ============================================================
+
+class MenuItemWidget(QWidget):
+    """单个菜单项 - Windows 11 Fluent Design 风格"""
+
+    clicked = pyqtSignal()
+
+    def __init__(self, icon_text, text, has_toggle=False, is_checked=False, parent=None):
+        super().__init__(parent)
+        self.has_toggle = has_toggle
+        self.is_checked = is_checked
+        self._hovered = False
+        self.setFixedHeight(36)  # Windows 11 标准高度
+        self.setMouseTracking(True)
+        self.setCursor(Qt.PointingHandCursor)
+
+        self.setup_ui(icon_text, text, has_toggle, is_checked)
+
+    def setup_ui(self, icon_text, text, has_toggle, is_checked):
+        """设置 UI"""
+        layout = QHBoxLayout(self)
+        layout.setContentsMargins(12, 0, 12, 0)  # 更宽的水平内边距
+        layout.setSpacing(10)
+
+        # 图标 - 使用白色
+        self.icon_label = QLabel(icon_text)
+        self.icon_label.setFixedWidth(20)
+        self.icon_label.setStyleSheet("font-size: 14px; background: transparent; color: #FFFFFF;")
+        self.icon_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+        # 文字 - 使用 Segoe UI 字体（Windows 11 默认字体）
+        self.text_label = QLabel(text)
+        self.text_label.setStyleSheet("""
+            QLabel {
+                color: #FFFFFF;
+                font-family: 'Segoe UI', 'Microsoft YaHei UI', sans-serif;
+                font-size: 13px;
+                font-weight: 400;
+                background: transparent;
+            }
+        """)
+        self.text_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
+        self.text_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+
+        layout.addWidget(self.icon_label)
+        layout.addWidget(self.text_label)
+        layout.addStretch()
+
+        # 开关项 - 显示简洁的状态
+        if has_toggle:
+            self.status_label = QLabel()
+            self.status_label.setFixedWidth(24)
+            self.status_label.setAttribute(Qt.WA_TransparentForMouseEvents)
+            self.update_toggle_status(is_checked)
+            layout.addWidget(self.status_label)
+
+    def paintEvent(self, event):
+        """自定义绘制背景 - Windows 11 风格"""
+        painter = QPainter(self)
+        painter.setRenderHint(QPainter.Antialiasing)
+
+        # 绘制圆角矩形背景
+        rect = self.rect().adjusted(4, 2, -4, -2)  # 内缩，留出边距
+
+        if self._hovered:
+            # 悬停状态 - 使用更亮的高亮色
+            painter.setBrush(QColor(255, 255, 255, 15))  # 白色 6% 透明度
+        else:
+            painter.setBrush(Qt.transparent)
+
+        painter.setPen(Qt.NoPen)
+        painter.drawRoundedRect(rect, 4, 4)  # 4px 圆角
+
+    def enterEvent(self, event):
+        """鼠标进入 - 显示高亮"""
+        self._hovered = True
+        self.update()
+        super().enterEvent(event)
+
+    def leaveEvent(self, event):
+        """鼠标离开 - 恢复正常"""
+        self._hovered = False
+        self.update()
+        super().leaveEvent(event)
+
+    def update_toggle_status(self, checked):
+        """更新开关状态 - 使用现代化的开关指示器"""
+        self.is_checked = checked
+        if checked:
+            self.status_label.setText("✓")
+            self.status_label.setStyleSheet("""
+                QLabel {
+                    color: #60CDFF;
+                    font-family: 'Segoe UI', 'Microsoft YaHei UI', sans-serif;
+                    font-size: 14px;
+                    font-weight: bold;
+                    background: transparent;
+                }
+            """)
+        else:
+            self.status_label.setText("")
+            self.status_label.setStyleSheet("background: transparent;")
+
+    def mousePressEvent(self, event):
+        """鼠标点击事件"""
+        self.clicked.emit()
+        super().mousePressEvent(event)
+
+
+class ModernMenuWidget(QWidget):
+    """Windows 11 Fluent Design 风格的自定义菜单窗口"""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowFlags(Qt.FramelessWindowHint | Qt.Popup | Qt.NoDropShadowWindowHint)
+        self.setAttribute(Qt.WA_TranslucentBackground)
+
+        # 动画相关
+        self.animation_step = 0
+        self.animation_max_steps = 10  # 约 160ms - 更快更流畅
+        self.animation_timer = QTimer()
+        self.animation_timer.timeout.connect(self.update_animation)
+
+        self.setup_ui()
+
+    def setup_ui(self):
+        """设置 UI - Windows 11 Fluent Design"""
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(8, 8, 8, 8)  # 阴影边距
+        layout.setSpacing(0)
+
+        # 主容器 - 使用深色半透明背景
+        self.container = QWidget()
+        self.container.setObjectName("menuContainer")
+        self.container.setStyleSheet("""
+            #menuContainer {
+                background-color: rgba(32, 32, 32, 245);
+                border: 1px solid rgba(255, 255, 255, 0.08);
+                border-radius: 8px;
+            }
+        """)
+        container_layout = QVBoxLayout(self.container)
+        container_layout.setContentsMargins(4, 6, 4, 6)  # 内边距
+        container_layout.setSpacing(2)  # 项间距
+
+        # 同步输入
+        self.sync_btn = MenuItemWidget("📡", "同步输入", has_toggle=True, is_checked=True)
+        self.sync_btn.clicked.connect(self.toggle_sync)
+        container_layout.addWidget(self.sync_btn)
+
+        # 开机自启
+        self.startup_btn = MenuItemWidget("🚀", "开机自启", has_toggle=True, is_checked=False)
+        self.startup_btn.clicked.connect(self.toggle_startup)
+        container_layout.addWidget(self.startup_btn)
+
+        # 分隔线
+        separator1 = QWidget()
+        separator1.setFixedHeight(1)
+        separator1.setStyleSheet("background-color: rgba(255, 255, 255, 0.08); margin: 4px 8px;")
+        container_layout.addWidget(separator1)
+
+        # 打开日志
+        log_btn = MenuItemWidget("📋", "打开日志")
+        log_btn.clicked.connect(self.open_log)
+        container_layout.addWidget(log_btn)
+
+        # 分隔线
+        separator2 = QWidget()
+        separator2.setFixedHeight(1)
+        separator2.setStyleSheet("background-color: rgba(255, 255, 255, 0.08); margin: 4px 8px;")
+        container_layout.addWidget(separator2)
+
+        # 退出应用
+        quit_btn = MenuItemWidget("🚪", "退出应用")
+        quit_btn.clicked.connect(self.quit_app)
+        container_layout.addWidget(quit_btn)
+
+        layout.addWidget(self.container)
+
+        # 设置阴影
+        self.set_shadow_effect()
+
+        # 更新初始状态
+        QTimer.singleShot(0, self.update_state)
+
+    def set_shadow_effect(self):
+        """设置阴影效果 - Windows 11 风格的柔和阴影"""
+        shadow = QGraphicsDropShadowEffect()
+        shadow.setBlurRadius(24)
+        shadow.setColor(QColor(0, 0, 0, 100))
+        shadow.setOffset(0, 4)
+        self.container.setGraphicsEffect(shadow)
+
+    def show_at_position(self, tray_pos):
+        """在指定位置显示菜单（菜单左下角对齐鼠标点击位置）"""
+        # 获取菜单尺寸
+        self.adjustSize()
+        menu_height = self.height()
+
+        # 菜单左下角对齐鼠标点击位置
+        x = tray_pos.x() - 8  # 向左偏移一点，让菜单边缘靠近鼠标
+        y = tray_pos.y() - menu_height  # 菜单底部对齐鼠标位置
+
+        self.target_y = y
+        self.move(x, y)
+
+        # 从下往上滑出的动画
+        self.animation_step = 0
+        self.move(x, y + 16)  # 从下方开始
+        self.setWindowOpacity(0.0)
+        self.show()
+        self.animation_timer.start(16)  # 60fps
+
+    def update_animation(self):
+        """更新滑入动画"""
+        self.animation_step += 1
+
+        if self.animation_step >= self.animation_max_steps:
+            # 动画结束
+            self.animation_timer.stop()
+            self.move(self.pos().x(), self.target_y)
+            self.setWindowOpacity(1.0)
+        else:
+            # 缓动
+            progress = self.animation_step / self.animation_max_steps
+            eased = 1 - pow(1 - progress, 2)  # easeOutQuad
+
+            # 从下往上滑
+            current_y = self.target_y + 16 * (1 - eased)
+            self.move(self.pos().x(), int(current_y))
+
+            # 淡入
+            self.setWindowOpacity(min(1.0, eased * 1.5))
+
+    def update_state(self):
+        """更新菜单状态"""
+        self.sync_btn.update_toggle_status(state.sync_enabled)
+        self.startup_btn.update_toggle_status(is_startup_enabled())
+
+    def toggle_sync(self):
+        """切换同步状态"""
+        new_state = not self.sync_btn.is_checked
+        # 托盘图标通过 "sync" 事件更新，同步状态由服务器事件循环广播
+        set_sync_enabled(new_state)
+        self.sync_btn.update_toggle_status(new_state)
+        self.close_with_animation()
+
+    def toggle_startup(self):
+        """切换开机自启"""
+        new_state = not self.startup_btn.is_checked
+        set_startup_enabled(new_state)
+        self.startup_btn.update_toggle_status(new_state)
+        self.close_with_animation()
+
+    def open_log(self):
+        """打开日志文件"""
+        self.close_with_animation()
+        if state.log_file and state.log_file.exists():
+            # 用默认文本编辑器打开日志文件
+            subprocess.Popen(['notepad.exe', str(state.log_file)])
+        else:
+            # 打开日志目录
+            log_dir = Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / 'logs'
+            log_dir.mkdir(parents=True, exist_ok=True)
+            os.startfile(str(log_dir))
+
+    def quit_app(self):
+        """退出应用"""
+        state.running = False
+        QApplication.quit()
+
+    def close_with_animation(self):
+        """关闭动画"""
+        self.animation_timer.stop()
+        self.close()
+
+
+class ModernTrayIcon(QSystemTrayIcon):
+    """现代托盘图标（由状态事件驱动，不轮询）"""
+
+    # 状态事件 (event, data)：服务器 / 网络线程发出时由 Qt 排队到主线程执行
+    state_changed = pyqtSignal(str, object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # 预先缓存图标
+        with startup.phase("icon_cache"):
+            self._init_icon_cache()
+        # 预先创建菜单（避免首次打开慢）
+        self.menu_widget = ModernMenuWidget()
+        self._client_count = 0
+        self._icon_key = None  # 当前显示的图标，相同时不重复 setIcon
+        self._dim = False
+        # 闪烁定时器只在等待连接时运行
+        self.blink_timer = QTimer(self)
+        self.blink_timer.setInterval(BLINK_INTERVAL_MS)
+        self.blink_timer.timeout.connect(self.blink)
+        self.state_changed.connect(self.on_state_changed)
+        self.setup_icon()
+        self.setup_menu()
+        # 设置悬停提示
+        self.setToolTip(tray_tooltip())
+
+    def _init_icon_cache(self):
+        """从图标图集加载所有状态的图标"""
+        self._icon_cache = load_icon_atlas()
+
+    def setup_icon(self):
+        """设置初始图标"""
+        self.update_icon(None)
+
+    def setup_menu(self):
+        """设置菜单"""
+        # 不使用 QMenu，而是自定义菜单
+        self.activated.connect(self.on_tray_activated)
+
+    def on_tray_activated(self, reason):
+        """托盘图标激活事件"""
+        if reason == QSystemTrayIcon.Context:
+            # 只有右键点击才显示菜单
+            self.show_custom_menu()
+
+    def show_custom_menu(self):
+        """显示自定义菜单"""
+        # 更新状态
+        self.menu_widget.update_state()
+
+        # 获取托盘图标位置并显示菜单（带动画）
+        pos = QCursor.pos()
+        self.menu_widget.show_at_position(pos)
+
+    def on_state_changed(self, event, data):
+        """处理状态事件（Qt 主线程）"""
+        if event == "clients":
+            self._client_count = data["count"]
+        elif event == "address":
+            self.setToolTip(tray_tooltip())
+            return
+        self.refresh()
+
+    def refresh(self):
+        """根据同步开关和连接数切换图标，等待连接时才启动闪烁"""
+        waiting = state.sync_enabled and self._client_count == 0
+        if waiting:
+            if not self.blink_timer.isActive():
+                self._dim = False
+                self.blink_timer.start()
+        else:
+            self.blink_timer.stop()
+            self._dim = False
+        self.update_icon(None, dim=self._dim)
+
+    def blink(self):
+        """闪烁定时器：切换亮 / 暗"""
+        self._dim = not self._dim
+        self.update_icon(None, dim=self._dim)
+
+    def update_icon(self, status, dim=False):
+        """更新图标状态 - 使用缓存的图标，状态未变化时不调用 setIcon
+
+        Args:
+            status: 未使用，保留兼容
+            dim: 是否为暗淡状态（用于闪烁效果）
+        """
+        if not state.sync_enabled:
+            # 暂停状态
+            key = 'paused'
+        elif self._client_count == 0 and dim:
+            # 等待连接 + 暗淡状态
+            key = 'dim'
+        else:
+            # 正常状态（已连接或等待连接的亮状态）
+            key = 'normal'
+        if key != self._icon_key:
+            self._icon_key = key
+            self.setIcon(self._icon_cache[key])
+
+
+# ============================================================
+# System Tray / 系统托盘
+# ============================================================
+
+def get_base_icon_path() -> str:
+    """获取基础图标路径"""
+    if getattr(sys, 'frozen', False):
+        # 打包后的路径
+        base_path = sys._MEIPASS
+    else:
+        # 开发环境路径
+        base_path = os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(base_path, 'assets', 'icon_1024.png')
+
+
+def load_base_icon(size: int = 64) -> "Image.Image":
+    """加载并缩放基础图标"""
+    from PIL import Image, ImageDraw
+    icon_path = get_base_icon_path()
+    try:
+        icon = Image.open(icon_path)
+        icon = icon.convert('RGBA')
+        icon = icon.resize((size, size), Image.Resampling.LANCZOS)
+        return icon
+    except Exception as e:
+        logging.warning(f"无法加载图标 {icon_path}: {e}，使用备用图标")
+        # 备用图标：简单的圆形
+        fallback = Image.new('RGBA', (size, size), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(fallback)
+        draw.ellipse([4, 4, size-4, size-4], fill='#2196F3')
+        return fallback
+
+
+def run_tray():
+    """Run the system tray application with PyQt5 / 使用PyQt5运行系统托盘应用"""
+    # 创建 QApplication（如果不存在）
+    if QApplication.instance() is None:
+        app = QApplication(sys.argv)
+    else:
+        app = QApplication.instance()
+
+    app.setQuitOnLastWindowClosed(False)
+
+    # 创建现代托盘图标
+    with startup.phase("tray"):
+        tray_icon = ModernTrayIcon()
+        tray_icon.show()
+
+    # 保存到状态
+    state.tray_icon = tray_icon
+
+    # 状态事件转发到 Qt 主线程（跨线程 emit 自动排队），不再定时轮询
+    add_state_listener(tray_icon.state_changed.emit)
+    # 监听注册前已连接的客户端 / 补上注册前的连接数
+    tray_icon.state_changed.emit("clients", {"count": len(state.connected_clients)})
+
+    # 运行应用
+    app.exec()
+
+
+def tray_tooltip() -> str:
+    """托盘悬停提示：应用名 + 当前服务地址"""
+    return f"Voicing\n{server_url()}"
@@ -6,38 +6,52 @@ A system tray application that receives text from phone and types it at cursor p
 系统托盘应用，接收手机发送的文本并在光标处输入。
 """
 
+import time
+
+# Reference point of the cold start report / 冷启动计时起点
+_STARTUP_T0 = time.perf_counter()
+
+import argparse
 import asyncio
+import atexit
+import gzip
+import http
 import socket
+import struct
 import sys
 import os
 import threading
-import winreg
+import itertools
 import json
+import math
+import unicodedata
 import ctypes
+import ctypes.wintypes
 import logging
-import subprocess
-import time
-from datetime import datetime
+import logging.handlers
+import queue
+import shutil
+import secrets
+import select
+import signal
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache, partial
+from contextlib import contextmanager
 from typing import Optional
 from pathlib import Path
 
-# PyQt5 for modern tray menu
-from PyQt5.QtWidgets import (
-    QApplication, QSystemTrayIcon, QMenu, QAction,
-    QWidget, QVBoxLayout, QHBoxLayout, QLabel,
-    QPushButton, QStyle, QGraphicsDropShadowEffect
-)
-from PyQt5.QtCore import Qt, QTimer, QPoint, pyqtSignal
-from PyQt5.QtGui import QIcon, QPixmap, QPainter, QColor, QFont, QCursor, QPen, QBrush
-
 # Third-party imports
+# PyQt5/Pillow (tray_ui), pyautogui/pyperclip (injection) and winreg
+# (startup) are imported on first use to keep them off the cold start path
+# PyQt5/Pillow（tray_ui）、pyautogui/pyperclip（注入）和 winreg（开机启动）
+# 在首次使用时才导入，不占用冷启动时间
 import websockets
-from websockets.server import serve
-import pyautogui
-import pystray
-from pystray import MenuItem as item
-from PIL import Image, ImageDraw
-import pyperclip
+from websockets.server import serve, WebSocketServerProtocol
+from websockets.frames import CTRL_OPCODES, Opcode
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate, ServerPerMessageDeflateFactory
+)
 
 # ============================================================
 # Single Instance Check / 单实例检查
@@ -49,6 +63,11 @@ def check_single_instance() -> bool:
     Check if another instance is already running / 检查是否已有实例在运行
     Returns True if this is the only instance, False if another is running.
     """
+    if sys.platform != "win32":
+        # No named mutex; a second instance fails to bind the port instead
+        # 非 Windows 没有命名互斥锁，第二个实例会在绑定端口时失败
+        return True
+
     # Try to create a named mutex
     kernel32 = ctypes.windll.kernel32
     mutex = kernel32.CreateMutexW(None, False, MUTEX_NAME)
@@ -68,6 +87,9 @@ def check_single_instance() -> bool:
 
 def show_already_running_message():
     """Show message that app is already running / 显示程序已运行的提示"""
+    if state.headless:
+        print("Voicing is already running")
+        return
     ctypes.windll.user32.MessageBoxW(
         0,
         "Voicing 已经在运行中！\n\n请查看系统托盘图标。\n\nVoicing is already running!\nPlease check the system tray.",
@@ -82,12 +104,28 @@ def show_already_running_message():
 APP_NAME = "Voicing"
 APP_VERSION = "1.9.0"
 WS_PORT = 9527      # WebSocket port
+TEXT_BATCH_WINDOW = 0.03     # 文本合并窗口（秒），0 表示不合并
+TEXT_BATCH_MAX_CHARS = 4096  # 单次合并的最大字符数，超过立即输入
+LATENCY_WINDOW = 1024        # 延迟统计保留的最近样本数
+SEQ_REORDER_LIMIT = 64       # 每个会话最多缓存的乱序帧数
+SESSION_LIMIT = 64           # 最多保留的客户端会话数
+RESUME_TTL = 300             # 断开后会话可用 resume_token 恢复的时间（秒）
+RESUME_OUTBOX_LIMIT = 256    # 会话离线期间最多暂存、恢复后补发的帧数
+WS_PING_INTERVAL = 5.0       # 服务器心跳间隔（秒），热点频繁掉线时尽快发现失效连接
+WS_PING_TIMEOUT = 5.0        # 心跳超时（秒），超时即断开
+WS_CLOSE_TIMEOUT = 1.0       # 关闭握手最多等待（秒），失效连接不必等默认的 10 秒
+PROTOCOL_VERSION = 2         # 当前协议版本（1 = 纯 JSON 旧协议）
+COMPRESSION_MIN_SIZE = 256   # 小于此字节数的消息不压缩
+BROADCAST_SEND_TIMEOUT = 2.0 # 广播时单个客户端的发送超时（秒），超时即断开
+FLOOR_LEASE = 10.0           # 独占输入权的默认租期（秒）
+FLOOR_MAX_LEASE = 60.0       # 独占输入权的最长租期（秒）
+MAX_FRAME_SIZE = 2 ** 20     # 单个 WebSocket 消息的最大字节数
+STREAM_CHUNK_CHARS = 4096    # 长文本每次注入的最大字符数
+HISTORY_LIMIT = 32           # 每个客户端保留的最近注入条数（用于撤销）
+CLIPBOARD_SETTLE_DELAY = 0.1 # Ctrl+V 后留给目标程序读取剪贴板的时间（秒）
+CLIPBOARD_RESTORE_IDLE = 0.5 # 连续粘贴停止多久后恢复用户剪贴板（秒）
 STARTUP_REGISTRY_KEY = r"Software\Microsoft\Windows\CurrentVersion\Run"
-
-# Disable pyautogui failsafe (moving to corner won't stop it)
-pyautogui.FAILSAFE = False
-# Small pause between keystrokes for stability
-pyautogui.PAUSE = 0.01
+DEFAULT_INJECTION_BACKEND = "clipboard"  # 默认文本注入后端
 
 
 # ============================================================
@@ -102,42 +140,328 @@ class AppState:
         self.tray_icon = None
         self.ws_port = WS_PORT
         self.connected_clients = set()
-        self.blink_state = False  # For icon blinking / 图标闪烁状态
-        self.blink_timer: Optional[threading.Timer] = None
         self.log_file = None  # 日志文件路径
+        self.injector: Optional["InjectionWorker"] = None  # 文本注入工作线程
+        self.batch_window = TEXT_BATCH_WINDOW  # 文本合并窗口（秒）
+        self.clipboard_delay = CLIPBOARD_SETTLE_DELAY  # 剪贴板粘贴后的等待时间（秒）
+        self.injection_backend: Optional["InjectionBackend"] = None  # 文本注入后端，首次使用时创建
+        self.backend_name = DEFAULT_INJECTION_BACKEND  # --backend 选择的注入后端
+        self.latency: Optional["LatencyTracker"] = None  # 消息延迟统计
+        self.metrics: Optional["Metrics"] = None  # /metrics 计数器
+        self.sessions = {}  # client_id -> ClientSession，用于重连后去重
+        self.resume_sessions = {}  # resume_token -> ClientSession，用于断线恢复
+        self.ping_interval = WS_PING_INTERVAL  # 心跳间隔（秒），None 表示关闭
+        self.ping_timeout = WS_PING_TIMEOUT    # 心跳超时（秒）
+        self.compression_min_size = COMPRESSION_MIN_SIZE  # 负数表示关闭压缩
+        self.discovery_payload: Optional[bytes] = None  # UDP 发现消息
+        self.discovery: Optional["DiscoveryService"] = None  # UDP 发现服务
+        self.loop: Optional[asyncio.AbstractEventLoop] = None  # 服务器事件循环
+        self.max_frame_size = MAX_FRAME_SIZE  # 单个消息的最大字节数
+        self.log_level = logging.INFO
+        self.headless = False  # 无托盘模式，不导入 PyQt5 / Pillow
+        self.rules_path: Optional[Path] = None  # 文本规则文件，None 为默认位置
+        self.rules: Optional["TextRules"] = None  # 文本替换 / 按键规则
+        self.event_log = False  # 是否写入 JSON 事件日志
+        self.record_path: Optional[Path] = None  # 会话录制文件，None 表示不录制
+        self.recorder: Optional["SessionRecorder"] = None
+        self.listeners = []  # 状态变化回调 (event, data)
 
 state = AppState()
 
 
+def add_state_listener(callback):
+    """
+    Register a state change callback / 注册状态变化回调
+
+    Callbacks run on the thread that changed the state, so GUI code must
+    hand the event over to its own thread.
+    """
+    state.listeners.append(callback)
+
+
+def notify_state_listeners(event: str, **data):
+    """
+    Notify all state listeners / 通知所有状态监听者
+
+    Events: "clients" (count), "sync" (enabled), "address" (ip).
+    """
+    for callback in list(state.listeners):
+        try:
+            callback(event, data)
+        except Exception as e:
+            logging.error(f"状态回调失败 ({event}): {e}")
+
+
+def set_sync_enabled(enabled: bool):
+    """
+    Switch text sync on/off / 切换同步开关
+
+    Safe to call from any thread: listeners are notified and the new state
+    is pushed to every phone from the server loop.
+    """
+    state.sync_enabled = enabled
+    notify_state_listeners("sync", enabled=enabled)
+    call_in_server_loop(broadcast_sync_state())
+
+
 # ============================================================
 # Logging Setup / 日志配置
 # ============================================================
-def setup_logging():
-    """设置日志系统"""
+LOG_MAX_BYTES = 5 * 2 ** 20     # 单个日志文件上限，超过后轮转
+LOG_BACKUP_COUNT = 5            # 保留的轮转文件数（gzip 压缩）
+LOG_RETENTION_DAYS = 14         # 启动时删除超过天数的日志文件
+DEBUG_SAMPLE_EVERY = 50         # 带 sample 键的高频日志每 N 条保留 1 条
+
+# Per-message JSON records (--event-log) / 每条消息的 JSON 事件记录
+event_logger = logging.getLogger("voicing.events")
+event_logger.propagate = False
+
+
+def get_log_dir() -> Path:
+    """日志目录（用户数据目录）"""
+    return Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / 'logs'
+
+
+def compress_log(source: str, dest: str):
+    """gzip 压缩轮转出的日志文件（在日志监听线程中执行）"""
+    tmp = dest + ".tmp"
+    try:
+        with open(source, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.replace(tmp, dest)
+        os.remove(source)
+    except OSError as e:
+        logging.warning(f"日志压缩失败 {source}: {e}")
+
+
+def prune_logs(log_dir: Path, days: int, active=()):
+    """
+    删除超过保留天数的日志文件（包括旧版按日期命名的日志）
+
+    Files in `active` are being written and are never removed, however old
+    their mtime / 正在写入的日志文件不会被删除
+    """
+    cutoff = time.time() - days * 86400
+    active = {path.name for path in active}
+    for path in log_dir.iterdir():
+        if not path.name.startswith(("voice_coding", "events")) or path.name in active:
+            continue
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+        except OSError:
+            pass
+
+
+class CompressingRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Size-rotated log file whose backups are gzipped.
+    按大小轮转的日志文件，备份文件 gzip 压缩。
+
+    Backups are named `<file>.1.gz` ... `<file>.N.gz`. Only used behind a
+    QueueListener, so rotation and compression run on the listener thread,
+    never on the thread that logged.
+    """
+
+    def __init__(self, filename, max_bytes: int = LOG_MAX_BYTES, backup_count: int = LOG_BACKUP_COUNT):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self.namer = lambda name: name + ".gz"
+        self.rotator = compress_log
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keep 1 in `every` records that carry the same `sample` key.
+    同一 sample 键的日志每 every 条只保留 1 条。
+
+    Used for per-packet debug lines, e.g.
+    `logging.debug("...", extra={"sample": "udp_broadcast"})`.
+    """
+
+    def __init__(self, every: int = DEBUG_SAMPLE_EVERY):
+        super().__init__()
+        self.every = every
+        self._counts = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = getattr(record, "sample", None)
+        if key is None:
+            return True
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if count % self.every:
+            return False
+        if count:
+            record.msg = f"{record.msg} [1/{self.every} sampled]"
+        return True
+
+
+class EventQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue event records untouched; JSON is encoded by the listener / 事件原样入队，由监听线程编码"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class JsonEventFormatter(logging.Formatter):
+    """One JSON object per line / 每行一个 JSON 对象"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        event = dict(record.msg)
+        event.setdefault("ts", round(record.created, 3))
+        return json.dumps(event, ensure_ascii=False, default=str)
+
+
+def log_event(kind: str, **fields):
+    """
+    Record a structured event when --event-log is on / 记录结构化事件
+
+    The dict is only serialized on the log listener thread.
+    """
+    if not state.event_log:
+        return
+    fields["event"] = kind
+    event_logger.info(fields)
+
+
+def start_log_listener(logger: logging.Logger, queue_handler, *handlers):
+    """Route a logger through a queue to a listener thread / 日志经队列交给监听线程写入"""
+    log_queue = queue.SimpleQueue()
+    queue_handler.queue = log_queue
+    logger.handlers[:] = [queue_handler]
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def setup_logging(level: int = logging.INFO, event_log: bool = False):
+    """
+    设置日志系统
+
+    All records go through a queue: callers (event loop, injection thread)
+    only enqueue, a listener thread does formatting and disk I/O. The log
+    rotates by size, backups are gzipped and old files are pruned by age.
+    所有日志经队列交给监听线程写入，调用方只入队，不做磁盘 I/O。
+    """
     # 日志文件保存在用户数据目录
-    log_dir = Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / 'logs'
+    log_dir = get_log_dir()
     log_dir.mkdir(parents=True, exist_ok=True)
-    
-    # 使用日期作为文件名
-    from datetime import datetime
-    log_file = log_dir / f"voice_coding_{datetime.now().strftime('%Y%m%d')}.log"
+    log_file = log_dir / "voice_coding.log"
     state.log_file = log_file
-    
-    # 配置 logging
-    import logging
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s [%(levelname)s] %(message)s',
-        datefmt='%H:%M:%S',
-        handlers=[
-            logging.FileHandler(log_file, encoding='utf-8'),
-            logging.StreamHandler(sys.stdout)  # 同时输出到控制台
-        ]
-    )
+
+    file_handler = CompressingRotatingFileHandler(log_file)
+    file_handler.setFormatter(logging.Formatter(
+        '%(asctime)s [%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    handlers = [file_handler]
+    # Windowed builds have no console / 无控制台的打包版本没有 stdout
+    if sys.stdout is not None:
+        console = logging.StreamHandler(sys.stdout)  # 同时输出到控制台
+        console.setFormatter(logging.Formatter('%(asctime)s [%(levelname)s] %(message)s', datefmt='%H:%M:%S'))
+        handlers.append(console)
+
+    queue_handler = logging.handlers.QueueHandler(None)
+    queue_handler.addFilter(SamplingFilter())
+    root = logging.getLogger()
+    root.setLevel(level)
+    start_log_listener(root, queue_handler, *handlers)
+
+    if event_log:
+        events = CompressingRotatingFileHandler(log_dir / "events.jsonl")
+        events.setFormatter(JsonEventFormatter())
+        event_logger.setLevel(logging.INFO)
+        start_log_listener(event_logger, EventQueueHandler(None), events)
+    state.event_log = event_log
+
+    active = (log_file, log_dir / "events.jsonl")
+    threading.Thread(target=prune_logs, args=(log_dir, LOG_RETENTION_DAYS, active),
+                     name="LogPrune", daemon=True).start()
+
     logging.info(f"=== Voicing 启动 ===")
     logging.info(f"日志文件: {log_file}")
 
 
+# ============================================================
+# Startup Timing / 启动计时
+# ============================================================
+STARTUP_REPORT_TIMEOUT = 15  # 超时后即使有阶段未完成也输出报告（秒）
+STARTUP_PHASES = ["imports", "logging", "ip_detection", "server_bind",
+                  "first_broadcast", "tray_imports", "icon_cache", "tray"]
+TRAY_STARTUP_PHASES = ("tray_imports", "icon_cache", "tray")  # --headless 时不存在的阶段
+
+
+class StartupProfiler:
+    """
+    Per-phase cold start timings / 冷启动分阶段计时
+
+    Phases run on different threads (server, discovery, tray), so each one
+    records its own start and end relative to process start. The report is
+    printed once every expected phase finished, or after a timeout.
+    """
+
+    def __init__(self, origin: float):
+        self.origin = origin
+        self.phases = {}  # name -> (start, end)，相对起点的秒数
+        self.expected = []
+        self.enabled = False
+        self._reported = False
+        self._lock = threading.Lock()
+
+    def enable(self, expected):
+        """Print a report once these phases are done / 这些阶段完成后输出报告"""
+        self.expected = list(expected)
+        self.enabled = True
+        timer = threading.Timer(STARTUP_REPORT_TIMEOUT, self.report)
+        timer.daemon = True
+        timer.start()
+
+    def record(self, name: str, started: float, finished: Optional[float] = None):
+        """Record a phase from perf_counter() values / 记录一个阶段"""
+        if finished is None:
+            finished = time.perf_counter()
+        with self._lock:
+            if name in self.phases:
+                return
+            self.phases[name] = (started - self.origin, finished - self.origin)
+            done = self.enabled and all(p in self.phases for p in self.expected)
+        if done:
+            self.report()
+
+    @contextmanager
+    def phase(self, name: str):
+        """Time the enclosed block / 计时代码块"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, started)
+
+    def format(self) -> str:
+        """Render the timing table / 生成耗时表"""
+        lines = ["=== Startup report / 启动耗时 ===",
+                 f"{'phase':<16}{'took':>10}{'done at':>12}"]
+        for name in self.expected + sorted(set(self.phases) - set(self.expected)):
+            if name in self.phases:
+                start, end = self.phases[name]
+                lines.append(f"{name:<16}{(end - start) * 1000:>8.1f}ms{end * 1000:>10.1f}ms")
+            else:
+                lines.append(f"{name:<16}{'-':>10}{'-':>12}")
+        return "\n".join(lines)
+
+    def report(self):
+        """Log the report once / 只输出一次报告"""
+        with self._lock:
+            if not self.enabled or self._reported:
+                return
+            self._reported = True
+        for line in self.format().splitlines():
+            logging.info(line)
+
+
+startup = StartupProfiler(_STARTUP_T0)
+
+
 # ============================================================
 # Network Configuration / 网络配置
 # ============================================================
@@ -146,9 +470,15 @@ DEFAULT_HOTSPOT_IP = "192.168.137.1"
 # UDP broadcast configuration / UDP 广播配置
 UDP_BROADCAST_PORT = 9530  # UDP 广播端口
 UDP_BROADCAST_INTERVAL = 2  # 广播间隔（秒）
+UDP_BROADCAST_MAX_INTERVAL = 30  # 有客户端连接时广播退避的最大间隔（秒）
+DISCOVERY_QUERY_TYPE = "voice_coding_discover"  # 手机主动发现查询的消息类型
+
 
+NETWORK_POLL_INTERVAL = 5    # 无系统通知时轮询网卡变化的间隔（秒）
+NETWORK_SETTLE_DELAY = 0.5   # 地址变化后等待网卡稳定的时间（秒）
 
-def get_hotspot_ip() -> str:
+
+def get_hotspot_ip(addresses: Optional[list] = None) -> str:
     """
     Get the actual hotspot IP address / 获取热点的实际 IP 地址
     
@@ -156,10 +486,11 @@ def get_hotspot_ip() -> str:
     will try to detect the actual IP by looking for the hotspot adapter.
     """
     try:
-        import socket
-        
+        if addresses is None:
+            addresses = get_interface_addresses()
+
         # Method 1: Try to find hotspot adapter by checking common hotspot IP ranges
-        for adapter_ip in get_all_local_ips():
+        for adapter_ip, _ in addresses:
             # Windows Mobile Hotspot typically uses 192.168.137.x
             if adapter_ip.startswith("192.168.137."):
                 return adapter_ip
@@ -168,93 +499,433 @@ def get_hotspot_ip() -> str:
         return DEFAULT_HOTSPOT_IP
         
     except Exception as e:
-        print(f"Error detecting hotspot IP: {e}")
+        logging.warning(f"检测热点 IP 失败: {e}")
         return DEFAULT_HOTSPOT_IP
 
 
-def get_all_local_ips() -> list:
-    """Get all local IP addresses / 获取所有本地 IP 地址"""
-    ips = []
+_interface_cache: Optional[list] = None
+_interface_lock = threading.Lock()
+
+
+def get_interface_addresses(refresh: bool = False) -> list:
+    """
+    IPv4 addresses of the active interfaces / 活动网卡的 IPv4 地址
+
+    Returns (ip, prefix_length) tuples. Enumeration happens in-process (no
+    PowerShell) and the result is cached until `refresh` is requested, which
+    the network watcher does whenever addresses change.
+    """
+    global _interface_cache
+    with _interface_lock:
+        if _interface_cache is None or refresh:
+            try:
+                if sys.platform == "win32":
+                    addresses = _enumerate_windows_interfaces()
+                elif sys.platform.startswith("linux"):
+                    addresses = _enumerate_linux_interfaces()
+                else:
+                    addresses = []
+            except Exception as e:
+                logging.warning(f"网卡枚举失败，改用主机名解析: {e}")
+                addresses = []
+            if not addresses:
+                addresses = _enumerate_hostname_addresses()
+            _interface_cache = addresses
+        return list(_interface_cache)
+
+
+def _is_usable_ip(ip: str) -> bool:
+    """Skip loopback and link-local addresses / 跳过回环和链路本地地址"""
+    return not ip.startswith("127.") and not ip.startswith("169.254.")
+
+
+# Win32 GetAdaptersAddresses structures (fields up to the ones we read)
+# Win32 GetAdaptersAddresses 结构体（只声明到需要读取的字段）
+GAA_FLAG_SKIP_ANYCAST = 0x0002
+GAA_FLAG_SKIP_MULTICAST = 0x0004
+GAA_FLAG_SKIP_DNS_SERVER = 0x0008
+ERROR_BUFFER_OVERFLOW = 111
+IF_OPER_STATUS_UP = 1
+IF_TYPE_SOFTWARE_LOOPBACK = 24
+
+
+class _SOCKET_ADDRESS(ctypes.Structure):
+    _fields_ = [("lpSockaddr", ctypes.c_void_p), ("iSockaddrLength", ctypes.c_int)]
+
+
+class _IP_ADAPTER_UNICAST_ADDRESS(ctypes.Structure):
+    pass
+
+
+_IP_ADAPTER_UNICAST_ADDRESS._fields_ = [
+    ("Length", ctypes.wintypes.ULONG),
+    ("Flags", ctypes.wintypes.DWORD),
+    ("Next", ctypes.POINTER(_IP_ADAPTER_UNICAST_ADDRESS)),
+    ("Address", _SOCKET_ADDRESS),
+    ("PrefixOrigin", ctypes.c_int),
+    ("SuffixOrigin", ctypes.c_int),
+    ("DadState", ctypes.c_int),
+    ("ValidLifetime", ctypes.wintypes.ULONG),
+    ("PreferredLifetime", ctypes.wintypes.ULONG),
+    ("LeaseLifetime", ctypes.wintypes.ULONG),
+    ("OnLinkPrefixLength", ctypes.c_uint8),
+]
+
+
+class _IP_ADAPTER_ADDRESSES(ctypes.Structure):
+    pass
+
+
+_IP_ADAPTER_ADDRESSES._fields_ = [
+    ("Length", ctypes.wintypes.ULONG),
+    ("IfIndex", ctypes.wintypes.DWORD),
+    ("Next", ctypes.POINTER(_IP_ADAPTER_ADDRESSES)),
+    ("AdapterName", ctypes.c_char_p),
+    ("FirstUnicastAddress", ctypes.POINTER(_IP_ADAPTER_UNICAST_ADDRESS)),
+    ("FirstAnycastAddress", ctypes.c_void_p),
+    ("FirstMulticastAddress", ctypes.c_void_p),
+    ("FirstDnsServerAddress", ctypes.c_void_p),
+    ("DnsSuffix", ctypes.c_wchar_p),
+    ("Description", ctypes.c_wchar_p),
+    ("FriendlyName", ctypes.c_wchar_p),
+    ("PhysicalAddress", ctypes.c_ubyte * 8),
+    ("PhysicalAddressLength", ctypes.wintypes.ULONG),
+    ("Flags", ctypes.wintypes.ULONG),
+    ("Mtu", ctypes.wintypes.ULONG),
+    ("IfType", ctypes.wintypes.ULONG),
+    ("OperStatus", ctypes.c_int),
+]
+
+
+def _enumerate_windows_interfaces() -> list:
+    """Enumerate with GetAdaptersAddresses / 使用 GetAdaptersAddresses 枚举网卡"""
+    iphlpapi = ctypes.windll.iphlpapi
+    flags = GAA_FLAG_SKIP_ANYCAST | GAA_FLAG_SKIP_MULTICAST | GAA_FLAG_SKIP_DNS_SERVER
+    size = ctypes.wintypes.ULONG(16 * 1024)
+    for _ in range(3):
+        buffer = ctypes.create_string_buffer(size.value)
+        result = iphlpapi.GetAdaptersAddresses(
+            socket.AF_INET, flags, None, buffer, ctypes.byref(size)
+        )
+        if result != ERROR_BUFFER_OVERFLOW:
+            break
+    if result != 0:
+        raise OSError(result, "GetAdaptersAddresses failed")
+
+    addresses = []
+    adapter = ctypes.cast(buffer, ctypes.POINTER(_IP_ADAPTER_ADDRESSES))
+    while adapter:
+        info = adapter.contents
+        if info.OperStatus == IF_OPER_STATUS_UP and info.IfType != IF_TYPE_SOFTWARE_LOOPBACK:
+            unicast = info.FirstUnicastAddress
+            while unicast:
+                entry = unicast.contents
+                sockaddr = ctypes.string_at(entry.Address.lpSockaddr, entry.Address.iSockaddrLength)
+                # SOCKADDR_IN: family (2) | port (2) | addr (4)
+                if struct.unpack_from("<H", sockaddr)[0] == socket.AF_INET:
+                    ip = socket.inet_ntoa(sockaddr[4:8])
+                    if _is_usable_ip(ip) and ip not in [a for a, _ in addresses]:
+                        addresses.append((ip, entry.OnLinkPrefixLength))
+                unicast = entry.Next
+        adapter = info.Next
+    return addresses
+
+
+def _enumerate_linux_interfaces() -> list:
+    """Enumerate with SIOCGIFADDR / SIOCGIFNETMASK ioctls / 使用 ioctl 枚举网卡"""
+    import fcntl
+    SIOCGIFADDR = 0x8915
+    SIOCGIFNETMASK = 0x891B
+
+    addresses = []
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        for _, name in socket.if_nameindex():
+            request = struct.pack("256s", name.encode()[:15])
+            try:
+                ip = socket.inet_ntoa(fcntl.ioctl(sock.fileno(), SIOCGIFADDR, request)[20:24])
+                mask = fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, request)[20:24]
+            except OSError:
+                # Interface without an IPv4 address / 没有 IPv4 地址的网卡
+                continue
+            if _is_usable_ip(ip):
+                addresses.append((ip, bin(int.from_bytes(mask, "big")).count("1")))
+    return addresses
+
+
+def _enumerate_hostname_addresses() -> list:
+    """Fallback: resolve the host name, assuming /24 / 兜底：解析主机名（假定 /24）"""
+    addresses = []
     try:
-        import socket
-        hostname = socket.gethostname()
-        # Get all addresses associated with hostname
-        for info in socket.getaddrinfo(hostname, None, socket.AF_INET):
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
             ip = info[4][0]
-            if ip not in ips and not ip.startswith("127."):
-                ips.append(ip)
-    except:
-        pass
-    
-    # Also try to get IPs from network interfaces directly
-    try:
-        import subprocess
-        result = subprocess.run(
-            ['powershell', '-Command', 
-             "Get-NetIPAddress -AddressFamily IPv4 | Select-Object -ExpandProperty IPAddress"],
-            capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW
-        )
-        for line in result.stdout.strip().split('\n'):
-            ip = line.strip()
-            if ip and not ip.startswith("127.") and ip not in ips:
-                ips.append(ip)
-    except:
+            if _is_usable_ip(ip) and ip not in [a for a, _ in addresses]:
+                addresses.append((ip, 24))
+    except OSError:
         pass
-    
-    return ips
+    return addresses
+
+
+def build_discovery_payload(ip: Optional[str] = None) -> bytes:
+    """UDP discovery message for an address (default: hotspot IP) / UDP 发现消息"""
+    # Broadcast message format / 广播消息格式
+    return json.dumps({
+        "type": "voice_coding_server",
+        "ip": ip or HOTSPOT_IP,
+        "port": state.ws_port,
+        "name": socket.gethostname()
+    }).encode('utf-8')
+
+
+def refresh_network():
+    """
+    Re-read interfaces and apply a changed hotspot IP / 重新读取网卡并应用新的热点 IP
+    """
+    global HOTSPOT_IP
+    addresses = get_interface_addresses(refresh=True)
+    new_ip = get_hotspot_ip(addresses)
+    if new_ip == HOTSPOT_IP and state.discovery_payload is not None:
+        return
+    if new_ip != HOTSPOT_IP:
+        logging.info(f"热点 IP 变化: {HOTSPOT_IP} -> {new_ip}")
+    HOTSPOT_IP = new_ip
+    state.discovery_payload = build_discovery_payload()
+    notify_state_listeners("address", ip=new_ip)
+
+
+class NetworkWatcher:
+    """
+    Background watcher for interface address changes.
+    后台监视网卡地址变化。
+
+    On Windows the thread blocks in NotifyAddrChange and wakes only when an
+    IPv4 address is added or removed (e.g. the hotspot restarting on a new
+    subnet); elsewhere it polls every NETWORK_POLL_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="NetworkWatcher", daemon=True)
+        self._thread.start()
+
+    def _wait_for_change(self):
+        if sys.platform == "win32":
+            # Synchronous call: returns after the next address change
+            # 同步调用：下一次地址变化后返回
+            result = ctypes.windll.iphlpapi.NotifyAddrChange(None, None)
+            if result != 0:
+                time.sleep(NETWORK_POLL_INTERVAL)
+        else:
+            time.sleep(NETWORK_POLL_INTERVAL)
+
+    def _run(self):
+        while state.running:
+            self._wait_for_change()
+            # Addresses arrive in several steps; let them settle
+            # 地址分几步生效，稍等片刻再读取
+            time.sleep(NETWORK_SETTLE_DELAY)
+            try:
+                refresh_network()
+            except Exception as e:
+                logging.error(f"刷新网络信息失败: {e}")
 
 
 # ============================================================
 # UDP Broadcast for Auto-Discovery / UDP 广播自动发现
 # ============================================================
-def start_udp_broadcast():
+def _ipv4_to_int(ip: str) -> int:
+    return struct.unpack(">I", socket.inet_aton(ip))[0]
+
+
+def _prefix_mask(prefix: int) -> int:
+    return (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+
+
+def broadcast_address(ip: str, prefix: int) -> Optional[str]:
+    """Directed broadcast address of a subnet / 子网定向广播地址"""
+    if not 0 < prefix < 31:
+        return None
+    host_bits = ~_prefix_mask(prefix) & 0xFFFFFFFF
+    return socket.inet_ntoa(struct.pack(">I", _ipv4_to_int(ip) | host_bits))
+
+
+class DiscoveryService:
     """
-    Start UDP broadcast to let mobile clients discover this server.
-    启动 UDP 广播让移动客户端自动发现此服务器。
+    UDP discovery: query responder plus adaptive broadcasting.
+    UDP 自动发现：响应查询 + 自适应广播。
+
+    A phone sending `{"type": "voice_coding_discover"}` to UDP_BROADCAST_PORT
+    gets the server payload back immediately, addressed to it. Broadcasts go
+    to the directed broadcast address of every IPv4 interface, each carrying
+    that interface's IP, every UDP_BROADCAST_INTERVAL seconds while nobody is
+    connected, backing off to UDP_BROADCAST_MAX_INTERVAL while clients are.
+    The thread sleeps in select() and is woken through a socket pair when the
+    client count or the addresses change.
     """
-    broadcast_socket = None
-    try:
-        broadcast_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        broadcast_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-        # Broadcast message format / 广播消息格式
-        broadcast_data = json.dumps({
-            "type": "voice_coding_server",
-            "ip": HOTSPOT_IP,
-            "port": state.ws_port,
-            "name": socket.gethostname()
-        }).encode('utf-8')
+    def __init__(self):
+        self.sock: Optional[socket.socket] = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._broadcast_now = False
+        self._client_count = 0
+        self.interval = UDP_BROADCAST_INTERVAL
+        self.broadcasts_sent = 0
+        self.queries_answered = 0
+
+    def wake(self, broadcast: bool = True):
+        """Interrupt select(); optionally broadcast right away / 唤醒线程"""
+        if broadcast:
+            self._broadcast_now = True
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
 
-        logging.info(f"UDP 广播服务已启动，端口: {UDP_BROADCAST_PORT}")
+    def on_state_event(self, event: str, data: dict):
+        """State listener: re-announce when the last client leaves or the
+        address changes / 最后一个客户端断开或地址变化时立即广播"""
+        if event == "clients":
+            self._client_count = data["count"]
+            if self._client_count == 0:
+                self.wake()
+        elif event == "address":
+            self.wake()
+
+    def targets(self) -> list:
+        """(address, payload) per interface / 每个网卡的广播地址和消息"""
+        targets = []
+        for ip, prefix in get_interface_addresses():
+            address = broadcast_address(ip, prefix)
+            if address:
+                targets.append((address, build_discovery_payload(ip)))
+        if not targets:
+            targets.append(('<broadcast>', state.discovery_payload or build_discovery_payload()))
+        return targets
+
+    def payload_for(self, sender_ip: str) -> bytes:
+        """Payload with the local IP on the sender's subnet / 选择与发送方同网段的本机 IP"""
+        try:
+            sender = _ipv4_to_int(sender_ip)
+            for ip, prefix in get_interface_addresses():
+                mask = _prefix_mask(prefix)
+                if (_ipv4_to_int(ip) & mask) == (sender & mask):
+                    return build_discovery_payload(ip)
+        except OSError:
+            pass
+        return state.discovery_payload or build_discovery_payload()
 
-        while state.running:
+    def broadcast(self):
+        """Send one round of directed broadcasts / 发送一轮定向广播"""
+        for address, payload in self.targets():
             try:
-                broadcast_socket.sendto(
-                    broadcast_data,
-                    ('<broadcast>', UDP_BROADCAST_PORT)
+                self.sock.sendto(payload, (address, UDP_BROADCAST_PORT))
+                self.broadcasts_sent += 1
+                logging.debug("发送 UDP 广播: %s (%d 字节)", address, len(payload),
+                              extra={"sample": "udp_broadcast"})
+            except OSError as e:
+                logging.debug(f"UDP 广播发送失败 ({address}): {e}")
+
+    def handle_datagram(self):
+        """Answer a discovery query / 回复发现查询"""
+        try:
+            data, addr = self.sock.recvfrom(2048)
+        except OSError:
+            return
+        try:
+            message = json.loads(data)
+        except ValueError:
+            return
+        # Our own broadcasts loop back here too; only queries are answered
+        # 本机广播也会回环到这里，只回复查询
+        if not isinstance(message, dict) or message.get("type") != DISCOVERY_QUERY_TYPE:
+            return
+        try:
+            self.sock.sendto(self.payload_for(addr[0]), addr)
+            self.queries_answered += 1
+            logging.debug("回复 UDP 发现查询: %s:%d", addr[0], addr[1],
+                          extra={"sample": "udp_query"})
+        except OSError as e:
+            logging.debug(f"UDP 查询回复失败 ({addr[0]}): {e}")
+
+    def _next_interval(self) -> float:
+        if self._client_count > 0:
+            self.interval = min(self.interval * 2, UDP_BROADCAST_MAX_INTERVAL)
+        else:
+            self.interval = UDP_BROADCAST_INTERVAL
+        return self.interval
+
+    def run(self):
+        """Serve until the app exits / 运行直到应用退出"""
+        started = time.perf_counter()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        watched = [self._wake_r]
+        try:
+            self.sock.bind(("", UDP_BROADCAST_PORT))
+            watched.append(self.sock)
+        except OSError as e:
+            # Still broadcast, just cannot answer queries / 仍可广播，但无法回复查询
+            logging.warning(f"无法监听 UDP 发现端口 {UDP_BROADCAST_PORT}: {e}")
+        if state.discovery_payload is None:
+            state.discovery_payload = build_discovery_payload()
+
+        logging.info(f"UDP 发现服务已启动，端口: {UDP_BROADCAST_PORT}")
+
+        next_broadcast = time.monotonic()
+        try:
+            while state.running:
+                now = time.monotonic()
+                if self._broadcast_now:
+                    self._broadcast_now = False
+                    self.interval = UDP_BROADCAST_INTERVAL
+                    next_broadcast = now
+                if now >= next_broadcast:
+                    self.broadcast()
+                    if started is not None:
+                        startup.record("first_broadcast", started)
+                        started = None
+                    next_broadcast = now + self._next_interval()
+
+                readable, _, _ = select.select(
+                    watched, [], [], max(0.0, next_broadcast - now)
                 )
-                logging.debug(f"发送 UDP 广播: {HOTSPOT_IP}:{state.ws_port}")
-            except Exception as e:
-                logging.debug(f"UDP 广播发送失败: {e}")
+                if self._wake_r in readable:
+                    try:
+                        self._wake_r.recv(64)
+                    except OSError:
+                        pass
+                if self.sock in readable:
+                    self.handle_datagram()
+        finally:
+            self.sock.close()
 
-            # Wait before next broadcast / 等待下次广播
-            for _ in range(UDP_BROADCAST_INTERVAL * 10):
-                if not state.running:
-                    break
-                time.sleep(0.1)
 
+def start_udp_broadcast():
+    """
+    Start UDP discovery to let mobile clients find this server.
+    启动 UDP 自动发现让移动客户端找到此服务器。
+    """
+    try:
+        service = DiscoveryService()
+        state.discovery = service
+        add_state_listener(service.on_state_event)
+        service.run()
     except Exception as e:
         logging.error(f"UDP 广播服务错误: {e}")
-    finally:
-        if broadcast_socket:
-            broadcast_socket.close()
 
 
 # Will be set at runtime / 运行时设置
 HOTSPOT_IP = DEFAULT_HOTSPOT_IP
 
 
+def server_url() -> str:
+    """Current WebSocket address shown to the user / 当前服务地址"""
+    return f"ws://{HOTSPOT_IP}:{state.ws_port}"
+
+
 # ============================================================
 # Startup Management / 开机启动管理
 # ============================================================
@@ -268,6 +939,7 @@ def get_exe_path() -> str:
 def is_startup_enabled() -> bool:
     """Check if app is set to start with Windows / 检查是否已设置开机启动"""
     try:
+        import winreg
         with winreg.OpenKey(winreg.HKEY_CURRENT_USER, STARTUP_REGISTRY_KEY, 0, winreg.KEY_READ) as key:
             winreg.QueryValueEx(key, APP_NAME)
             return True
@@ -280,6 +952,7 @@ def is_startup_enabled() -> bool:
 def set_startup_enabled(enabled: bool) -> bool:
     """Enable or disable startup with Windows / 启用或禁用开机启动"""
     try:
+        import winreg
         with winreg.OpenKey(winreg.HKEY_CURRENT_USER, STARTUP_REGISTRY_KEY, 0, winreg.KEY_SET_VALUE) as key:
             if enabled:
                 exe_path = get_exe_path()
@@ -291,810 +964,2661 @@ def set_startup_enabled(enabled: bool) -> bool:
                     pass
         return True
     except Exception as e:
-        print(f"Failed to modify startup setting: {e}")
+        logging.error(f"修改开机启动设置失败: {e}")
         return False
 
 
 # ============================================================
 # Text Input / 文本输入
 # ============================================================
-def type_text(text: str):
+_pyautogui = None
+
+
+def get_pyautogui():
     """
-    Type text at current cursor position.
-    在当前光标位置输入文本。
-    
-    Uses pyautogui.write for ASCII and pyperclip+paste for Unicode.
+    Import and configure pyautogui on first use / 首次使用时导入并配置 pyautogui
+
+    pyautogui needs a desktop session to import, so only the backends that
+    actually press keys load it.
     """
-    if not text or not state.sync_enabled:
-        return
-    
-    try:
-        # For Unicode support, use clipboard paste method
-        import pyperclip
-        
-        # Save current clipboard
-        try:
-            old_clipboard = pyperclip.paste()
-        except:
-            old_clipboard = ""
-        
-        # Copy new text and paste
-        pyperclip.copy(text)
-        pyautogui.hotkey('ctrl', 'v')
-        
-        # Small delay then restore clipboard
-        import time
-        time.sleep(0.1)
-        try:
-            pyperclip.copy(old_clipboard)
-        except:
-            pass
-            
-    except Exception as e:
-        print(f"Error typing text: {e}")
+    global _pyautogui
+    if _pyautogui is None:
+        import pyautogui
+        # Disable pyautogui failsafe (moving to corner won't stop it)
+        pyautogui.FAILSAFE = False
+        # Small pause between keystrokes for stability
+        pyautogui.PAUSE = 0.01
+        _pyautogui = pyautogui
+    return _pyautogui
+
+
+class InjectionBackend:
+    """
+    Base class for text injection backends / 文本注入后端基类
 
+    A backend turns text into input at the current cursor position. `inject`
+    is only ever called from the injection worker thread, one call at a time.
+    """
 
-# ============================================================
-# Reserved for future features / 保留给未来功能
-# ============================================================
+    name = ""
 
+    def inject(self, text: str):
+        """Type text at the cursor / 在光标处输入文本"""
+        raise NotImplementedError
 
-# ============================================================
-# WebSocket Server / WebSocket 服务器
-# ============================================================
-async def handle_client(websocket):
-    """Handle incoming WebSocket connections / 处理传入的WebSocket连接"""
-    client_addr = websocket.remote_address
-    state.connected_clients.add(websocket)
-    print(f"Client connected: {client_addr}")
+    def press_keys(self, keys: tuple):
+        """
+        Press keys in order / 依次按键
+
+        Each key is a name such as "enter" or a combination such as
+        "ctrl+z" (see KEY_CODES). On Windows the whole sequence goes out in
+        one SendInput call; elsewhere pyautogui presses them one by one.
+        """
+        if sys.platform == "win32":
+            send_key_batches(key_combo_events(keys))
+            return
+        pyautogui = get_pyautogui()
+        for key in keys:
+            pyautogui.hotkey(*key.split("+"))
+
+
+class ClipboardTransactions:
+    """
+    Serialized clipboard pastes that keep the user's clipboard intact.
+    串行化剪贴板粘贴，保证用户原有的剪贴板内容不丢失。
+
+    The user's clipboard is saved when a burst of pastes starts and restored
+    once the burst has been idle for `idle` seconds, so a later paste in the
+    burst can never save (and then restore) an earlier message's text. If
+    something else changes the clipboard mid-burst, that content is what
+    gets restored instead.
+
+    Windows does not report when the target application has read the
+    clipboard, so every paste is given `settle` seconds before the clipboard
+    is changed again. That wait is paid by the next paste or by the restore,
+    not by the message that was just pasted.
+
+    `read`, `write` and `press_paste` are injected so a fake clipboard can
+    drive it in the benchmark.
+    """
 
-    # Update tray icon when client connects
-    if state.tray_icon:
+    def __init__(self, read, write, press_paste,
+                 settle: float = CLIPBOARD_SETTLE_DELAY, idle: float = CLIPBOARD_RESTORE_IDLE):
+        self._read = read
+        self._write = write
+        self._press_paste = press_paste
+        self.settle = max(0.0, settle)
+        self.idle = max(idle, self.settle)
+        self._cond = threading.Condition()
+        self._saved = None       # 用户原剪贴板，None 表示不在事务中
+        self._pasted = None      # 最近一次写入剪贴板的文本
+        self._settled_at = 0.0   # 最近一次粘贴可以认为已被读取的时间
+        self._restore_at = 0.0
+        self.pastes = 0
+        self.restores = 0
+        threading.Thread(target=self._restore_loop, name="ClipboardRestore", daemon=True).start()
+
+    def _safe_read(self) -> Optional[str]:
         try:
-            update_tray_icon(state.tray_icon)
+            return self._read()
         except Exception as e:
-            print(f"Error updating tray icon: {e}")
+            logging.debug("读取剪贴板失败: %s", e)
+            return None
+
+    def _wait_settled(self):
+        """Wait until the last paste has had time to be read / 等待上一次粘贴被读取"""
+        while True:
+            remaining = self._settled_at - time.monotonic()
+            if remaining <= 0:
+                return
+            self._cond.wait(remaining)
+
+    def paste(self, text: str):
+        """Put text on the clipboard and press Ctrl+V / 写入剪贴板并按下 Ctrl+V"""
+        with self._cond:
+            self._wait_settled()
+            current = self._safe_read()
+            if self._saved is None:
+                self._saved = current if current is not None else ""
+            elif current is not None and current != self._pasted:
+                # Copied by the user mid-burst / 连续粘贴期间用户复制了新内容
+                self._saved = current
+            self._write(text)
+            self._pasted = text
+            try:
+                self._press_paste()
+            finally:
+                now = time.monotonic()
+                self._settled_at = now + self.settle
+                self._restore_at = now + self.idle
+                self.pastes += 1
+                self._cond.notify_all()
+
+    def _restore(self):
+        current = self._safe_read()
+        # Leave the clipboard alone if someone copied after our last paste
+        # 最后一次粘贴之后若有人复制了新内容，则不覆盖
+        if current is None or current == self._pasted:
+            try:
+                self._write(self._saved)
+            except Exception as e:
+                logging.warning(f"恢复剪贴板失败: {e}")
+        self._saved = None
+        self._pasted = None
+        self.restores += 1
+
+    def _restore_loop(self):
+        with self._cond:
+            while True:
+                if self._saved is None:
+                    self._cond.wait()
+                    continue
+                remaining = self._restore_at - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._restore()
+
+    def flush(self):
+        """Restore the user's clipboard now if a burst is pending / 立即恢复剪贴板（退出时）"""
+        with self._cond:
+            if self._saved is not None:
+                self._wait_settled()
+                self._restore()
+
+
+class ClipboardBackend(InjectionBackend):
+    """
+    Paste through the clipboard with Ctrl+V / 通过剪贴板 + Ctrl+V 粘贴
 
-    try:
-        # Get computer name for identification
-        computer_name = socket.gethostname()
-
-        # Send welcome message with current sync state and computer name
-        await websocket.send(json.dumps({
-            "type": "connected",
-            "message": "Connected to Voicing server",
-            "sync_enabled": state.sync_enabled,
-            "computer_name": computer_name
-        }))
+    Works in every application and for all of Unicode, at the cost of
+    touching the user's clipboard; see `ClipboardTransactions` for how it is
+    saved and restored.
+    """
 
-        async for message in websocket:
-            try:
-                data = json.loads(message)
-                msg_type = data.get("type", "")
+    name = "clipboard"
 
-                if msg_type == "text":
-                    # Check if sync is enabled
-                    if not state.sync_enabled:
-                        await websocket.send(json.dumps({
-                            "type": "sync_disabled",
-                            "message": "Sync is disabled on PC"
-                        }))
-                        continue
+    def __init__(self):
+        import pyperclip
+        pyautogui = get_pyautogui()
+        self.transactions = ClipboardTransactions(
+            pyperclip.paste, pyperclip.copy, partial(pyautogui.hotkey, 'ctrl', 'v'),
+            settle=state.clipboard_delay,
+        )
+        # Do not leave dictated text on the clipboard / 退出时不把听写文本留在剪贴板
+        atexit.register(self.transactions.flush)
+
+    def inject(self, text: str):
+        self.transactions.paste(text)
+
+
+# Win32 SendInput structures / Win32 SendInput 结构体
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+KEYEVENTF_EXTENDEDKEY = 0x0001
+VK_TAB = 0x09
+VK_RETURN = 0x0D
+KEYS_MAX_PRESSES = 256  # 单条 keys 消息展开后的最大按键数
+# Events per SendInput call; very large batches can overflow slow apps
+# 每次 SendInput 的事件数，过大的批次可能让响应慢的程序丢键
+SENDINPUT_BATCH_EVENTS = 1024
+
+# Key names (pyautogui spelling) -> virtual key codes / 按键名 -> 虚拟键码
+KEY_CODES = {
+    "backspace": 0x08, "tab": VK_TAB, "enter": VK_RETURN, "shift": 0x10, "ctrl": 0x11,
+    "alt": 0x12, "esc": 0x1B, "escape": 0x1B, "space": 0x20, "pageup": 0x21,
+    "pagedown": 0x22, "end": 0x23, "home": 0x24, "left": 0x25, "up": 0x26,
+    "right": 0x27, "down": 0x28, "insert": 0x2D, "delete": 0x2E, "del": 0x2E, "win": 0x5B,
+}
+KEY_CODES.update({chr(c): c - 0x20 for c in range(ord("a"), ord("z") + 1)})
+KEY_CODES.update({str(d): 0x30 + d for d in range(10)})
+KEY_CODES.update({f"f{n}": 0x6F + n for n in range(1, 13)})
+# Navigation keys need the extended flag, or NumLock turns them into digits
+# 导航键需要扩展键标志，否则开启 NumLock 时会变成小键盘数字
+EXTENDED_KEYS = {0x21, 0x22, 0x23, 0x24, 0x25, 0x26, 0x27, 0x28, 0x2D, 0x2E, 0x5B}
+
+
+class _MOUSEINPUT(ctypes.Structure):
+    _fields_ = [
+        ("dx", ctypes.wintypes.LONG),
+        ("dy", ctypes.wintypes.LONG),
+        ("mouseData", ctypes.wintypes.DWORD),
+        ("dwFlags", ctypes.wintypes.DWORD),
+        ("time", ctypes.wintypes.DWORD),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class _KEYBDINPUT(ctypes.Structure):
+    _fields_ = [
+        ("wVk", ctypes.wintypes.WORD),
+        ("wScan", ctypes.wintypes.WORD),
+        ("dwFlags", ctypes.wintypes.DWORD),
+        ("time", ctypes.wintypes.DWORD),
+        ("dwExtraInfo", ctypes.c_size_t),
+    ]
+
+
+class _HARDWAREINPUT(ctypes.Structure):
+    _fields_ = [
+        ("uMsg", ctypes.wintypes.DWORD),
+        ("wParamL", ctypes.wintypes.WORD),
+        ("wParamH", ctypes.wintypes.WORD),
+    ]
+
+
+class _INPUTUNION(ctypes.Union):
+    # MOUSEINPUT is the largest member and fixes sizeof(INPUT)
+    _fields_ = [("mi", _MOUSEINPUT), ("ki", _KEYBDINPUT), ("hi", _HARDWAREINPUT)]
+
+
+class _INPUT(ctypes.Structure):
+    _fields_ = [("type", ctypes.wintypes.DWORD), ("u", _INPUTUNION)]
+
+
+def send_key_events(events: list) -> int:
+    """
+    Submit keyboard events with a single SendInput call / 一次 SendInput 提交所有键盘事件
 
-                    text = data.get("content", "")
-                    if text:
-                        # Type the received text
-                        type_text(text)
-                        # Send acknowledgment
-                        await websocket.send(json.dumps({
-                            "type": "ack",
-                            "message": "Text received and typed"
-                        }))
+    Args:
+        events: list of (virtual_key, scan_code, flags) tuples
 
-                elif msg_type == "ping":
-                    # Respond with pong and current sync state
-                    await websocket.send(json.dumps({
-                        "type": "pong",
-                        "sync_enabled": state.sync_enabled
-                    }))
+    Returns the number of events Windows accepted.
+    """
+    if not events:
+        return 0
+    inputs = (_INPUT * len(events))()
+    for slot, (vk, scan, flags) in zip(inputs, events):
+        slot.type = INPUT_KEYBOARD
+        slot.u.ki.wVk = vk
+        slot.u.ki.wScan = scan
+        slot.u.ki.dwFlags = flags
+    return ctypes.windll.user32.SendInput(len(events), inputs, ctypes.sizeof(_INPUT))
+
+
+def send_key_batches(events: list):
+    """Send events in SENDINPUT_BATCH_EVENTS batches / 分批提交键盘事件"""
+    for start in range(0, len(events), SENDINPUT_BATCH_EVENTS):
+        batch = events[start:start + SENDINPUT_BATCH_EVENTS]
+        sent = send_key_events(batch)
+        if sent != len(batch):
+            # Blocked by UIPI (e.g. elevated target window) / 被 UIPI 拦截（如目标窗口为管理员权限）
+            raise OSError(f"SendInput accepted {sent}/{len(batch)} events")
+
+
+def parse_key_sequence(keys) -> tuple:
+    """
+    Validate and expand a key list / 校验并展开按键序列
 
-            except json.JSONDecodeError:
-                # If not JSON, treat as plain text
-                if message.strip() and state.sync_enabled:
-                    type_text(message)
-                    
-    except websockets.exceptions.ConnectionClosed:
-        pass
-    finally:
-        state.connected_clients.discard(websocket)
-        print(f"Client disconnected: {client_addr}")
-        
-        # Update tray icon when client disconnects
-        if state.tray_icon:
-            update_tray_icon(state.tray_icon)
+    Items are key names ("enter"), combinations ("ctrl+z") or runs
+    ("left*5"). Returns the normalized names with runs expanded; raises
+    ValueError for anything else.
+    """
+    if not isinstance(keys, list) or not keys:
+        raise ValueError("keys must be a non-empty list")
+    pressed = []
+    for item in keys:
+        if not isinstance(item, str):
+            raise ValueError(f"invalid key: {item!r}")
+        combo, _, count = item.strip().lower().replace(" ", "").partition("*")
+        if count.isdecimal():
+            # Long digit strings are over the limit anyway / 过长的数字必然超出上限
+            repeat = int(count) if len(count) <= 9 else KEYS_MAX_PRESSES + 1
+        else:
+            repeat = 0 if count else 1
+        if repeat < 1:
+            raise ValueError(f"invalid repeat count: {item!r}")
+        for name in combo.split("+"):
+            if name not in KEY_CODES:
+                raise ValueError(f"unknown key: {name!r}")
+        # Checked before expanding "a*99999999" / 展开前检查，避免超大重复次数占满内存
+        if len(pressed) + repeat > KEYS_MAX_PRESSES:
+            raise ValueError(f"more than {KEYS_MAX_PRESSES} key presses")
+        pressed.extend([combo] * repeat)
+    return tuple(pressed)
+
+
+def key_combo_events(keys: tuple) -> list:
+    """
+    Translate key combinations into down/up events / 将组合键转换为按下 / 抬起事件
 
+    Modifiers go down in order and come up in reverse, so "ctrl+shift+z"
+    is ctrl, shift, z down then z, shift, ctrl up.
+    """
+    events = []
+    for combo in keys:
+        codes = [KEY_CODES[name] for name in combo.split("+")]
+        for vk in codes:
+            events.append((vk, 0, KEYEVENTF_EXTENDEDKEY if vk in EXTENDED_KEYS else 0))
+        for vk in reversed(codes):
+            flags = KEYEVENTF_KEYUP | (KEYEVENTF_EXTENDEDKEY if vk in EXTENDED_KEYS else 0)
+            events.append((vk, 0, flags))
+    return events
+
+
+def unicode_key_events(text: str) -> list:
+    """
+    Translate text into KEYEVENTF_UNICODE down/up pairs / 将文本转换为 Unicode 按键事件
 
-async def broadcast_sync_state():
-    """Broadcast sync state to all connected clients / 广播同步状态给所有客户端"""
-    if not state.connected_clients:
-        return
-    
-    message = json.dumps({
-        "type": "sync_state",
-        "sync_enabled": state.sync_enabled
-    })
-    
-    for client in state.connected_clients.copy():
-        try:
-            await client.send(message)
-        except:
-            pass
+    Characters outside the BMP are sent as two UTF-16 surrogates, which is
+    what Windows expects. Line breaks and tabs become real Enter/Tab presses
+    so editors treat them as keys rather than literal characters.
+    """
+    events = []
+    text = text.replace("\r\n", "\n")
+    data = text.encode("utf-16-le")
+    for i in range(0, len(data), 2):
+        unit = data[i] | (data[i + 1] << 8)
+        if unit in (0x0A, 0x0D):
+            events.append((VK_RETURN, 0, 0))
+            events.append((VK_RETURN, 0, KEYEVENTF_KEYUP))
+        elif unit == 0x09:
+            events.append((VK_TAB, 0, 0))
+            events.append((VK_TAB, 0, KEYEVENTF_KEYUP))
+        else:
+            events.append((0, unit, KEYEVENTF_UNICODE))
+            events.append((0, unit, KEYEVENTF_UNICODE | KEYEVENTF_KEYUP))
+    return events
 
 
-async def start_server():
-    """Start the WebSocket server / 启动WebSocket服务器"""
-    try:
-        async with serve(handle_client, "0.0.0.0", state.ws_port):
-            print(f"WebSocket server started at ws://{HOTSPOT_IP}:{state.ws_port}")
-            # Keep server running
-            while state.running:
-                await asyncio.sleep(1)
+class UnicodeKeyBackend(InjectionBackend):
+    """
+    Type text as batched Unicode key events / 以批量 Unicode 按键事件输入文本
+
+    Leaves the clipboard untouched and needs no restore delay: the whole
+    message is handed to Windows in one SendInput call per chunk.
+    """
+
+    name = "unicode"
+
+    def __init__(self):
+        if sys.platform != "win32":
+            raise RuntimeError("unicode backend requires Windows SendInput")
+
+    def inject(self, text: str):
+        send_key_batches(unicode_key_events(text))
+
+
+VIRTUAL_KEY_TEXT = {"enter": "\n", "tab": "\t", "space": " "}  # 虚拟文本框中产生字符的按键
+
+
+class VirtualTextField(InjectionBackend):
+    """
+    In-memory text field that records what would have been typed.
+    内存中的虚拟文本框，记录本应输入的内容。
+
+    Used for benchmarks and for running the server on machines without a
+    desktop session.
+    """
+
+    name = "memory"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._chunks = []
+        self.key_presses = 0
+
+    def inject(self, text: str):
+        with self._lock:
+            self._chunks.append(text)
+
+    def press_keys(self, keys: tuple):
+        # Editing keys change the text; others are recorded as <key>
+        # 编辑键直接作用于文本，其余按键记录为 <key>
+        with self._lock:
+            text = "".join(self._chunks)
+            for key in keys:
+                if key == "backspace":
+                    # Editors erase a whole grapheme cluster / 编辑器退格删除整个字素簇
+                    cut = len(text) - 1
+                    while cut > 0 and not is_grapheme_break(text, cut):
+                        cut -= 1
+                    text = text[:max(cut, 0)]
+                elif key in VIRTUAL_KEY_TEXT:
+                    text += VIRTUAL_KEY_TEXT[key]
+                else:
+                    text += f"<{key}>"
+            self._chunks = [text]
+            self.key_presses += len(keys)
+
+    @property
+    def text(self) -> str:
+        """Everything typed so far / 目前为止输入的全部内容"""
+        with self._lock:
+            return "".join(self._chunks)
+
+    @property
+    def injections(self) -> int:
+        """Number of inject calls / 注入次数"""
+        with self._lock:
+            return len(self._chunks)
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+
+
+class NullBackend(InjectionBackend):
+    """Discard all input / 丢弃所有输入（用于压测）"""
+
+    name = "null"
+
+    def inject(self, text: str):
+        pass
+
+    def press_keys(self, keys: tuple):
+        pass
+
+
+INJECTION_BACKENDS = {
+    backend.name: backend
+    for backend in (ClipboardBackend, UnicodeKeyBackend, VirtualTextField, NullBackend)
+}
+
+
+def create_injection_backend(name: str) -> InjectionBackend:
+    """Create an injection backend by name / 按名称创建注入后端"""
+    try:
+        backend_class = INJECTION_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"unknown injection backend: {name}") from None
+    return backend_class()
+
+
+def _is_regional_indicator(ch: str) -> bool:
+    return 0x1F1E6 <= ord(ch) <= 0x1F1FF
+
+
+def _is_grapheme_extend(ch: str) -> bool:
+    """Characters that attach to the previous one / 附着在前一字符上的字符"""
+    cp = ord(ch)
+    return (
+        unicodedata.category(ch) in ("Mn", "Me", "Mc")
+        or cp == 0x200D                    # ZWJ
+        or 0xFE00 <= cp <= 0xFE0F          # variation selectors
+        or 0x1F3FB <= cp <= 0x1F3FF        # emoji skin tones
+        or 0xE0020 <= cp <= 0xE007F        # emoji tag sequences
+    )
+
+
+def is_grapheme_break(text: str, index: int) -> bool:
+    """
+    Whether a user-perceived character boundary lies before text[index].
+    text[index] 之前是否为用户可见字符（字素簇）边界。
+
+    Covers what dictation produces: combining marks, CRLF, emoji ZWJ
+    sequences, skin tones, variation selectors and flag pairs.
+    """
+    if index <= 0 or index >= len(text):
+        return True
+    prev, cur = text[index - 1], text[index]
+    if prev == "\r" and cur == "\n":
+        return False
+    if prev == "\u200d" or _is_grapheme_extend(cur):
+        return False
+    if _is_regional_indicator(prev) and _is_regional_indicator(cur):
+        # Flags are pairs: break only after an even run / 国旗由两个区域指示符组成
+        run = 0
+        while index - run - 1 >= 0 and _is_regional_indicator(text[index - run - 1]):
+            run += 1
+        return run % 2 == 0
+    return True
+
+
+def split_text(text: str, limit: int) -> list:
+    """
+    Split text into chunks of at most `limit` characters without breaking a
+    grapheme cluster / 按字素边界把文本切成不超过 limit 个字符的块
+    """
+    chunks = []
+    start = 0
+    while len(text) - start > limit:
+        cut = start + limit
+        while cut > start and not is_grapheme_break(text, cut):
+            cut -= 1
+        if cut == start:
+            # A single cluster longer than the limit / 单个字素超过上限
+            cut = start + limit
+        chunks.append(text[start:cut])
+        start = cut
+    chunks.append(text[start:])
+    return chunks
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    """
+    Length of the common prefix of two strings / 两个字符串公共前缀的长度
+
+    Binary search over slice comparisons, so the per-character work happens
+    in C; appending to the end (the usual case) is a single comparison.
+    """
+    low, high = 0, min(len(a), len(b))
+    if a[:high] == b[:high]:
+        return high
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def diff_edit(old: str, new: str) -> tuple:
+    """
+    Minimal end-of-text edit turning `old` into `new` / 把 old 改成 new 的最小尾部编辑
+
+    Returns (graphemes to erase with Backspace, text to type). The cut is
+    moved back to a grapheme boundary of both texts, so a changed skin tone
+    or combining mark erases and retypes the whole character.
+    """
+    keep = common_prefix_length(old, new)
+    while keep > 0 and not (is_grapheme_break(old, keep) and is_grapheme_break(new, keep)):
+        keep -= 1
+    return count_graphemes(old[keep:]), new[keep:]
+
+
+def count_graphemes(text: str) -> int:
+    """User-perceived characters in text / 文本中用户可见字符（字素簇）的数量"""
+    return sum(1 for index in range(len(text)) if is_grapheme_break(text, index))
+
+
+def typed_length(segments) -> int:
+    """
+    Characters a sequence of segments leaves in a text field.
+    片段序列在文本框中留下的字符数。
+
+    Keys other than Enter/Tab/Space/Backspace are assumed to add nothing.
+    """
+    length = 0
+    for kind, value in segments:
+        if kind == RULE_TEXT:
+            length += count_graphemes(value)
+            continue
+        for key in value:
+            if key == "backspace":
+                length = max(0, length - 1)
+            elif key in VIRTUAL_KEY_TEXT:
+                length += 1
+    return length
+
+
+class InjectionUnavailable(RuntimeError):
+    """No injection backend could be created / 没有可用的注入后端"""
+
+
+INJECTION_FALLBACKS = ("clipboard", "unicode")  # 所选后端不可用时依次尝试
+_backend_error: Optional[str] = None  # 所有后端都不可用时的原因，不再重复尝试
+
+
+def get_injection_backend() -> InjectionBackend:
+    """
+    Backend selected with --backend, created on first use / 首次使用时创建 --backend 选择的后端
+
+    Creating it imports pyautogui / pyperclip, so this only runs on the
+    injection worker, once the server is listening. If the selected backend
+    cannot be created the INJECTION_FALLBACKS are tried; if none works,
+    InjectionUnavailable is raised now and on every later call. With
+    --record the backend is wrapped to record what it types.
+    """
+    global _backend_error
+    if state.injection_backend is None:
+        if _backend_error is not None:
+            raise InjectionUnavailable(_backend_error)
+        errors = []
+        for name in dict.fromkeys((state.backend_name,) + INJECTION_FALLBACKS):
+            try:
+                backend = create_injection_backend(name)
+            except Exception as e:
+                logging.error(f"注入后端 {name} 不可用: {e}")
+                errors.append(f"{name}: {e}")
+                continue
+            if name != state.backend_name:
+                logging.warning(f"改用注入后端: {name}")
+            break
+        else:
+            _backend_error = "no injection backend available (" + "; ".join(errors) + ")"
+            raise InjectionUnavailable(_backend_error)
+        if state.recorder is not None:
+            backend = RecordingBackend(backend, state.recorder)
+        state.injection_backend = backend
+    return state.injection_backend
+
+
+def press_keys(keys: tuple) -> int:
+    """
+    Press a key sequence from a `keys` message / 执行 keys 消息中的按键序列
+
+    The whole sequence is one injection job and one backend call.
+    Returns the characters it typed (see `typed_length`).
+    """
+    if not keys or not state.sync_enabled:
+        return 0
+    try:
+        get_injection_backend().press_keys(keys)
+    except InjectionUnavailable:
+        raise
     except Exception as e:
-        print(f"Server error: {e}")
+        logging.error(f"按键输入出错: {e}")
+        return 0
+    return typed_length(((RULE_KEYS, keys),))
 
 
-def run_server():
-    """Run the server in a separate thread / 在单独线程中运行服务器"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    loop.run_until_complete(start_server())
+def type_text(text: str, rules: bool = True):
+    """
+    Type text at current cursor position.
+    在当前光标位置输入文本。
+
+    Delegates to the injection backend selected at startup (clipboard paste
+    by default). Returns the characters typed, for undo. `rules=False`
+    types the text verbatim.
+    """
+    if not text or not state.sync_enabled:
+        return 0
+
+    try:
+        backend = get_injection_backend()
+        if rules and state.rules is not None:
+            segments = state.rules.transform(text)
+        else:
+            segments = ((RULE_TEXT, text),)
+        for kind, value in segments:
+            if kind == RULE_TEXT:
+                backend.inject(value)
+            else:
+                backend.press_keys(value)
+    except InjectionUnavailable:
+        # Reported to the phone as an error / 作为错误回报给手机
+        raise
+    except Exception as e:
+        logging.error(f"文本输入出错: {e}")
+        return 0
+    return typed_length(segments)
 
 
 # ============================================================
-# PyQt5 Modern Tray Menu / PyQt5 现代托盘菜单
+# Text Rules / 文本规则
 # ============================================================
+RULES_FILE_NAME = "rules.json"
+RULES_CHECK_INTERVAL = 1.0  # 检查规则文件是否变化的最小间隔（秒）
+RULES_CACHE_SIZE = 256      # 缓存最近的转换结果数
+RULE_TEXT = "text"          # 片段类型：文本
+RULE_KEYS = "keys"          # 片段类型：按键
 
-class MenuItemWidget(QWidget):
-    """单个菜单项 - Windows 11 Fluent Design 风格"""
-
-    clicked = pyqtSignal()
-
-    def __init__(self, icon_text, text, has_toggle=False, is_checked=False, parent=None):
-        super().__init__(parent)
-        self.has_toggle = has_toggle
-        self.is_checked = is_checked
-        self._hovered = False
-        self.setFixedHeight(36)  # Windows 11 标准高度
-        self.setMouseTracking(True)
-        self.setCursor(Qt.PointingHandCursor)
-
-        self.setup_ui(icon_text, text, has_toggle, is_checked)
-
-    def setup_ui(self, icon_text, text, has_toggle, is_checked):
-        """设置 UI"""
-        layout = QHBoxLayout(self)
-        layout.setContentsMargins(12, 0, 12, 0)  # 更宽的水平内边距
-        layout.setSpacing(10)
-
-        # 图标 - 使用白色
-        self.icon_label = QLabel(icon_text)
-        self.icon_label.setFixedWidth(20)
-        self.icon_label.setStyleSheet("font-size: 14px; background: transparent; color: #FFFFFF;")
-        self.icon_label.setAttribute(Qt.WA_TransparentForMouseEvents)
-
-        # 文字 - 使用 Segoe UI 字体（Windows 11 默认字体）
-        self.text_label = QLabel(text)
-        self.text_label.setStyleSheet("""
-            QLabel {
-                color: #FFFFFF;
-                font-family: 'Segoe UI', 'Microsoft YaHei UI', sans-serif;
-                font-size: 13px;
-                font-weight: 400;
-                background: transparent;
-            }
-        """)
-        self.text_label.setAlignment(Qt.AlignLeft | Qt.AlignVCenter)
-        self.text_label.setAttribute(Qt.WA_TransparentForMouseEvents)
-
-        layout.addWidget(self.icon_label)
-        layout.addWidget(self.text_label)
-        layout.addStretch()
-
-        # 开关项 - 显示简洁的状态
-        if has_toggle:
-            self.status_label = QLabel()
-            self.status_label.setFixedWidth(24)
-            self.status_label.setAttribute(Qt.WA_TransparentForMouseEvents)
-            self.update_toggle_status(is_checked)
-            layout.addWidget(self.status_label)
-
-    def paintEvent(self, event):
-        """自定义绘制背景 - Windows 11 风格"""
-        from PyQt5.QtGui import QPainter, QColor
-        painter = QPainter(self)
-        painter.setRenderHint(QPainter.Antialiasing)
-
-        # 绘制圆角矩形背景
-        rect = self.rect().adjusted(4, 2, -4, -2)  # 内缩，留出边距
-
-        if self._hovered:
-            # 悬停状态 - 使用更亮的高亮色
-            painter.setBrush(QColor(255, 255, 255, 15))  # 白色 6% 透明度
+
+def get_rules_path() -> Path:
+    """Default rule file (user data directory) / 默认规则文件（用户数据目录）"""
+    return Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / RULES_FILE_NAME
+
+
+def parse_rules(data) -> dict:
+    """
+    Turn the rule file into phrase -> segment / 解析规则文件
+
+    The file maps a spoken phrase to replacement text or to keys:
+        {"左括号": "(", "下划线": "_", "换行": {"keys": ["enter"]}}
+    """
+    if not isinstance(data, dict):
+        raise ValueError("rule file must be a JSON object")
+    rules = {}
+    for phrase, action in data.items():
+        if not phrase:
+            continue
+        if isinstance(action, str):
+            rules[phrase] = (RULE_TEXT, action)
+        elif isinstance(action, dict) and "keys" in action:
+            rules[phrase] = (RULE_KEYS, parse_key_sequence(action["keys"]))
+        else:
+            raise ValueError(f"invalid rule for {phrase!r}: {action!r}")
+    return rules
+
+
+class RuleAutomaton:
+    """
+    Aho–Corasick automaton over the rule phrases.
+    规则短语的 Aho–Corasick 自动机。
+
+    Every phrase occurrence is found in one pass over the text, however many
+    rules there are; `apply` then keeps the leftmost-longest non-overlapping
+    matches and merges adjacent text so only key actions split a paste.
+    """
+
+    def __init__(self, rules: dict):
+        self._goto = [{}]
+        self._fail = [0]
+        self._match = [None]  # state -> (phrase length, segment)
+        self._link = [0]      # nearest matching state along the fail chain
+        for phrase, segment in rules.items():
+            node = 0
+            for ch in phrase:
+                nxt = self._goto[node].get(ch)
+                if nxt is None:
+                    nxt = self._goto[node][ch] = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._match.append(None)
+                    self._link.append(0)
+                node = nxt
+            self._match[node] = (len(phrase), segment)
+        self._build()
+
+    def _build(self):
+        pending = deque(self._goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, child in self._goto[node].items():
+                pending.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0) if node else 0
+                self._fail[child] = target
+                self._link[child] = target if self._match[target] else self._link[target]
+
+    def longest_matches(self, text: str) -> dict:
+        """start -> (end, segment) of the longest phrase starting there / 每个起点的最长匹配"""
+        goto, fail, match, link = self._goto, self._fail, self._match, self._link
+        found = {}
+        node = 0
+        for index, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if match[node] else link[node]
+            while hit:
+                length, segment = match[hit]
+                start = index + 1 - length
+                if start not in found or found[start][0] < index + 1:
+                    found[start] = (index + 1, segment)
+                hit = link[hit]
+        return found
+
+    def apply(self, text: str) -> tuple:
+        """Text -> ((kind, value), ...) segments / 将文本转换为片段序列"""
+        found = self.longest_matches(text)
+        if not found:
+            return ((RULE_TEXT, text),)
+        segments = []
+        pending = []  # 待合并的文本
+        position = 0
+        for start in sorted(found):
+            if start < position:
+                continue
+            end, (kind, value) = found[start]
+            pending.append(text[position:start])
+            if kind == RULE_TEXT:
+                pending.append(value)
+            else:
+                if any(pending):
+                    segments.append((RULE_TEXT, "".join(pending)))
+                pending = []
+                if segments and segments[-1][0] == RULE_KEYS:
+                    # Consecutive key actions press as one run / 相邻按键合并为一次
+                    segments[-1] = (RULE_KEYS, segments[-1][1] + value)
+                else:
+                    segments.append((kind, value))
+            position = end
+        pending.append(text[position:])
+        if any(pending):
+            segments.append((RULE_TEXT, "".join(pending)))
+        return tuple(segments)
+
+
+class TextRules:
+    """
+    User rules applied to dictated text before injection.
+    注入前应用于听写文本的用户规则。
+
+    Runs on the injection thread, after batching, so a phrase split across
+    two shadow-mode frames still matches. The rule file is re-checked at
+    most once per RULES_CHECK_INTERVAL and recompiled when it changes; a
+    missing file means no rules, a broken one keeps the previous rules.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.count = 0
+        self._mtime = None
+        self._checked_at = 0.0
+        self._transform = None
+
+    def _check(self):
+        now = time.monotonic()
+        if now - self._checked_at < RULES_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        try:
+            mtime = self.path.stat().st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime == self._mtime:
+            return
+        self._mtime = mtime
+        if mtime is None:
+            self._compile({})
+            return
+        try:
+            rules = parse_rules(json.loads(self.path.read_text(encoding="utf-8")))
+        except (OSError, ValueError) as e:
+            logging.warning(f"规则文件无效，继续使用原有规则: {e}")
+            return
+        self._compile(rules)
+        logging.info(f"已加载 {len(rules)} 条文本规则: {self.path}")
+
+    def _compile(self, rules: dict):
+        self.count = len(rules)
+        # A fresh cache per rule set / 每套规则一份缓存，重新编译即失效
+        self._transform = lru_cache(maxsize=RULES_CACHE_SIZE)(RuleAutomaton(rules).apply) if rules else None
+
+    def transform(self, text: str) -> tuple:
+        """Apply the rules to one injection / 对一次注入应用规则"""
+        self._check()
+        if self._transform is None:
+            return ((RULE_TEXT, text),)
+        return self._transform(text)
+
+
+# ============================================================
+# Latency Tracing / 延迟追踪
+# ============================================================
+class LatencyHistogram:
+    """
+    Fixed-bucket latency histogram with a rolling window of recent samples.
+    固定分桶的延迟直方图，同时保留最近的样本用于计算分位数。
+    """
+
+    # Bucket upper bounds in milliseconds / 分桶上限（毫秒）
+    BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)  # last bucket is +Inf
+        self.total = 0
+        self.sum_ms = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.BUCKETS_MS, ms)] += 1
+        self.total += 1
+        self.sum_ms += ms
+        self.recent.append(ms)
+
+    def percentile(self, pct: float) -> float:
+        """Percentile over the rolling window / 滚动窗口内的分位数"""
+        if not self.recent:
+            return 0.0
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class LatencyTracker:
+    """
+    Per-stage latency of text messages / 文本消息各阶段延迟
+
+    Stages: queue (received -> injection start), inject (injection itself)
+    and total (received -> ack sent).
+    """
+
+    STAGES = ("queue", "inject", "total")
+
+    def __init__(self):
+        self.histograms = {stage: LatencyHistogram() for stage in self.STAGES}
+
+    def record(self, received: float, inject_start: float, inject_end: float, acked: float):
+        self.histograms["queue"].observe((inject_start - received) * 1000)
+        self.histograms["inject"].observe((inject_end - inject_start) * 1000)
+        self.histograms["total"].observe((acked - received) * 1000)
+
+    def summary(self) -> str:
+        """One-line p50/p95/p99 summary for the log / 用于日志的一行摘要"""
+        parts = []
+        for stage, histogram in self.histograms.items():
+            parts.append(
+                f"{stage} p50={histogram.percentile(50):.1f} "
+                f"p95={histogram.percentile(95):.1f} "
+                f"p99={histogram.percentile(99):.1f}ms"
+            )
+        return f"n={self.histograms['total'].total} " + " | ".join(parts)
+
+
+def log_text_event(client, received: float, timing: tuple, acked: float, **fields):
+    """Event-log record for one acked text message / 一条已确认文本消息的事件记录"""
+    if not state.event_log:
+        return
+    log_event(
+        "text", client=client,
+        queue_ms=round((timing[0] - received) * 1000, 2),
+        inject_ms=round((timing[1] - timing[0]) * 1000, 2),
+        total_ms=round((acked - received) * 1000, 2),
+        **fields
+    )
+
+
+def trace_ms(timestamp: float) -> float:
+    """Monotonic timestamp in milliseconds for ack frames / 用于 ack 的毫秒级单调时间戳"""
+    return round(timestamp * 1000, 3)
+
+
+state.latency = LatencyTracker()
+
+
+# ============================================================
+# Metrics / 运行指标
+# ============================================================
+METRICS_PATH = "/metrics"
+HEALTH_PATH = "/healthz"
+LOOP_LAG_INTERVAL = 0.5  # 事件循环延迟采样间隔（秒）
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class ClientCounters:
+    """Receive counters of one connection / 单个连接的接收计数"""
+
+    __slots__ = ("label", "messages", "bytes")
+
+    def __init__(self, label: str):
+        self.label = label
+        self.messages = 0
+        self.bytes = 0
+
+
+class Metrics:
+    """
+    In-process counters served at /metrics / /metrics 使用的进程内计数器
+
+    Only touched on the server loop. Counter objects are created per
+    connection; a message only bumps integers, it never allocates.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.clients = {}            # websocket -> ClientCounters
+        self.retired_messages = 0    # 已断开客户端的累计消息数
+        self.retired_bytes = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.rejected_paused = 0     # 同步暂停时被拒绝的文本
+        self.loop_lag = LatencyHistogram()
+
+    def client_connected(self, websocket) -> ClientCounters:
+        address = websocket.remote_address
+        label = f"{address[0]}:{address[1]}" if address else "unknown"
+        counters = ClientCounters(label)
+        self.clients[websocket] = counters
+        self.connects += 1
+        return counters
+
+    def client_disconnected(self, websocket):
+        counters = self.clients.pop(websocket, None)
+        if counters is not None:
+            self.retired_messages += counters.messages
+            self.retired_bytes += counters.bytes
+        self.disconnects += 1
+
+    def render(self) -> str:
+        """Prometheus text exposition format / Prometheus 文本格式"""
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, value in samples:
+                lines.append(f"{name}{suffix} {value}")
+
+        def histogram_samples(histogram: LatencyHistogram, labels: str = ""):
+            samples = []
+            cumulative = 0
+            for bound, count in zip(LatencyHistogram.BUCKETS_MS + ("+Inf",), histogram.counts):
+                cumulative += count
+                samples.append((f'_bucket{{{labels}le="{bound}"}}', cumulative))
+            suffix = f"{{{labels.rstrip(',')}}}" if labels else ""
+            samples.append((f"_sum{suffix}", round(histogram.sum_ms, 3)))
+            samples.append((f"_count{suffix}", histogram.total))
+            return samples
+
+        clients = list(self.clients.values())
+        discovery = state.discovery
+        metric("voicing_uptime_seconds", "gauge", "Seconds since the server started.",
+               [("", round(time.monotonic() - self.started, 3))])
+        metric("voicing_connected_clients", "gauge", "Phones currently connected.",
+               [("", len(state.connected_clients))])
+        metric("voicing_sync_enabled", "gauge", "1 if text from phones is being typed.",
+               [("", int(state.sync_enabled))])
+        metric("voicing_connections_total", "counter", "WebSocket connections accepted.",
+               [("", self.connects)])
+        metric("voicing_disconnections_total", "counter", "WebSocket connections closed.",
+               [("", self.disconnects)])
+        metric("voicing_messages_received_total", "counter",
+               "Frames received per connected client; closed connections are summed under client=disconnected.",
+               [(f'{{client="{c.label}"}}', c.messages) for c in clients]
+               + [('{client="disconnected"}', self.retired_messages)])
+        metric("voicing_bytes_received_total", "counter",
+               "Payload bytes received per connected client.",
+               [(f'{{client="{c.label}"}}', c.bytes) for c in clients]
+               + [('{client="disconnected"}', self.retired_bytes)])
+        metric("voicing_rejected_paused_total", "counter",
+               "Texts rejected because sync was paused.", [("", self.rejected_paused)])
+        metric("voicing_injection_queue_depth", "gauge", "Injection jobs waiting to be typed.",
+               [("", state.injector.queue_depth() if state.injector else 0)])
+        metric("voicing_text_latency_ms", "histogram",
+               "Text latency in ms by stage: queue, inject and total (received to ack).",
+               [sample for stage, histogram in state.latency.histograms.items()
+                for sample in histogram_samples(histogram, f'stage="{stage}",')])
+        metric("voicing_udp_broadcasts_total", "counter", "UDP discovery broadcasts sent.",
+               [("", discovery.broadcasts_sent if discovery else 0)])
+        metric("voicing_udp_queries_answered_total", "counter", "UDP discovery queries answered.",
+               [("", discovery.queries_answered if discovery else 0)])
+        metric("voicing_event_loop_lag_ms", "histogram", "Server event loop wake-up delay in ms.",
+               histogram_samples(self.loop_lag))
+        return "\n".join(lines) + "\n"
+
+
+state.metrics = Metrics()
+
+
+async def process_http_request(path: str, request_headers):
+    """
+    Answer plain HTTP on the WebSocket port / 在 WebSocket 端口上响应普通 HTTP 请求
+
+    `GET /metrics` returns Prometheus metrics and `GET /healthz` a liveness
+    check; any other request continues with the WebSocket handshake.
+    """
+    path = path.split("?", 1)[0]
+    if path == METRICS_PATH:
+        body = state.metrics.render().encode("utf-8")
+        return http.HTTPStatus.OK, [("Content-Type", METRICS_CONTENT_TYPE)], body
+    if path == HEALTH_PATH:
+        healthy = state.running and state.injector is not None and state.injector.is_alive()
+        status = http.HTTPStatus.OK if healthy else http.HTTPStatus.SERVICE_UNAVAILABLE
+        return status, [("Content-Type", "text/plain")], b"ok\n" if healthy else b"unhealthy\n"
+    return None
+
+
+async def monitor_loop_lag():
+    """Sample how late the server loop wakes up / 采样服务器事件循环的唤醒延迟"""
+    while state.running:
+        expected = time.monotonic() + LOOP_LAG_INTERVAL
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        state.metrics.loop_lag.observe(max(0.0, time.monotonic() - expected) * 1000)
+
+
+# ============================================================
+# Session Recorder / 会话录制
+# ============================================================
+# Append-only binary log (--record FILE): a magic header, then one record
+# per event: direction, frame kind, connection id, monotonic timestamp and
+# payload length, followed by the payload. It contains everything the
+# phones dictated, so it is only written on request.
+# 追加写入的二进制日志：每条记录包含方向、帧类型、连接号、单调时间戳和长度。
+RECORD_MAGIC = b"VCREC\x01"
+_RECORD_HEADER = struct.Struct("<BBIdI")  # 方向、帧类型、连接号、时间戳、长度
+RECORD_BUFFER_SIZE = 64 * 1024  # 写缓冲区，连接断开和退出时刷新
+REC_IN = 0      # 手机 -> PC
+REC_OUT = 1     # PC -> 手机
+REC_OPEN = 2    # 连接建立，内容为客户端地址
+REC_CLOSE = 3   # 连接断开
+REC_INJECT = 4  # 注入后端输入的文本
+REC_KEYS = 5    # 注入后端按下的按键，按换行分隔
+REC_TEXT = 0    # 文本帧
+REC_BINARY = 1  # 二进制帧
+
+
+class SessionRecorder:
+    """
+    Write WebSocket frames and injections to a recording / 将 WebSocket 帧和注入写入录制文件
+
+    Frames are recorded on the server loop, injections on the injection
+    worker; a lock keeps records whole. Writes land in a 64 KiB buffer, so
+    recording costs no system call per frame.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._file = open(path, "ab", buffering=RECORD_BUFFER_SIZE)
+        if self._file.tell() == 0:
+            self._file.write(RECORD_MAGIC)
+        atexit.register(self.close)
+
+    def write(self, direction: int, conn: int, payload=b""):
+        """Append one record / 追加一条记录"""
+        if isinstance(payload, str):
+            kind, payload = REC_TEXT, payload.encode("utf-8")
         else:
-            painter.setBrush(Qt.transparent)
-
-        painter.setPen(Qt.NoPen)
-        painter.drawRoundedRect(rect, 4, 4)  # 4px 圆角
-
-    def enterEvent(self, event):
-        """鼠标进入 - 显示高亮"""
-        self._hovered = True
-        self.update()
-        super().enterEvent(event)
-
-    def leaveEvent(self, event):
-        """鼠标离开 - 恢复正常"""
-        self._hovered = False
-        self.update()
-        super().leaveEvent(event)
-
-    def update_toggle_status(self, checked):
-        """更新开关状态 - 使用现代化的开关指示器"""
-        self.is_checked = checked
-        if checked:
-            self.status_label.setText("✓")
-            self.status_label.setStyleSheet("""
-                QLabel {
-                    color: #60CDFF;
-                    font-family: 'Segoe UI', 'Microsoft YaHei UI', sans-serif;
-                    font-size: 14px;
-                    font-weight: bold;
-                    background: transparent;
-                }
-            """)
+            kind = REC_BINARY
+        header = _RECORD_HEADER.pack(direction, kind, conn, time.monotonic(), len(payload))
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(header)
+            self._file.write(payload)
+
+    def attach(self, websocket) -> int:
+        """
+        Record a new connection's frames / 开始录制一个连接
+
+        Returns its connection id. Outgoing frames are caught by wrapping
+        the connection's `send`, which every reply and broadcast goes
+        through.
+        """
+        conn = next(self._ids)
+        host, port = (websocket.remote_address or ("", 0))[:2]
+        self.write(REC_OPEN, conn, f"{host}:{port}")
+        send = websocket.send
+
+        async def recorded_send(message):
+            self.write(REC_OUT, conn, message)
+            await send(message)
+
+        websocket.send = recorded_send
+        return conn
+
+    def detach(self, conn: int):
+        """Mark a connection closed and flush / 标记连接断开并刷新"""
+        self.write(REC_CLOSE, conn)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class RecordingBackend(InjectionBackend):
+    """Injection backend wrapper that records its input / 记录输入内容的注入后端包装"""
+
+    def __init__(self, backend: InjectionBackend, recorder: SessionRecorder):
+        self.backend = backend
+        self.recorder = recorder
+        self.name = backend.name
+
+    def inject(self, text: str):
+        self.recorder.write(REC_INJECT, 0, text)
+        self.backend.inject(text)
+
+    def press_keys(self, keys: tuple):
+        self.recorder.write(REC_KEYS, 0, "\n".join(keys))
+        self.backend.press_keys(keys)
+
+
+def read_recording(path: Path):
+    """
+    Yield (direction, conn, timestamp, payload) from a recording / 读取录制文件
+
+    Text payloads are str, binary frames bytes. A record cut short by a
+    crash ends the iteration.
+    """
+    with open(path, "rb") as f:
+        if f.read(len(RECORD_MAGIC)) != RECORD_MAGIC:
+            raise ValueError(f"not a Voicing recording: {path}")
+        while True:
+            header = f.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            direction, kind, conn, timestamp, length = _RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if kind == REC_TEXT:
+                payload = payload.decode("utf-8", errors="replace")
+            yield direction, conn, timestamp, payload
+
+
+# ============================================================
+# Injection Worker / 输入注入工作线程
+# ============================================================
+class InjectionCancelled(Exception):
+    """A queued injection was cancelled by the client / 排队中的注入已被取消"""
+
+
+class UndoRequest:
+    """
+    Injection job that removes the client's last injections / 撤销客户端最近注入的任务
+
+    `pending` is the length of an open `replace` buffer, which is not in the
+    history yet; it is erased first and counts as one step.
+    """
+
+    def __init__(self, count: int = 1, pending: int = 0):
+        self.count = count
+        self.pending = pending  # 未提交的 replace 缓冲区字素数
+
+
+class ReplaceEdit:
+    """
+    Injection job that corrects the end of a `replace` buffer.
+    修正 replace 缓冲区末尾的注入任务。
+
+    Erases `erase` graphemes, then types `text` verbatim (no text rules, or
+    the server's copy of the buffer would no longer match the screen). A
+    committed buffer is recorded in the undo history as one injection.
+    """
+
+    def __init__(self, erase: int, text: str, committed: int = 0):
+        self.erase = erase
+        self.text = text
+        self.committed = committed  # 提交时整个缓冲区的字素数，0 表示未提交
+
+
+class InjectionWorker:
+    """
+    Dedicated thread that performs text injection, fairly across clients.
+    专用输入线程：按客户端公平调度文本注入，避免阻塞 asyncio 事件循环。
+
+    `type_text` blocks on the clipboard, the Ctrl+V keystroke and the restore
+    delay, so it must never run on the WebSocket loop. Coroutines call
+    `submit()` and await the returned future, which resolves on their own loop
+    once the paste has actually completed.
+
+    Each client has its own FIFO queue. Clients with pending jobs take turns
+    one job (one merged batch) at a time, so a long paste from one phone does
+    not hold back the others and each phone's text keeps its order. A client
+    holding the floor (`grant_floor()`) is served exclusively until its lease
+    expires or it releases the floor.
+
+    The length of every message typed is remembered per client (at most
+    HISTORY_LIMIT entries each), so an `UndoRequest` job can erase the last
+    ones with backspaces: the chunks of one long text add up to one entry,
+    the frames of a merged batch get one entry each. The history is only
+    touched on the worker thread.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._history = {}    # client -> deque[[消息键, 已输入字符数]]，仅工作线程访问
+        self._queues = {}     # client -> deque[(client, text, loop, future, token, message)]
+        self._ring = deque()  # 有待处理任务的客户端，按轮转顺序
+        self._floor = None    # (client, expires_at)：独占输入权
+        self._stopping = False
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the worker thread / 启动工作线程"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="InjectionWorker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop after the queued jobs are done / 处理完队列中的任务后停止"""
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def queue_depth(self) -> int:
+        """Jobs waiting, not counting the one being typed / 等待中的任务数"""
+        with self._cond:
+            return sum(len(jobs) for jobs in self._queues.values())
+
+    def submit(self, text: str, client=None, token=None, message=None) -> asyncio.Future:
+        """
+        Queue text for injection / 将文本加入注入队列
+
+        Must be called from a running event loop. `text` may also be a tuple
+        of key names from a `keys` message, a `ReplaceEdit`, or an
+        `UndoRequest`, whose future resolves to (start, end, characters
+        removed). `client` is any
+        hashable key identifying the sender (one queue per key). If `token.cancelled`
+        is true when the job comes up, it is skipped and the future fails
+        with InjectionCancelled. The returned future resolves to the
+        (start, end) monotonic timestamps of the injection.
+
+        `message` groups jobs in the undo history: jobs with the same key in
+        a row (the chunks of one stream) are one entry; a tuple holds the
+        texts of the frames merged into `text`, one entry each.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        with self._cond:
+            jobs = self._queues.setdefault(client, deque())
+            if not jobs:
+                self._ring.append(client)
+            jobs.append((client, text, loop, future, token, message))
+            self._cond.notify()
+        return future
+
+    def grant_floor(self, client, lease: float) -> Optional[float]:
+        """
+        Give `client` exclusive input for `lease` seconds / 授予独占输入权
+
+        Renews the lease if `client` already holds the floor. Returns the
+        granted lease, or None if another client holds it. A non-finite
+        lease falls back to FLOOR_LEASE.
+        """
+        if not math.isfinite(lease):
+            lease = FLOOR_LEASE
+        lease = min(max(lease, 0.0), FLOOR_MAX_LEASE)
+        with self._cond:
+            now = time.monotonic()
+            holder = self._floor_holder(now)
+            if holder is not None and holder != client:
+                return None
+            self._floor = (client, now + lease)
+            self._cond.notify()
+            return lease
+
+    def release_floor(self, client):
+        """Release the floor if `client` holds it / 释放独占输入权"""
+        with self._cond:
+            if self._floor is not None and self._floor[0] == client:
+                self._floor = None
+                self._cond.notify()
+
+    def floor_remaining(self, client) -> float:
+        """Seconds left on `client`'s lease (0 if not holder) / 剩余租期"""
+        with self._cond:
+            now = time.monotonic()
+            if self._floor_holder(now) != client or self._floor is None:
+                return 0.0
+            return self._floor[1] - now
+
+    def _floor_holder(self, now: float):
+        if self._floor is not None and self._floor[1] <= now:
+            self._floor = None
+        return self._floor[0] if self._floor is not None else None
+
+    def _take(self, client):
+        """Pop the client's next job and rotate it to the back / 取出任务并轮转"""
+        jobs = self._queues[client]
+        job = jobs.popleft()
+        self._ring.remove(client)
+        if jobs:
+            self._ring.append(client)
         else:
-            self.status_label.setText("")
-            self.status_label.setStyleSheet("background: transparent;")
-
-    def mousePressEvent(self, event):
-        """鼠标点击事件"""
-        self.clicked.emit()
-        super().mousePressEvent(event)
-
-
-class ModernMenuWidget(QWidget):
-    """Windows 11 Fluent Design 风格的自定义菜单窗口"""
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        self.setWindowFlags(Qt.FramelessWindowHint | Qt.Popup | Qt.NoDropShadowWindowHint)
-        self.setAttribute(Qt.WA_TranslucentBackground)
-
-        # 动画相关
-        self.animation_step = 0
-        self.animation_max_steps = 10  # 约 160ms - 更快更流畅
-        self.animation_timer = QTimer()
-        self.animation_timer.timeout.connect(self.update_animation)
-
-        self.setup_ui()
-
-    def setup_ui(self):
-        """设置 UI - Windows 11 Fluent Design"""
-        layout = QVBoxLayout(self)
-        layout.setContentsMargins(8, 8, 8, 8)  # 阴影边距
-        layout.setSpacing(0)
-
-        # 主容器 - 使用深色半透明背景
-        self.container = QWidget()
-        self.container.setObjectName("menuContainer")
-        self.container.setStyleSheet("""
-            #menuContainer {
-                background-color: rgba(32, 32, 32, 245);
-                border: 1px solid rgba(255, 255, 255, 0.08);
-                border-radius: 8px;
+            del self._queues[client]
+        return job
+
+    def _record(self, client, typed: int, message=None):
+        """Remember an injection's length for undo / 记录注入长度用于撤销"""
+        history = self._history.pop(client, None)
+        if history is None:
+            history = deque(maxlen=HISTORY_LIMIT)
+            if len(self._history) >= SESSION_LIMIT:
+                # Forget the least recently active client / 丢弃最久未活动客户端的历史
+                del self._history[next(iter(self._history))]
+        self._history[client] = history
+        if isinstance(message, tuple):
+            # Merged frames, one entry each unless text rules changed the
+            # length / 合并的多帧各占一条，文本规则改变长度时合为一条
+            lengths = [count_graphemes(part) for part in message]
+            if sum(lengths) == typed:
+                history.extend([None, length] for length in lengths if length)
+                return
+            message = None
+        if message is not None and history and history[-1][0] == message:
+            # Next chunk of the same message / 同一消息的后续分块
+            history[-1][1] += typed
+        else:
+            history.append([message, typed])
+
+    def _undo(self, client, count: int, pending: int = 0) -> int:
+        """Erase the client's last `count` injections / 删除客户端最近的若干次注入"""
+        history = self._history.get(client)
+        removed = pending
+        if pending:
+            count -= 1
+        while history and count > 0:
+            removed += history.pop()[1]
+            count -= 1
+        if removed:
+            press_keys(("backspace",) * removed)
+        return removed
+
+    def _next_job(self):
+        """Block until a job may run; None once stopped and drained / 等待下一个可执行任务"""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                holder = None if self._stopping else self._floor_holder(now)
+                if holder is not None:
+                    # Others wait until the lease ends / 其他客户端等待租期结束
+                    if self._queues.get(holder):
+                        return self._take(holder)
+                    self._cond.wait(self._floor[1] - now)
+                elif self._ring:
+                    return self._take(self._ring[0])
+                elif self._stopping:
+                    return None
+                else:
+                    self._cond.wait()
+
+    def _run(self):
+        try:
+            get_injection_backend()
+        except InjectionUnavailable:
+            # Logged; every job now fails with it / 已记录，之后的任务都会返回该错误
+            pass
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            client, payload, loop, future, token, message = job
+            error = None
+            removed = None
+            started = time.monotonic()
+            try:
+                if token is not None and token.cancelled:
+                    raise InjectionCancelled()
+                if isinstance(payload, UndoRequest):
+                    removed = self._undo(client, payload.count, payload.pending)
+                elif isinstance(payload, ReplaceEdit):
+                    if payload.erase:
+                        press_keys(("backspace",) * payload.erase)
+                    type_text(payload.text, rules=False)
+                    if payload.committed:
+                        self._record(client, payload.committed)
+                else:
+                    typed = press_keys(payload) if isinstance(payload, tuple) else type_text(payload)
+                    if typed:
+                        self._record(client, typed, message)
+            except Exception as e:
+                error = e
+            finished = time.monotonic()
+            result = (started, finished) if removed is None else (started, finished, removed)
+            try:
+                loop.call_soon_threadsafe(_resolve_injection, future, error, result)
+            except RuntimeError:
+                # Event loop already closed / 事件循环已关闭
+                pass
+
+
+def _resolve_injection(future: asyncio.Future, error: Optional[BaseException], result=None):
+    """Complete an injection future on its own loop / 在所属事件循环中完成注入 future"""
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(result)
+
+
+class TextBatcher:
+    """
+    Coalesce consecutive text frames from one client into a single injection.
+    合并同一客户端在短时间窗口内连续到达的文本帧，只执行一次粘贴。
+
+    In auto-send mode the phone commits many small phrases in quick succession;
+    each paste costs a full clipboard round trip, so frames arriving within
+    `window` seconds of the first pending one are joined and injected together.
+    Every original frame still gets its own future, resolved when the merged
+    injection completes.
+    """
+
+    def __init__(self, injector: InjectionWorker, window: float, client=None):
+        self._injector = injector
+        self._window = window
+        self._client = client  # 注入队列的客户端键
+        self._parts = []
+        self._chars = 0
+        self._waiters = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    def add(self, text: str) -> asyncio.Future:
+        """Add a text frame to the current batch / 将文本帧加入当前批次"""
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self._parts.append(text)
+        self._chars += len(text)
+        self._waiters.append(waiter)
+
+        if self._window <= 0 or self._chars >= TEXT_BATCH_MAX_CHARS:
+            self.flush()
+        elif self._flush_handle is None:
+            # The window starts at the first pending frame, so no frame waits
+            # longer than `window` / 窗口从第一帧开始计时，单帧最多等待一个窗口
+            self._flush_handle = loop.call_later(self._window, self.flush)
+        return waiter
+
+    def rebind(self, client):
+        """Flush, then queue under another client key / 输入待合并文本后切换客户端键"""
+        self.flush()
+        self._client = client
+
+    def flush(self):
+        """Inject everything pending now / 立即输入所有待合并文本"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._parts:
+            return
+
+        parts = self._parts
+        text = "".join(parts)
+        waiters = self._waiters
+        self._parts = []
+        self._chars = 0
+        self._waiters = []
+
+        # Frames stay separate undo steps / 每帧仍是独立的撤销步骤
+        done = self._injector.submit(text, self._client, message=tuple(parts) if len(parts) > 1 else None)
+        done.add_done_callback(lambda f: _complete_batch(f, waiters))
+
+
+def _complete_batch(done: asyncio.Future, waiters: list):
+    """Propagate a merged injection result to each frame / 将合并注入结果分发给每一帧"""
+    if done.cancelled():
+        error, result = asyncio.CancelledError(), None
+    else:
+        error = done.exception()
+        result = None if error else done.result()
+    for waiter in waiters:
+        _resolve_injection(waiter, error, result)
+
+
+# ============================================================
+# Protocol v2 / 协议 v2
+# ============================================================
+# Binary frame layout (v2, opt-in via `hello`) / 二进制帧格式
+#   phone -> PC  text: 0x01 | seq (uint32 BE) | UTF-8 text
+#   PC -> phone  ack:  0x81 | cumulative seq (uint32 BE)
+BIN_TEXT = 0x01
+BIN_ACK = 0x81
+_BIN_HEADER = struct.Struct(">BI")
+
+PROTOCOL_FEATURES = ["seq", "binary", "stream", "keys", "undo", "replace"]
+
+# Builders of constant control frames, keyed by kind / 固定控制帧构造器
+_CONTROL_FRAMES = {
+    "connected": lambda sync_enabled: {
+        "type": "connected",
+        "message": "Connected to Voicing server",
+        "sync_enabled": sync_enabled,
+        "computer_name": socket.gethostname(),
+        "protocol": PROTOCOL_VERSION,
+        "features": PROTOCOL_FEATURES,
+    },
+    "pong": lambda sync_enabled: {
+        "type": "pong",
+        "sync_enabled": sync_enabled,
+    },
+    "sync_state": lambda sync_enabled: {
+        "type": "sync_state",
+        "sync_enabled": sync_enabled,
+    },
+    "sync_disabled": lambda sync_enabled: {
+        "type": "sync_disabled",
+        "message": "Sync is disabled on PC",
+    },
+}
+_frame_cache = {}
+
+
+def control_frame(kind: str) -> str:
+    """
+    Pre-serialized control frame for the current sync state.
+    当前同步状态下预先序列化的控制帧。
+
+    These frames only depend on `sync_enabled`, so each variant is encoded
+    once instead of calling json.dumps on every ping.
+    """
+    key = (kind, state.sync_enabled)
+    frame = _frame_cache.get(key)
+    if frame is None:
+        frame = _frame_cache[key] = json.dumps(_CONTROL_FRAMES[kind](state.sync_enabled))
+    return frame
+
+
+def encode_binary_ack(seq: int) -> bytes:
+    """Compact cumulative ack / 紧凑二进制累计确认"""
+    return _BIN_HEADER.pack(BIN_ACK, seq & 0xFFFFFFFF)
+
+
+def decode_binary_text(message: bytes) -> Optional[tuple]:
+    """Decode a binary text frame into (seq, text) / 解码二进制文本帧"""
+    if len(message) < _BIN_HEADER.size or message[0] != BIN_TEXT:
+        return None
+    _, seq = _BIN_HEADER.unpack_from(message)
+    return seq, message[_BIN_HEADER.size:].decode("utf-8", errors="replace")
+
+
+class ThresholdDeflate(PerMessageDeflate):
+    """
+    permessage-deflate that leaves small messages uncompressed.
+    只压缩较大消息的 permessage-deflate。
+
+    RFC 7692 lets each message choose whether to set RSV1, so acks and pongs
+    of a few dozen bytes skip zlib entirely while long texts still benefit.
+    """
+
+    def __init__(self, *args, min_size: int = COMPRESSION_MIN_SIZE, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_size = min_size
+
+    def encode(self, frame):
+        # Only complete messages are skipped; fragmented ones are always
+        # compressed so continuation frames stay consistent
+        # 只跳过完整的小消息，分片消息始终压缩以保持续帧一致
+        if (frame.opcode not in CTRL_OPCODES and frame.opcode != Opcode.CONT
+                and frame.fin and len(frame.data) < self.min_size):
+            return frame
+        return super().encode(frame)
+
+
+class CountingServerProtocol(WebSocketServerProtocol):
+    """
+    Server protocol that counts received payload bytes / 统计接收字节数的服务器协议
+
+    Each data frame's length is known before it is decoded to str, so
+    /metrics gets the byte count without re-encoding every message.
+    """
+
+    received_bytes = 0  # 已接收的数据帧负载字节数
+
+    async def read_frame(self, max_size):
+        frame = await super().read_frame(max_size)
+        if frame.opcode not in CTRL_OPCODES:
+            self.received_bytes += len(frame.data)
+        return frame
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiate permessage-deflate with a size threshold / 协商带阈值的压缩扩展"""
+
+    def __init__(self, min_size: int, **kwargs):
+        super().__init__(**kwargs)
+        self.min_size = min_size
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            min_size=self.min_size,
+        )
+
+
+def server_extensions() -> list:
+    """WebSocket extensions offered by the server / 服务器提供的扩展"""
+    if state.compression_min_size < 0:
+        return []
+    # Same defaults as websockets' own server-side deflate
+    # 与 websockets 默认的服务器端压缩参数一致
+    return [ThresholdDeflateFactory(
+        state.compression_min_size,
+        server_max_window_bits=12,
+        compress_settings={"memLevel": 5},
+    )]
+
+
+# ============================================================
+# Client Sessions / 客户端会话
+# ============================================================
+class SequencedText:
+    """A sequence-numbered text frame / 带序号的文本帧"""
+
+    __slots__ = ("seq", "text", "msg_id", "received_at")
+
+    def __init__(self, seq: int, text: str, msg_id, received_at: float):
+        self.seq = seq
+        self.text = text
+        self.msg_id = msg_id
+        self.received_at = received_at
+
+
+class ClientSession:
+    """
+    Sequence state of one phone / 单个手机的序号状态
+
+    Text frames carrying `seq` are delivered to the injector strictly in
+    sequence order exactly once: retransmitted frames (seq already accepted)
+    are dropped, frames that arrive ahead of a gap wait in a small reorder
+    buffer. Completed frames are acknowledged cumulatively with the highest
+    contiguous seq that has been typed, coalescing everything that finished
+    in the same loop iteration into one `ack`.
+
+    Sessions identified by a `hello` client_id survive reconnects, so a phone
+    can resend everything it has not seen acked without double-typing.
+
+    Every session also has a `resume_token`, sent in `connected`/`session`,
+    that lets a phone without a client id reattach after a drop. Frames that
+    could not be delivered while the phone was away are kept in an outbox
+    and replayed once on resume.
+
+    The session is also the injection queue and floor key, so text resent
+    over a resumed connection queues behind what the old one left.
+    """
+
+    def __init__(self, client_id: Optional[str] = None):
+        self.client_id = client_id
+        self.websocket = None
+        self.address = None     # 当前 / 最后一个连接的地址
+        self.resume_token = secrets.token_urlsafe(16)
+        self.disconnected_at: Optional[float] = None
+        self._outbox = deque(maxlen=RESUME_OUTBOX_LIMIT)
+        self._sends = set()     # 进行中的发送任务，保持引用直到完成
+        self.revision = 0       # 最近应用的 replace 版本号
+        self.buffer = ""        # replace 缓冲区在 PC 上已输入（或已排队）的内容
+        self.protocol = 1       # 当前连接协商的协议版本
+        self.binary = False     # 当前连接是否使用二进制 ack
+        self.accepted_seq = 0   # 已交给注入线程的最大连续序号
+        self.completed_seq = 0  # 已输入完成的最大连续序号
+        self.last_seen = time.monotonic()
+        self._reorder = {}
+        self._done_ahead = set()  # 已完成但前面还有未完成帧的序号
+        self._completed = []
+        self._ack_scheduled = False
+
+    def reset(self):
+        """Start a new sequence from 1 / 序号从 1 重新开始"""
+        self.accepted_seq = 0
+        self.completed_seq = 0
+        self._reorder.clear()
+        self._done_ahead.clear()
+        # The phone's replace revisions restart too / 手机的修正版本号同样从头开始
+        self.revision = 0
+        self.buffer = ""
+
+    def accept(self, frame: SequencedText) -> Optional[list]:
+        """
+        Accept a frame / 接收一帧
+
+        Returns the frames that are now deliverable in order (possibly empty
+        when the frame fills no gap yet), or None for a duplicate.
+        """
+        self.last_seen = time.monotonic()
+        if frame.seq <= self.accepted_seq or frame.seq in self._reorder:
+            return None
+        if frame.seq != self.accepted_seq + 1:
+            if len(self._reorder) < SEQ_REORDER_LIMIT:
+                self._reorder[frame.seq] = frame
+            # Beyond the limit the phone simply retransmits / 超出上限时由手机重传
+            return []
+
+        ready = [frame]
+        self.accepted_seq = frame.seq
+        while self.accepted_seq + 1 in self._reorder:
+            self.accepted_seq += 1
+            ready.append(self._reorder.pop(self.accepted_seq))
+        return ready
+
+    def complete(self, frame: SequencedText, done: Optional[asyncio.Future] = None):
+        """Mark a frame as typed and schedule the cumulative ack / 标记已输入并安排累计确认"""
+        timing = None
+        if done is not None and not done.cancelled():
+            if done.exception() is not None:
+                # Still advance so one failure cannot stall the sequence
+                # 失败也推进序号，避免一帧失败卡住后续所有帧
+                logging.error(f"文本输入失败 (seq={frame.seq}): {done.exception()}")
+                self.send(json.dumps({"type": "error", "id": frame.msg_id, "seq": frame.seq,
+                                      "message": str(done.exception())}))
+            else:
+                timing = done.result()
+        # Only a contiguous run is acked: a frame that finishes early (e.g.
+        # empty text) must not cover earlier ones still being typed
+        # 只确认连续完成的序号：提前完成的帧不能覆盖前面仍在输入的帧
+        if frame.seq > self.completed_seq:
+            self._done_ahead.add(frame.seq)
+        while self.completed_seq + 1 in self._done_ahead:
+            self.completed_seq += 1
+            self._done_ahead.remove(self.completed_seq)
+        self._completed.append((frame, timing))
+        if not self._ack_scheduled:
+            self._ack_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush_ack)
+
+    def _flush_ack(self):
+        self._ack_scheduled = False
+        completed, self._completed = self._completed, []
+        if not completed:
+            return
+
+        acked_at = time.monotonic()
+        last_frame, last_timing = completed[-1]
+        for frame, timing in completed:
+            if timing is not None:
+                state.latency.record(frame.received_at, timing[0], timing[1], acked_at)
+                log_text_event(self.client_id, frame.received_at, timing, acked_at,
+                               seq=frame.seq, id=frame.msg_id, chars=len(frame.text))
+
+        if self.binary:
+            self.send(encode_binary_ack(self.completed_seq))
+            return
+
+        ack = {
+            "type": "ack",
+            "message": "Text received and typed",
+            "seq": self.completed_seq,
+            "ids": [frame.msg_id for frame, _ in completed if frame.msg_id is not None],
+        }
+        if last_frame.msg_id is not None:
+            ack["id"] = last_frame.msg_id
+        if last_timing is not None:
+            ack["timing"] = {
+                "recv": trace_ms(last_frame.received_at),
+                "inject_start": trace_ms(last_timing[0]),
+                "inject_end": trace_ms(last_timing[1]),
+                "ack": trace_ms(acked_at),
             }
-        """)
-        container_layout = QVBoxLayout(self.container)
-        container_layout.setContentsMargins(4, 6, 4, 6)  # 内边距
-        container_layout.setSpacing(2)  # 项间距
-
-        # 同步输入
-        self.sync_btn = MenuItemWidget("📡", "同步输入", has_toggle=True, is_checked=True)
-        self.sync_btn.clicked.connect(self.toggle_sync)
-        container_layout.addWidget(self.sync_btn)
-
-        # 开机自启
-        self.startup_btn = MenuItemWidget("🚀", "开机自启", has_toggle=True, is_checked=False)
-        self.startup_btn.clicked.connect(self.toggle_startup)
-        container_layout.addWidget(self.startup_btn)
-
-        # 分隔线
-        separator1 = QWidget()
-        separator1.setFixedHeight(1)
-        separator1.setStyleSheet("background-color: rgba(255, 255, 255, 0.08); margin: 4px 8px;")
-        container_layout.addWidget(separator1)
-
-        # 打开日志
-        log_btn = MenuItemWidget("📋", "打开日志")
-        log_btn.clicked.connect(self.open_log)
-        container_layout.addWidget(log_btn)
-
-        # 分隔线
-        separator2 = QWidget()
-        separator2.setFixedHeight(1)
-        separator2.setStyleSheet("background-color: rgba(255, 255, 255, 0.08); margin: 4px 8px;")
-        container_layout.addWidget(separator2)
-
-        # 退出应用
-        quit_btn = MenuItemWidget("🚪", "退出应用")
-        quit_btn.clicked.connect(self.quit_app)
-        container_layout.addWidget(quit_btn)
-
-        layout.addWidget(self.container)
-
-        # 设置阴影
-        self.set_shadow_effect()
-
-        # 更新初始状态
-        QTimer.singleShot(0, self.update_state)
-
-    def set_shadow_effect(self):
-        """设置阴影效果 - Windows 11 风格的柔和阴影"""
-        shadow = QGraphicsDropShadowEffect()
-        shadow.setBlurRadius(24)
-        shadow.setColor(QColor(0, 0, 0, 100))
-        shadow.setOffset(0, 4)
-        self.container.setGraphicsEffect(shadow)
-
-    def show_at_position(self, tray_pos):
-        """在指定位置显示菜单（菜单左下角对齐鼠标点击位置）"""
-        # 获取菜单尺寸
-        self.adjustSize()
-        menu_height = self.height()
-
-        # 菜单左下角对齐鼠标点击位置
-        x = tray_pos.x() - 8  # 向左偏移一点，让菜单边缘靠近鼠标
-        y = tray_pos.y() - menu_height  # 菜单底部对齐鼠标位置
-
-        self.target_y = y
-        self.move(x, y)
-
-        # 从下往上滑出的动画
-        self.animation_step = 0
-        self.move(x, y + 16)  # 从下方开始
-        self.setWindowOpacity(0.0)
-        self.show()
-        self.animation_timer.start(16)  # 60fps
-
-    def update_animation(self):
-        """更新滑入动画"""
-        self.animation_step += 1
-
-        if self.animation_step >= self.animation_max_steps:
-            # 动画结束
-            self.animation_timer.stop()
-            self.move(self.pos().x(), self.target_y)
-            self.setWindowOpacity(1.0)
+        self.send(json.dumps(ack))
+
+    def attach(self, websocket):
+        """Bind the session to a connection / 将会话绑定到连接"""
+        self.websocket = websocket
+        self.address = websocket.remote_address
+        self.disconnected_at = None
+        self.last_seen = time.monotonic()
+
+    def detach(self, websocket):
+        """Unbind a closed connection unless already resumed elsewhere / 连接关闭时解绑"""
+        if self.websocket is websocket:
+            self.websocket = None
+            self.disconnected_at = time.monotonic()
+
+    def send(self, frame):
+        """
+        Send a frame to the session's current connection / 发送到会话当前连接
+
+        Without a connection, or if the connection turns out to be closed,
+        the frame goes to the outbox for `replay()`.
+        """
+        if self.websocket is None:
+            self._outbox.append(frame)
+            return
+        task = asyncio.create_task(self._send(self.websocket, frame))
+        self._sends.add(task)
+        task.add_done_callback(self._sends.discard)
+
+    async def _send(self, websocket, frame):
+        try:
+            await websocket.send(frame)
+        except websockets.exceptions.ConnectionClosed:
+            self._outbox.append(frame)
+        except Exception as e:
+            logging.error(f"发送失败 ({self.client_id}): {e}")
+
+    def replay(self) -> int:
+        """Resend undelivered frames once, in order / 按顺序补发一次未送达的帧"""
+        frames = list(self._outbox)
+        self._outbox.clear()
+        for frame in frames:
+            self.send(frame)
+        return len(frames)
+
+    def resumable(self, now: float) -> bool:
+        return self.disconnected_at is None or now - self.disconnected_at < RESUME_TTL
+
+
+def _evict_oldest(sessions: dict):
+    """
+    Drop the least recently seen disconnected session / 淘汰最久未活动的已断开会话
+
+    Sessions still bound to a connection are never evicted; if every one
+    is, the limit is exceeded until a phone disconnects.
+    """
+    idle = [item for item in sessions.items() if item[1].websocket is None]
+    if idle:
+        key, _ = min(idle, key=lambda item: item[1].last_seen)
+        del sessions[key]
+
+
+def new_session(client_id: Optional[str] = None) -> ClientSession:
+    """Create a session and register its resume token / 创建会话并登记恢复令牌"""
+    now = time.monotonic()
+    for token, session in list(state.resume_sessions.items()):
+        if not session.resumable(now):
+            del state.resume_sessions[token]
+    if len(state.resume_sessions) >= SESSION_LIMIT:
+        _evict_oldest(state.resume_sessions)
+    session = ClientSession(client_id)
+    state.resume_sessions[session.resume_token] = session
+    return session
+
+
+def get_session(client_id: str) -> ClientSession:
+    """Find or create the session of a client id / 获取或创建客户端会话"""
+    session = state.sessions.get(client_id)
+    if session is None:
+        if len(state.sessions) >= SESSION_LIMIT:
+            _evict_oldest(state.sessions)
+        session = new_session(client_id)
+        state.sessions[client_id] = session
+    return session
+
+
+def find_resumable(token: str) -> Optional[ClientSession]:
+    """Session of a resume token, if it has not expired / 查找未过期的可恢复会话"""
+    session = state.resume_sessions.get(token)
+    if session is None or not session.resumable(time.monotonic()):
+        return None
+    return session
+
+
+def submit_sequenced_text(session: ClientSession, batcher: "TextBatcher", frame: SequencedText):
+    """Queue a sequenced frame, dropping duplicates / 提交带序号的文本帧（丢弃重复帧）"""
+    ready = session.accept(frame)
+    if ready is None:
+        # Already typed or in flight: re-ack what is done so the phone can
+        # drop it / 重复帧：回复当前累计确认，让手机停止重传
+        if session.binary:
+            session.send(encode_binary_ack(session.completed_seq))
         else:
-            # 缓动
-            progress = self.animation_step / self.animation_max_steps
-            eased = 1 - pow(1 - progress, 2)  # easeOutQuad
-
-            # 从下往上滑
-            current_y = self.target_y + 16 * (1 - eased)
-            self.move(self.pos().x(), int(current_y))
-
-            # 淡入
-            self.setWindowOpacity(min(1.0, eased * 1.5))
-
-    def update_state(self):
-        """更新菜单状态"""
-        self.sync_btn.update_toggle_status(state.sync_enabled)
-        self.startup_btn.update_toggle_status(is_startup_enabled())
-
-    def toggle_sync(self):
-        """切换同步状态"""
-        new_state = not self.sync_btn.is_checked
-        state.sync_enabled = new_state
-        self.sync_btn.update_toggle_status(new_state)
-        # 更新托盘图标
-        if state.tray_icon:
-            update_tray_icon_pyqt(state.tray_icon)
-        self.close_with_animation()
-        # 广播同步状态
-        def send_sync_state():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(broadcast_sync_state())
-            loop.close()
-        threading.Thread(target=send_sync_state, daemon=True).start()
-
-    def toggle_startup(self):
-        """切换开机自启"""
-        new_state = not self.startup_btn.is_checked
-        set_startup_enabled(new_state)
-        self.startup_btn.update_toggle_status(new_state)
-        self.close_with_animation()
-
-    def open_log(self):
-        """打开日志文件"""
-        self.close_with_animation()
-        if state.log_file and state.log_file.exists():
-            # 用默认文本编辑器打开日志文件
-            subprocess.Popen(['notepad.exe', str(state.log_file)])
+            session.send(json.dumps({
+                "type": "ack",
+                "seq": session.completed_seq,
+                "duplicate": frame.seq,
+            }))
+        return
+    for ready_frame in ready:
+        if ready_frame.text:
+            done = batcher.add(ready_frame.text)
+            done.add_done_callback(lambda f, fr=ready_frame: session.complete(fr, f))
         else:
-            # 打开日志目录
-            log_dir = Path(os.environ.get('APPDATA', Path.home())) / 'Voicing' / 'logs'
-            log_dir.mkdir(parents=True, exist_ok=True)
-            os.startfile(str(log_dir))
-
-    def quit_app(self):
-        """退出应用"""
-        state.running = False
-        QApplication.quit()
-
-    def close_with_animation(self):
-        """关闭动画"""
-        self.animation_timer.stop()
-        self.close()
-
-
-class ModernTrayIcon(QSystemTrayIcon):
-    """现代托盘图标"""
-
-    def __init__(self, parent=None):
-        super().__init__(parent)
-        # 预先缓存图标
-        self._icon_cache = {}
-        self._init_icon_cache()
-        # 预先创建菜单（避免首次打开慢）
-        self.menu_widget = ModernMenuWidget()
-        self.setup_icon()
-        self.setup_menu()
-        # 设置悬停提示
-        self.setToolTip("Voicing")
-
-    def _init_icon_cache(self):
-        """预先生成并缓存所有状态的图标"""
-        import io
-        size = 256
-
-        # 生成基础圆形图标
-        bg_color = (26, 26, 46, 255)  # #1A1A2E
-        base = Image.new('RGBA', (size, size), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(base)
-        draw.ellipse([0, 0, size-1, size-1], fill=bg_color)
-        original = load_base_icon(size)
-        base = Image.alpha_composite(base, original)
-        mask = Image.new('L', (size, size), 0)
-        ImageDraw.Draw(mask).ellipse([0, 0, size-1, size-1], fill=255)
-        base.putalpha(mask)
-
-        # 缓存：正常状态
-        self._icon_cache['normal'] = self._pil_to_qicon(base)
-
-        # 缓存：暗淡状态（闪烁用）
-        dim = base.copy()
-        alpha = dim.split()[3]
-        alpha = alpha.point(lambda x: int(x * 0.4))
-        dim.putalpha(alpha)
-        self._icon_cache['dim'] = self._pil_to_qicon(dim)
-
-        # 缓存：灰度状态（暂停用）
-        r, g, b, a = base.split()
-        gray = base.convert('L')
-        paused = Image.merge('RGBA', (gray, gray, gray, a))
-        self._icon_cache['paused'] = self._pil_to_qicon(paused)
-
-    def _pil_to_qicon(self, pil_image):
-        """PIL Image 转 QIcon"""
-        import io
-        byte_data = io.BytesIO()
-        pil_image.save(byte_data, format='PNG')
-        byte_data.seek(0)
-        qpix = QPixmap()
-        qpix.loadFromData(byte_data.getvalue())
-        return QIcon(qpix)
-
-    def setup_icon(self):
-        """设置图标 - 使用新的麦克风+声波图标"""
-        import io
-        
-        # 加载基础图标
-        icon = load_base_icon(32)
-        
-        # 转换为 QPixmap
-        byte_data = io.BytesIO()
-        icon.save(byte_data, format='PNG')
-        byte_data.seek(0)
-        qpix = QPixmap()
-        qpix.loadFromData(byte_data.getvalue())
-
-        self.setIcon(QIcon(qpix))
-
-    def setup_menu(self):
-        """设置菜单"""
-        # 不使用 QMenu，而是自定义菜单
-        self.activated.connect(self.on_tray_activated)
-
-    def on_tray_activated(self, reason):
-        """托盘图标激活事件"""
-        if reason == QSystemTrayIcon.Context:
-            # 只有右键点击才显示菜单
-            self.show_custom_menu()
-
-    def show_custom_menu(self):
-        """显示自定义菜单"""
-        # 更新状态
-        self.menu_widget.update_state()
-
-        # 获取托盘图标位置并显示菜单（带动画）
-        pos = QCursor.pos()
-        self.menu_widget.show_at_position(pos)
-
-    def update_icon(self, status, dim=False):
-        """更新图标状态 - 使用缓存的图标（快速切换）
-
-        Args:
-            status: 未使用，保留兼容
-            dim: 是否为暗淡状态（用于闪烁效果）
+            session.complete(ready_frame)
+
+
+# ============================================================
+# Text Streams / 长文本流
+# ============================================================
+_stream_ids = itertools.count(1)  # 客户端未指定时生成的流 ID
+_message_ids = itertools.count(1)  # 长文本在撤销历史中的键
+
+
+class TextStream:
+    """
+    A long text injected in bounded chunks / 分块输入的长文本
+
+    Text arrives as one large `text` message or as `stream_chunk` messages.
+    It is split at grapheme boundaries into STREAM_CHUNK_CHARS pieces queued
+    on the connection's injection queue, so other phones interleave between
+    chunks. Every typed chunk is reported with a `progress` frame; `cancel`
+    skips the chunks that have not been typed yet.
+    """
+
+    def __init__(self, stream_id, session: ClientSession):
+        self.stream_id = stream_id
+        self.session = session
+        self.received = 0
+        self.injected = 0
+        self.cancelled = False  # 由注入线程读取（token）
+        self.closed = False     # 不再接收新的分块
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self._pending = []
+        self._message = next(_message_ids)  # 撤销历史中所有分块共用的键
+
+    def feed(self, text: str):
+        """Queue more text / 追加文本"""
+        for chunk in split_text(text, STREAM_CHUNK_CHARS):
+            if not chunk:
+                continue
+            self.received += len(chunk)
+            done = state.injector.submit(chunk, self.session, token=self, message=self._message)
+            done.add_done_callback(partial(self._chunk_done, len(chunk)))
+            self._pending.append(done)
+
+    def _chunk_done(self, length: int, done: asyncio.Future):
+        if done.cancelled() or done.exception() is not None:
+            return
+        started, finished = done.result()
+        if self.started is None:
+            self.started = started
+        self.finished = finished
+        self.injected += length
+        self.session.send(json.dumps({
+            "type": "progress",
+            "stream": self.stream_id,
+            "injected": self.injected,
+            "received": self.received,
+        }))
+
+    def cancel(self):
+        """Skip the chunks not typed yet / 跳过尚未输入的分块"""
+        self.cancelled = True
+        self.closed = True
+
+    async def wait(self):
+        """
+        Wait until every queued chunk is done / 等待所有分块完成
+
+        Returns the (start, end) of the injection like InjectionWorker
+        futures; raises InjectionCancelled if the stream was cancelled.
         """
-        if not state.sync_enabled:
-            # 暂停状态
-            self.setIcon(self._icon_cache['paused'])
-        elif len(state.connected_clients) == 0 and dim:
-            # 等待连接 + 暗淡状态
-            self.setIcon(self._icon_cache['dim'])
+        results = await asyncio.gather(*self._pending, return_exceptions=True)
+        if self.cancelled:
+            raise InjectionCancelled()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        if self.started is None:
+            self.started = self.finished = time.monotonic()
+        return self.started, self.finished
+
+    def summary(self) -> dict:
+        return {
+            "type": "stream_end",
+            "stream": self.stream_id,
+            "received": self.received,
+            "injected": self.injected,
+            "cancelled": self.cancelled,
+        }
+
+
+def find_stream(streams: dict, stream_id) -> Optional[TextStream]:
+    """Open stream by id; None for unknown or malformed ids / 按 ID 查找长文本流"""
+    if not isinstance(stream_id, (str, int)):
+        return None
+    return streams.get(stream_id)
+
+
+def open_stream(streams: dict, stream_id, session: ClientSession) -> TextStream:
+    """Create a stream for a connection / 为连接创建长文本流"""
+    if not isinstance(stream_id, (str, int)) or isinstance(stream_id, bool) or stream_id in streams:
+        stream_id = f"s{next(_stream_ids)}"
+    stream = TextStream(stream_id, session)
+    streams[stream_id] = stream
+    return stream
+
+
+async def run_stream(streams: dict, stream: TextStream, msg_id=None, received_at: Optional[float] = None):
+    """
+    Wait for a stream to be typed, then report / 等待长文本输入完成并回报
+
+    A stream that came in as a plain `text` message (`received_at` given)
+    also gets the regular ack, so phones unaware of streams still clear
+    their input.
+    """
+    try:
+        if received_at is not None:
+            await send_ack_when_done(stream.session, stream.wait(), msg_id, received_at)
         else:
-            # 正常状态（已连接或等待连接的亮状态）
-            self.setIcon(self._icon_cache['normal'])
+            try:
+                await stream.wait()
+            except InjectionCancelled:
+                pass
+    finally:
+        streams.pop(stream.stream_id, None)
+    stream.session.send(json.dumps(stream.summary()))
 
 
 # ============================================================
-# System Tray / 系统托盘 (保留兼容函数)
+# Reserved for future features / 保留给未来功能
 # ============================================================
 
-def get_base_icon_path() -> str:
-    """获取基础图标路径"""
-    if getattr(sys, 'frozen', False):
-        # 打包后的路径
-        base_path = sys._MEIPASS
-    else:
-        # 开发环境路径
-        base_path = os.path.dirname(os.path.abspath(__file__))
-    return os.path.join(base_path, 'assets', 'icon_1024.png')
 
+# ============================================================
+# WebSocket Server / WebSocket 服务器
+# ============================================================
+async def handle_client(websocket):
+    """Handle incoming WebSocket connections / 处理传入的WebSocket连接"""
+    client_addr = websocket.remote_address
+    state.connected_clients.add(websocket)
+    # Ack tasks waiting for the injection worker / 等待注入完成的确认任务
+    pending_acks = set()
+    # Anonymous session until the phone identifies itself with `hello` or
+    # `resume` / 在手机发送 hello 或 resume 之前使用匿名会话
+    session = new_session()
+    session.attach(websocket)
+    recorder = state.recorder
+    conn = recorder.attach(websocket) if recorder is not None else 0
+    # One injection queue per session / 每个会话一个注入队列
+    batcher = TextBatcher(state.injector, state.batch_window, client=session)
+    # Long texts being typed, by stream id / 正在输入的长文本
+    streams = {}
+    counters = state.metrics.client_connected(websocket)
+    logging.info(f"客户端已连接: {client_addr}")
+    log_event("connect", client=client_addr)
+
+    def track(coro):
+        task = asyncio.create_task(coro)
+        pending_acks.add(task)
+        task.add_done_callback(pending_acks.discard)
+
+    # Tray and other listeners update from the event / 托盘等监听者根据事件更新
+    notify_state_listeners("clients", count=len(state.connected_clients))
 
-def load_base_icon(size: int = 64) -> Image.Image:
-    """加载并缩放基础图标"""
-    icon_path = get_base_icon_path()
     try:
-        icon = Image.open(icon_path)
-        icon = icon.convert('RGBA')
-        icon = icon.resize((size, size), Image.Resampling.LANCZOS)
-        return icon
-    except Exception as e:
-        logging.warning(f"无法加载图标 {icon_path}: {e}，使用备用图标")
-        # 备用图标：简单的圆形
-        fallback = Image.new('RGBA', (size, size), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(fallback)
-        draw.ellipse([4, 4, size-4, size-4], fill='#2196F3')
-        return fallback
-
-
-def apply_color_tint(image: Image.Image, color: tuple) -> Image.Image:
-    """应用颜色蒙版到图标（保留透明度）"""
-    # 创建颜色蒙版
-    tinted = Image.new('RGBA', image.size, color)
-    # 使用原图的 alpha 通道作为蒙版
-    result = Image.composite(tinted, Image.new('RGBA', image.size, (0, 0, 0, 0)), image.split()[3])
-    return result
-
-
-def add_status_border(image: Image.Image, color: str, width: int = 4) -> Image.Image:
-    """给图标添加状态边框"""
-    size = image.size[0]
-    result = image.copy()
-    draw = ImageDraw.Draw(result)
-    # 绘制圆形边框
-    draw.ellipse([0, 0, size-1, size-1], outline=color, width=width)
-    return result
-
-
-def create_icon_connected() -> Image.Image:
-    """创建已连接状态托盘图标（正常彩色） / Create connected state tray icon (normal color)"""
-    size = 64
-    icon = load_base_icon(size)
-    # 直接返回原图，不加边框
-    return icon
-
-
-def create_icon_waiting() -> Image.Image:
-    """创建等待连接状态托盘图标（正常） / Create waiting state tray icon (normal)"""
-    size = 64
-    icon = load_base_icon(size)
-    return icon
-
-
-def create_icon_waiting_dim() -> Image.Image:
-    """创建暗淡等待状态托盘图标（低透明度） / Create dim waiting state tray icon (low opacity)"""
-    size = 64
-    icon = load_base_icon(size)
-    # 降低透明度实现闪烁效果
-    alpha = icon.split()[3]
-    alpha = alpha.point(lambda x: int(x * 0.4))  # 40% 透明度
-    icon.putalpha(alpha)
-    return icon
-
-
-def create_icon_paused() -> Image.Image:
-    """创建暂停状态托盘图标（灰度） / Create paused state tray icon (grayscale)"""
-    size = 64
-    icon = load_base_icon(size)
-
-    # 转换为灰度，保留透明度
-    # 分离通道
-    r, g, b, a = icon.split()
-    # 转灰度
-    gray = icon.convert('L')
-    # 重新组合，使用原始 alpha 通道
-    result = Image.merge('RGBA', (gray, gray, gray, a))
-
-    return result
-
-
-def toggle_sync(icon, menu_item):
-    """Toggle sync on/off / 切换同步开关"""
-    state.sync_enabled = not state.sync_enabled
-    update_tray_icon(icon)
-    
-    # Broadcast sync state to all connected clients
-    def send_sync_state():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(broadcast_sync_state())
-        loop.close()
-    
-    threading.Thread(target=send_sync_state, daemon=True).start()
+        # Send welcome message with current sync state, computer name and
+        # protocol version / 发送欢迎消息（同步状态、电脑名、协议版本）
+        await websocket.send(connected_frame(session))
 
+        async for message in websocket:
+            received_at = time.monotonic()
+            session.last_seen = received_at
+            if recorder is not None:
+                recorder.write(REC_IN, conn, message)
+            counters.messages += 1
+            counters.bytes = websocket.received_bytes
+
+            if isinstance(message, bytes):
+                # Protocol v2 binary text frame / 协议 v2 二进制文本帧
+                decoded = decode_binary_text(message)
+                if decoded is None:
+                    logging.debug("忽略未知二进制帧: %s", message[:8].hex(),
+                                  extra={"sample": "binary_frame"})
+                    continue
+                if not state.sync_enabled:
+                    await reject_paused(websocket)
+                    continue
+                seq, text = decoded
+                submit_sequenced_text(session, batcher, SequencedText(seq, text, None, received_at))
+                continue
 
-def toggle_startup(icon, menu_item):
-    """Toggle startup with Windows / 切换开机启动"""
-    current = is_startup_enabled()
-    set_startup_enabled(not current)
+            try:
+                data = json.loads(message)
+                if not isinstance(data, dict):
+                    # Valid JSON but not a message object / 合法 JSON 但不是消息对象
+                    await websocket.send(error_frame(None, "bad_request"))
+                    continue
+                msg_type = data.get("type", "")
 
+                if msg_type == "text":
+                    # Check if sync is enabled
+                    if not state.sync_enabled:
+                        await reject_paused(websocket)
+                        continue
 
-def quit_app(icon, menu_item):
-    """Quit the application / 退出应用"""
-    state.running = False
-    stop_blink_timer()
-    icon.stop()
+                    text = data.get("content") or ""
+                    if not isinstance(text, str):
+                        await websocket.send(error_frame(data.get("id"), "content must be a string"))
+                        continue
+                    seq = data.get("seq")
+                    if isinstance(seq, int) and not isinstance(seq, bool):
+                        # Sequenced frame: dedup and cumulative ack / 带序号：去重并累计确认
+                        submit_sequenced_text(
+                            session, batcher,
+                            SequencedText(seq, text, data.get("id"), received_at)
+                        )
+                    elif len(text) > STREAM_CHUNK_CHARS:
+                        # Long transcript: typed in chunks with progress
+                        # 长文本：分块输入并回报进度
+                        batcher.flush()
+                        stream = open_stream(streams, data.get("id"), session)
+                        stream.feed(text)
+                        stream.closed = True
+                        track(run_stream(streams, stream, data.get("id"), received_at))
+                    elif text:
+                        # Queue the text and ack once it has been typed
+                        # 文本交给注入线程，输入完成后再发送确认
+                        done = batcher.add(text)
+                        track(send_ack_when_done(session, done, data.get("id"), received_at))
+
+                elif msg_type == "keys":
+                    # Key sequence as one batched injection, after the text
+                    # already received / 按键序列作为一次批量注入，排在已收到的文本之后
+                    if not state.sync_enabled:
+                        await reject_paused(websocket)
+                        continue
+                    try:
+                        keys = parse_key_sequence(data.get("keys"))
+                    except ValueError as e:
+                        await websocket.send(error_frame(data.get("id"), str(e)))
+                        continue
+                    batcher.flush()
+                    done = state.injector.submit(keys, session)
+                    track(send_ack_when_done(session, done, data.get("id"), received_at))
 
+                elif msg_type == "replace":
+                    # Whole IME buffer with a revision; only the changed tail
+                    # is retyped / 带版本号的完整输入框内容，只重新输入变化的尾部
+                    if not state.sync_enabled:
+                        await reject_paused(websocket)
+                        continue
+                    edit = apply_replace(session, data)
+                    if edit is None:
+                        await websocket.send(json.dumps({"type": "replace", "rev": data.get("rev"), "stale": True}))
+                        continue
+                    batcher.flush()
+                    done = state.injector.submit(edit, session)
+                    track(send_replace_result(session, done, session.revision, edit))
 
-def stop_blink_timer():
-    """Stop the blink timer / 停止闪烁定时器"""
-    if state.blink_timer:
-        state.blink_timer.cancel()
-        state.blink_timer = None
+                elif msg_type == "undo":
+                    # Erase the last injections on the PC / 删除 PC 上最近的输入
+                    if not state.sync_enabled:
+                        await reject_paused(websocket)
+                        continue
+                    count = data.get("count", 1)
+                    if not isinstance(count, int) or isinstance(count, bool) or count < 1:
+                        count = 1
+                    batcher.flush()
+                    # An open replace buffer goes first / 未提交的 replace 缓冲区最先撤销
+                    pending = count_graphemes(session.buffer)
+                    session.buffer = ""
+                    done = state.injector.submit(UndoRequest(min(count, HISTORY_LIMIT), pending), session)
+                    track(send_undo_result(session, done, data.get("id")))
+
+                elif msg_type == "stream_start":
+                    # Text larger than one frame, sent in pieces / 超过单帧大小的文本分段发送
+                    if not state.sync_enabled:
+                        await reject_paused(websocket)
+                        continue
+                    batcher.flush()
+                    stream = open_stream(streams, data.get("stream"), session)
+                    await websocket.send(json.dumps({"type": "stream_start", "stream": stream.stream_id}))
+
+                elif msg_type == "stream_chunk":
+                    stream = find_stream(streams, data.get("stream"))
+                    content = data.get("content") or ""
+                    if not isinstance(content, str):
+                        await websocket.send(error_frame(data.get("id"), "content must be a string"))
+                    elif stream is not None and not stream.closed:
+                        stream.feed(content)
+
+                elif msg_type == "stream_end":
+                    stream = find_stream(streams, data.get("stream"))
+                    if stream is not None and not stream.closed:
+                        stream.closed = True
+                        track(run_stream(streams, stream))
+
+                elif msg_type == "cancel":
+                    stream = find_stream(streams, data.get("stream"))
+                    if stream is not None:
+                        was_open = not stream.closed
+                        stream.cancel()
+                        if was_open:
+                            # Upload never finished: report from here / 上传未结束，由此回报
+                            track(run_stream(streams, stream))
+
+                elif msg_type == "hello":
+                    # Attach to the phone's persistent session and negotiate
+                    # the protocol / 绑定持久会话并协商协议版本
+                    client_id = str(data.get("client_id") or "")
+                    if client_id:
+                        session = switch_session(session, get_session(client_id), websocket, batcher)
+                        if data.get("reset"):
+                            session.reset()
+                    requested = data.get("protocol", 1)
+                    session.protocol = min(PROTOCOL_VERSION, requested) if isinstance(requested, int) else 1
+                    session.binary = session.protocol >= 2 and bool(data.get("binary"))
+                    await websocket.send(session_frame(session))
+                    session.replay()
+
+                elif msg_type == "resume":
+                    # Reattach after a drop; undelivered frames follow the reply
+                    # 断线后恢复会话，未送达的帧在回复之后补发
+                    resumed = find_resumable(str(data.get("token") or ""))
+                    if resumed is not None:
+                        session = switch_session(session, resumed, websocket, batcher)
+                    await websocket.send(session_frame(session, resumed=resumed is not None))
+                    if resumed is not None:
+                        replayed = session.replay()
+                        logging.info(f"会话已恢复: {client_addr}，补发 {replayed} 帧")
+
+                elif msg_type == "floor":
+                    # Exclusive input lease for pair programming / 独占输入租约
+                    await websocket.send(handle_floor_request(session, data))
 
+                elif msg_type == "ping":
+                    # Respond with pong and current sync state
+                    await websocket.send(control_frame("pong"))
 
-def start_blink_timer(icon):
-    """Start the icon blink timer / 启动图标闪烁定时器"""
-    stop_blink_timer()
-    
-    def blink():
-        if not state.running:
-            return
-        if len(state.connected_clients) == 0 and state.sync_enabled:
-            # Toggle blink state
-            state.blink_state = not state.blink_state
-            if state.blink_state:
-                icon.icon = create_icon_waiting()
-            else:
-                icon.icon = create_icon_waiting_dim()
-            # Schedule next blink
-            state.blink_timer = threading.Timer(0.5, blink)
-            state.blink_timer.daemon = True
-            state.blink_timer.start()
-    
-    blink()
-
-
-def update_tray_icon(icon):
-    """Update tray icon based on state / 根据状态更新托盘图标"""
-    stop_blink_timer()
-
-    if not state.sync_enabled:
-        # Sync disabled - gray icon
-        icon.icon = create_icon_paused()
-        icon.title = f"Voicing - Paused\nws://{HOTSPOT_IP}:{state.ws_port}"
-    elif len(state.connected_clients) > 0:
-        # Has connected clients - green icon
-        icon.icon = create_icon_connected()
-        client_count = len(state.connected_clients)
-        icon.title = f"Voicing - {client_count} Connected\nws://{HOTSPOT_IP}:{state.ws_port}"
-    else:
-        # Waiting for connection - blue blinking icon
-        icon.title = f"Voicing - Waiting\nws://{HOTSPOT_IP}:{state.ws_port}"
-        start_blink_timer(icon)
+            except json.JSONDecodeError:
+                # If not JSON, treat as plain text
+                if message.strip():
+                    if state.sync_enabled:
+                        # Plain-text clients get no ack / 纯文本客户端不需要确认
+                        track(log_injection_failure(batcher.add(message)))
+                    else:
+                        state.metrics.rejected_paused += 1
 
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    finally:
+        # Text already received is still typed / 已收到的文本仍然输入
+        batcher.flush()
+        session.detach(websocket)
+        if session.websocket is None:
+            # Not resumed on another connection / 未在其他连接上恢复
+            state.injector.release_floor(session)
+        state.connected_clients.discard(websocket)
+        state.metrics.client_disconnected(websocket)
+        if recorder is not None:
+            recorder.detach(conn)
+        logging.info(f"客户端已断开: {client_addr}")
+        log_event("disconnect", client=client_addr)
+        logging.info(f"延迟统计: {state.latency.summary()}")
+        
+        notify_state_listeners("clients", count=len(state.connected_clients))
+
+
+def connected_frame(session: ClientSession) -> str:
+    """Welcome frame with the session's resume token / 带恢复令牌的欢迎帧"""
+    frame = _CONTROL_FRAMES["connected"](state.sync_enabled)
+    frame["resume_token"] = session.resume_token
+    return json.dumps(frame)
+
+
+def session_frame(session: ClientSession, **fields) -> str:
+    """Reply to `hello` / `resume` / 对 hello、resume 的回复"""
+    return json.dumps({
+        "type": "session",
+        "client_id": session.client_id,
+        "acked_seq": session.completed_seq,
+        "protocol": session.protocol,
+        "binary": session.binary,
+        "resume_token": session.resume_token,
+        **fields
+    })
 
-def run_tray():
-    """Run the system tray application with PyQt5 / 使用PyQt5运行系统托盘应用"""
-    # 创建 QApplication（如果不存在）
-    if QApplication.instance() is None:
-        app = QApplication(sys.argv)
-    else:
-        app = QApplication.instance()
 
-    app.setQuitOnLastWindowClosed(False)
+def switch_session(current: ClientSession, target: ClientSession, websocket, batcher: TextBatcher) -> ClientSession:
+    """
+    Move a connection onto another session / 将连接切换到另一个会话
+
+    A connection the target is still bound to is aborted: when the phone
+    has already reconnected, the old socket is dead even if no ping has
+    timed out yet.
+    """
+    if target is current:
+        return current
+    current.detach(websocket)
+    old = target.websocket
+    if old is not None and old is not websocket:
+        logging.info(f"关闭被恢复会话的旧连接: {old.remote_address}")
+        reap_client(old)
+    target.attach(websocket)
+    batcher.rebind(target)
+    return target
 
-    # 创建现代托盘图标
-    tray_icon = ModernTrayIcon()
-    tray_icon.show()
 
-    # 更新初始状态
-    update_tray_icon_pyqt(tray_icon)
+def error_frame(msg_id, message: str) -> str:
+    """Reply to a malformed request / 对格式错误请求的回复"""
+    return json.dumps({"type": "error", "id": msg_id, "message": message})
 
-    # 保存到状态
-    state.tray_icon = tray_icon
 
-    # 定时更新图标状态
-    update_timer = QTimer()
-    update_timer.timeout.connect(lambda: update_tray_icon_pyqt(tray_icon))
-    update_timer.start(200)  # 每200ms更新（闪烁）
+async def reject_paused(websocket):
+    """Sync is paused: the text is dropped / 同步已暂停，文本不输入"""
+    state.metrics.rejected_paused += 1
+    await websocket.send(control_frame("sync_disabled"))
 
-    # 运行应用
-    app.exec()
 
+def handle_floor_request(client, data: dict) -> str:
+    """
+    Handle a `floor` message / 处理 floor 消息
 
-def update_tray_icon_pyqt(tray_icon):
-    """更新 PyQt5 托盘图标状态"""
-    # 判断是否需要闪烁（等待连接状态）
-    if state.sync_enabled and len(state.connected_clients) == 0:
-        # 等待连接 - 切换闪烁状态
-        state.blink_state = not state.blink_state
-        tray_icon.update_icon(None, dim=state.blink_state)
+    `{"type": "floor", "action": "request", "lease": seconds}` asks for (or
+    renews) exclusive input; `"action": "release"` gives it back. The reply
+    tells whether this client holds the floor and for how long. A NaN or
+    infinite lease (which json.loads accepts) gets an error frame.
+    """
+    injector = state.injector
+    if data.get("action") == "release":
+        injector.release_floor(client)
+        granted = False
     else:
-        # 其他状态 - 正常更新
-        tray_icon.update_icon(None, dim=False)
+        lease = data.get("lease", FLOOR_LEASE)
+        if not isinstance(lease, (int, float)) or isinstance(lease, bool):
+            lease = FLOOR_LEASE
+        if not math.isfinite(lease):
+            return error_frame(data.get("id"), "lease must be a finite number")
+        granted = injector.grant_floor(client, float(lease)) is not None
+    return json.dumps({
+        "type": "floor",
+        "granted": granted,
+        "expires_in": round(injector.floor_remaining(client) * 1000),
+    })
+
+
+async def log_injection_failure(done: asyncio.Future):
+    """Await an injection nobody acks and log if it failed / 等待无需确认的注入，失败时记录日志"""
+    try:
+        await done
+    except InjectionCancelled:
+        pass
+    except Exception as e:
+        logging.error(f"文本输入失败: {e}")
+
+
+async def send_ack_when_done(session: ClientSession, done: asyncio.Future, msg_id, received_at: float):
+    """
+    Send the ack after the injection finished / 注入完成后发送确认
+
+    The ack echoes the message id and the server-side timestamps (monotonic
+    milliseconds) so the phone can tell network delay from queueing and
+    paste time. It goes through the session, so an ack for a phone that
+    dropped meanwhile is replayed when it resumes.
+    """
+    try:
+        inject_start, inject_end = await done
+    except InjectionCancelled:
+        return
+    except Exception as e:
+        logging.error(f"文本输入失败: {e}")
+        session.send(error_frame(msg_id, str(e)))
+        return
+    acked_at = time.monotonic()
+    state.latency.record(received_at, inject_start, inject_end, acked_at)
+    log_text_event(session.address, received_at, (inject_start, inject_end), acked_at, id=msg_id)
+    session.send(json.dumps({
+        "type": "ack",
+        "message": "Text received and typed",
+        "id": msg_id,
+        "timing": {
+            "recv": trace_ms(received_at),
+            "inject_start": trace_ms(inject_start),
+            "inject_end": trace_ms(inject_end),
+            "ack": trace_ms(acked_at),
+        }
+    }))
+
+
+def apply_replace(session: ClientSession, data: dict) -> Optional[ReplaceEdit]:
+    """
+    Diff a `replace` message against the session buffer / 将 replace 消息与会话缓冲区比较
 
+    Revisions must increase; an older or repeated one (reordered or resent
+    after a reconnect) returns None. The buffer is updated right away: edits
+    run in queue order, so the next diff starts from what this one leaves.
+    `"commit": true` ends the buffer, the next revision starts a new one.
+    """
+    revision = data.get("rev")
+    content = data.get("content", "")
+    if (not isinstance(revision, int) or isinstance(revision, bool)
+            or revision <= session.revision or not isinstance(content, str)):
+        return None
+    erase, text = diff_edit(session.buffer, content)
+    committed = count_graphemes(content) if data.get("commit") else 0
+    session.revision = revision
+    session.buffer = "" if data.get("commit") else content
+    return ReplaceEdit(erase, text, committed)
+
+
+async def send_replace_result(session: ClientSession, done: asyncio.Future, revision: int, edit: ReplaceEdit):
+    """Confirm a revision once it is on screen / 版本内容输入完成后确认"""
+    try:
+        await done
+    except Exception as e:
+        logging.error(f"修正输入失败: {e}")
+        session.send(json.dumps({"type": "error", "rev": revision, "message": str(e)}))
+        return
+    session.send(json.dumps({
+        "type": "replace",
+        "rev": revision,
+        "erased": edit.erase,
+        "inserted": len(edit.text),
+    }))
 
-# 保留兼容的 update_tray_icon 函数
-def update_tray_icon(icon=None):
-    """Update tray icon based on state / 根据状态更新托盘图标（兼容函数）"""
-    if icon is None:
-        # 如果没有传入 icon，跳过（PyQt5 模式）
+
+async def send_undo_result(session: ClientSession, done: asyncio.Future, msg_id):
+    """Report how many characters an undo removed / 回报撤销删除的字符数"""
+    try:
+        _, _, removed = await done
+    except Exception as e:
+        logging.error(f"撤销失败: {e}")
+        session.send(error_frame(msg_id, str(e)))
         return
-    # 原 pystray 逻辑保留
-    stop_blink_timer()
-
-    if not state.sync_enabled:
-        icon.icon = create_icon_paused()
-        icon.title = f"Voicing - Paused\nws://{HOTSPOT_IP}:{state.ws_port}"
-    elif len(state.connected_clients) > 0:
-        icon.icon = create_icon_connected()
-        client_count = len(state.connected_clients)
-        icon.title = f"Voicing - {client_count} Connected\nws://{HOTSPOT_IP}:{state.ws_port}"
-    else:
-        icon.title = f"Voicing - Waiting\nws://{HOTSPOT_IP}:{state.ws_port}"
-        start_blink_timer(icon)
+    session.send(json.dumps({"type": "undo", "id": msg_id, "removed": removed}))
+
+
+async def send_with_timeout(websocket, message) -> bool:
+    """
+    Send one frame within BROADCAST_SEND_TIMEOUT / 限时发送一帧
+
+    A client that cannot take the frame in time (full send buffer, dead
+    Wi-Fi) is dropped so it cannot hold back the others.
+    Returns False if the client is gone or was dropped.
+    """
+    try:
+        await asyncio.wait_for(websocket.send(message), BROADCAST_SEND_TIMEOUT)
+        return True
+    except asyncio.TimeoutError:
+        logging.warning(f"客户端发送超时，断开: {websocket.remote_address}")
+        reap_client(websocket)
+    except websockets.exceptions.ConnectionClosed:
+        pass
+    except Exception as e:
+        logging.debug(f"广播发送失败 ({websocket.remote_address}): {e}")
+    return False
+
+
+def reap_client(websocket):
+    """Drop a client that cannot keep up / 断开跟不上的客户端"""
+    state.connected_clients.discard(websocket)
+    # Abort instead of a close handshake the client would not answer
+    # 直接中断连接，不等待对方不会响应的关闭握手
+    transport = getattr(websocket, "transport", None)
+    if transport is not None:
+        transport.abort()
+
+
+async def broadcast(message):
+    """Send a frame to all clients concurrently / 并发发送给所有客户端"""
+    clients = list(state.connected_clients)
+    if not clients:
+        return 0
+    results = await asyncio.gather(*(send_with_timeout(c, message) for c in clients))
+    return sum(results)
+
+
+async def broadcast_sync_state():
+    """Broadcast sync state to all connected clients / 广播同步状态给所有客户端"""
+    await broadcast(control_frame("sync_state"))
+
+
+def call_in_server_loop(coro):
+    """
+    Run a coroutine on the server loop from any thread / 从任意线程在服务器事件循环中执行协程
+
+    Websockets belong to the server loop, so sends must happen there.
+    Returns a concurrent.futures.Future, or None if the server is not running.
+    """
+    loop = state.loop
+    if loop is None or loop.is_closed():
+        coro.close()
+        return None
+    return asyncio.run_coroutine_threadsafe(coro, loop)
+
+
+async def start_server():
+    """Start the WebSocket server / 启动WebSocket服务器"""
+    state.loop = asyncio.get_running_loop()
+    state.injector = InjectionWorker()
+    # websockets logs every /metrics and /healthz answer as "connection
+    # rejected (200 OK)"; connects and disconnects are logged by handle_client
+    # 每次抓取指标都会被记为连接被拒绝，连接与断开已由 handle_client 记录
+    logging.getLogger("websockets.server").setLevel(logging.WARNING)
+    try:
+        started = time.perf_counter()
+        async with serve(handle_client, "0.0.0.0", state.ws_port,
+                         extensions=server_extensions(), compression=None,
+                         max_size=state.max_frame_size,
+                         ping_interval=state.ping_interval, ping_timeout=state.ping_timeout,
+                         close_timeout=WS_CLOSE_TIMEOUT,
+                         create_protocol=CountingServerProtocol,
+                         process_request=process_http_request):
+            startup.record("server_bind", started)
+            # The worker creates the injection backend (pyautogui, pyperclip)
+            # once the server is listening / 服务器开始监听后由工作线程创建注入后端
+            state.injector.start()
+            lag_monitor = asyncio.create_task(monitor_loop_lag())
+            logging.info(f"WebSocket 服务器已启动: {server_url()}")
+            # Keep server running
+            while state.running:
+                await asyncio.sleep(1)
+            lag_monitor.cancel()
+    except Exception as e:
+        logging.error(f"服务器错误: {e}")
+    finally:
+        state.injector.stop()
+        state.loop = None
+
+
+def run_server():
+    """Run the server in a separate thread / 在单独线程中运行服务器"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start_server())
 
 
 # ============================================================
 # Main Entry / 主入口
 # ============================================================
+def run_tray():
+    """Load the tray UI and run it in this thread / 加载托盘界面并在当前线程运行"""
+    with startup.phase("tray_imports"):
+        import tray_ui
+    tray_ui.run_tray()
+
+
+def run_headless(server_thread: threading.Thread):
+    """
+    Run without the tray until SIGINT/SIGTERM / 无托盘运行，直到收到 SIGINT/SIGTERM
+
+    Only the server, discovery and injection worker run and no GUI library
+    is imported, so this works as a background service and on Linux.
+    """
+    stop = threading.Event()
+
+    def on_signal(signum, frame):
+        logging.info(f"收到信号 {signum}，正在退出")
+        stop.set()
+
+    for name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, name):
+            signal.signal(getattr(signal, name), on_signal)
+
+    logging.info(f"无界面模式运行中: {server_url()}")
+    # Short waits keep Ctrl+C responsive on Windows / 短超时保证 Windows 下 Ctrl+C 及时响应
+    while not stop.wait(1.0):
+        if not server_thread.is_alive():
+            logging.error("服务器线程已退出")
+            break
+
+    state.running = False
+    if state.discovery is not None:
+        state.discovery.wake(broadcast=False)
+    server_thread.join(timeout=2)
+
+
 def main():
     """Main entry point / 主入口"""
     global HOTSPOT_IP
+    startup.record("imports", _STARTUP_T0)
 
     # 初始化日志系统
-    setup_logging()
+    with startup.phase("logging"):
+        setup_logging(state.log_level, state.event_log)
 
     # Detect hotspot IP at startup
-    HOTSPOT_IP = get_hotspot_ip()
+    with startup.phase("ip_detection"):
+        HOTSPOT_IP = get_hotspot_ip()
+        state.discovery_payload = build_discovery_payload()
     logging.info(f"检测到热点 IP: {HOTSPOT_IP}")
 
+    state.rules = TextRules(state.rules_path or get_rules_path())
+
+    if state.record_path is not None:
+        try:
+            state.recorder = SessionRecorder(state.record_path)
+            logging.warning(f"会话录制已开启（包含听写内容）: {state.record_path}")
+        except OSError as e:
+            logging.error(f"无法打开录制文件 {state.record_path}: {e}")
+
+    # Follow hotspot restarts / 跟踪热点重启导致的地址变化
+    NetworkWatcher().start()
+
     # Start WebSocket server in background thread
     ws_thread = threading.Thread(target=run_server, daemon=True)
     ws_thread.start()
@@ -1103,14 +3627,82 @@ def main():
     udp_thread = threading.Thread(target=start_udp_broadcast, daemon=True)
     udp_thread.start()
 
-    # Run tray icon with PyQt5 in main thread
+    if state.headless:
+        run_headless(ws_thread)
+        return
+
+    # Run tray icon with PyQt5 in main thread, after the server and
+    # discovery threads are already starting / 服务器和广播线程启动后再加载托盘
     run_tray()
 
 
+def parse_args():
+    """Parse command line options / 解析命令行参数"""
+    parser = argparse.ArgumentParser(prog=APP_NAME)
+    # Development mode: skip single instance check
+    # 开发模式：跳过单实例检查，方便快速迭代
+    parser.add_argument("--dev", action="store_true",
+                        help="skip the single instance check")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without the tray icon (no Qt/Pillow), stop with Ctrl+C or SIGTERM")
+    parser.add_argument("--backend", choices=sorted(INJECTION_BACKENDS),
+                        default=DEFAULT_INJECTION_BACKEND,
+                        help="text injection backend")
+    parser.add_argument("--compress-min-size", type=int, metavar="BYTES",
+                        default=COMPRESSION_MIN_SIZE,
+                        help="only deflate messages at least this large (-1 disables compression)")
+    parser.add_argument("--batch-window", type=float, metavar="MS",
+                        default=TEXT_BATCH_WINDOW * 1000,
+                        help="merge text frames arriving within this window (0 disables)")
+    parser.add_argument("--clipboard-delay", type=float, metavar="MS",
+                        default=CLIPBOARD_SETTLE_DELAY * 1000,
+                        help="time the target app gets to read a paste before the clipboard changes again")
+    parser.add_argument("--rules", type=Path, metavar="FILE",
+                        help=f"text rule file (default: %%APPDATA%%\\Voicing\\{RULES_FILE_NAME})")
+    parser.add_argument("--ping-interval", type=float, metavar="SECONDS",
+                        default=WS_PING_INTERVAL,
+                        help="server heartbeat interval (0 disables heartbeats)")
+    parser.add_argument("--ping-timeout", type=float, metavar="SECONDS",
+                        default=WS_PING_TIMEOUT,
+                        help="drop a connection whose heartbeat is not answered in time")
+    parser.add_argument("--max-frame-size", type=int, metavar="BYTES",
+                        default=MAX_FRAME_SIZE,
+                        help="largest WebSocket message accepted (longer texts must be streamed)")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+                        default="INFO", help="log verbosity")
+    parser.add_argument("--event-log", action="store_true",
+                        help="also write one JSON record per message to events.jsonl")
+    parser.add_argument("--record", type=Path, metavar="FILE",
+                        help="append every frame and injection to a binary recording (see replay.py)")
+    parser.add_argument("--startup-report", action="store_true",
+                        help="log per-phase cold start timings")
+    # Unknown options (e.g. Qt's) are left for QApplication
+    args, _ = parser.parse_known_args()
+    return args
+
+
 if __name__ == "__main__":
-    # Development mode: run with --dev flag to skip single instance check
-    # 开发模式：使用 --dev 参数跳过单实例检查，方便快速迭代
-    DEV_MODE = "--dev" in sys.argv
+    # tray_ui imports this module by name; reuse the running script instead
+    # of loading a second copy with its own state / 避免 tray_ui 重复加载本模块
+    sys.modules.setdefault("voice_coding", sys.modules[__name__])
+
+    args = parse_args()
+    state.headless = args.headless
+    state.rules_path = args.rules
+    if args.startup_report:
+        startup.enable([phase for phase in STARTUP_PHASES
+                        if not (state.headless and phase in TRAY_STARTUP_PHASES)])
+    state.batch_window = max(0.0, args.batch_window / 1000)
+    state.clipboard_delay = max(0.0, args.clipboard_delay / 1000)
+    state.compression_min_size = args.compress_min_size
+    state.max_frame_size = args.max_frame_size
+    state.ping_interval = args.ping_interval if args.ping_interval > 0 else None
+    state.ping_timeout = args.ping_timeout if args.ping_timeout > 0 else None
+    state.log_level = getattr(logging, args.log_level)
+    state.event_log = args.event_log
+    state.record_path = args.record
+    state.backend_name = args.backend
+    DEV_MODE = args.dev
 
     if not DEV_MODE:
         # Check single instance first (only in production)